@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+
+"""
+This is the benchmark suite for the raingutter database diff/sync tool.
+It isn't installed with the package; run the modules from the top of the
+source tree, e.g.:
+    python -m bench.dataset --help
+    python -m bench.end_to_end --help
+    python -m bench.micro --help
+
+The end-to-end benchmark requires a local MySQL server and a MySQL
+driver (MySQLdb or pymysql); the micro-benchmarks only need what
+raingutter itself requires.
+
+"""
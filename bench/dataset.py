@@ -0,0 +1,1292 @@
+#!/usr/bin/env python
+
+
+"""
+This is the synthetic dataset generator for the raingutter benchmarks.
+
+It builds an OCS Inventory NG database and a Drupal 7 inventory database
+(matching the ocs2drupal templates) in a local MySQL server, for a given
+number of servers.  The Drupal side is derived from the OCS side with the
+ocs2drupal transform functions, then 'drifted' so that a diff/sync has
+work to do:
+    change_rate: fraction of servers with changed values in Drupal
+                 (updates)
+    missing_rate: fraction of servers with values missing from Drupal
+                  (inserts)
+    extra_rate: fraction of servers with extra values in Drupal
+                (deletes)
+    stale_rate: fraction of servers with a superseded hardware row in OCS
+                (exercises the 'latest hardware per TAG' filter)
+
+The output is deterministic for a given seed.
+
+Note: both databases are dropped and recreated.
+
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import argparse
+import collections
+import decimal
+import random
+import socket
+import struct
+import time
+
+
+#########
+# add-on
+#########
+
+try:
+    import MySQLdb as db_driver
+except ImportError:
+    try:
+        import pymysql as db_driver
+    except ImportError:
+        db_driver = None
+
+
+###############
+# this package
+###############
+
+from raingutter import ocs2drupal
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+###########
+# defaults
+###########
+
+DEFAULT_OCS_DB = 'raingutter_bench_ocs'
+DEFAULT_DRUPAL_DB = 'raingutter_bench_drupal'
+DEFAULT_SERVERS = 1000
+DEFAULT_CHANGE_RATE = 0.05
+DEFAULT_MISSING_RATE = 0.02
+DEFAULT_EXTRA_RATE = 0.02
+DEFAULT_STALE_RATE = 0.1
+DEFAULT_SEED = 1
+DEFAULT_BATCH_SIZE = 1000
+
+# node titles / OCS tags
+TAG_FORMAT = 'srv{0:06d}.example.com'
+
+
+#############
+# OCS schema
+#############
+
+OCS_TABLES = collections.OrderedDict([
+    ('hardware', '''
+ID INT NOT NULL AUTO_INCREMENT,
+PROCESSORT VARCHAR(255),
+PROCESSORN SMALLINT,
+MEMORY INT,
+OSNAME VARCHAR(255),
+OSVERSION VARCHAR(255),
+OSCOMMENTS VARCHAR(255),
+SWAP INT,
+LASTDATE DATETIME,
+PRIMARY KEY (ID)'''),
+    ('accountinfo', '''
+HARDWARE_ID INT NOT NULL,
+TAG VARCHAR(255),
+PRIMARY KEY (HARDWARE_ID),
+KEY TAG (TAG)'''),
+    ('bios', '''
+HARDWARE_ID INT NOT NULL,
+SMANUFACTURER VARCHAR(255),
+SMODEL VARCHAR(255),
+BVERSION VARCHAR(255),
+BDATE VARCHAR(255),
+PRIMARY KEY (HARDWARE_ID)'''),
+    ('memories', '''
+ID INT NOT NULL AUTO_INCREMENT,
+HARDWARE_ID INT NOT NULL,
+CAPACITY VARCHAR(255),
+TYPE VARCHAR(255),
+NUMSLOTS SMALLINT,
+SPEED VARCHAR(255),
+SERIALNUMBER VARCHAR(255),
+PRIMARY KEY (HARDWARE_ID, ID),
+KEY ID (ID)'''),
+    ('networks', '''
+ID INT NOT NULL AUTO_INCREMENT,
+HARDWARE_ID INT NOT NULL,
+DESCRIPTION VARCHAR(255),
+STATUS VARCHAR(255),
+MACADDR VARCHAR(255),
+IPADDRESS VARCHAR(255),
+IPGATEWAY VARCHAR(255),
+PRIMARY KEY (HARDWARE_ID, ID),
+KEY ID (ID)'''),
+    ('drives', '''
+ID INT NOT NULL AUTO_INCREMENT,
+HARDWARE_ID INT NOT NULL,
+LETTER VARCHAR(255),
+TYPE VARCHAR(255),
+FILESYSTEM VARCHAR(255),
+TOTAL INT,
+VOLUMN VARCHAR(255),
+PRIMARY KEY (HARDWARE_ID, ID),
+KEY ID (ID)'''),
+    ('softwares', '''
+ID INT NOT NULL AUTO_INCREMENT,
+HARDWARE_ID INT NOT NULL,
+NAME VARCHAR(255),
+VERSION VARCHAR(255),
+COMMENTS LONGTEXT,
+PRIMARY KEY (HARDWARE_ID, ID),
+KEY ID (ID)'''),
+])
+
+
+################
+# Drupal schema
+################
+
+DRUPAL_TABLES = collections.OrderedDict([
+    ('node', '''
+nid INT UNSIGNED NOT NULL AUTO_INCREMENT,
+vid INT UNSIGNED,
+type VARCHAR(32) NOT NULL DEFAULT '',
+language VARCHAR(12) NOT NULL DEFAULT '',
+title VARCHAR(255) NOT NULL DEFAULT '',
+uid INT NOT NULL DEFAULT 0,
+status INT NOT NULL DEFAULT 1,
+created INT NOT NULL DEFAULT 0,
+changed INT NOT NULL DEFAULT 0,
+comment INT NOT NULL DEFAULT 0,
+promote INT NOT NULL DEFAULT 0,
+sticky INT NOT NULL DEFAULT 0,
+tnid INT UNSIGNED NOT NULL DEFAULT 0,
+translate INT NOT NULL DEFAULT 0,
+PRIMARY KEY (nid),
+UNIQUE KEY vid (vid),
+KEY node_type (type(4)),
+KEY node_title_type (title, type(4))'''),
+    ('node_revision', '''
+nid INT UNSIGNED NOT NULL DEFAULT 0,
+vid INT UNSIGNED NOT NULL AUTO_INCREMENT,
+uid INT NOT NULL DEFAULT 0,
+title VARCHAR(255) NOT NULL DEFAULT '',
+log LONGTEXT,
+timestamp INT NOT NULL DEFAULT 0,
+status INT NOT NULL DEFAULT 1,
+comment INT NOT NULL DEFAULT 0,
+promote INT NOT NULL DEFAULT 0,
+sticky INT NOT NULL DEFAULT 0,
+PRIMARY KEY (vid),
+KEY nid (nid)'''),
+    ('field_config', '''
+id INT NOT NULL AUTO_INCREMENT,
+field_name VARCHAR(32) NOT NULL,
+type VARCHAR(128) NOT NULL,
+cardinality TINYINT NOT NULL DEFAULT 0,
+deleted TINYINT NOT NULL DEFAULT 0,
+data LONGBLOB NOT NULL,
+PRIMARY KEY (id),
+KEY field_name (field_name)'''),
+    ('field_config_instance', '''
+id INT NOT NULL AUTO_INCREMENT,
+field_id INT NOT NULL,
+field_name VARCHAR(32) NOT NULL DEFAULT '',
+entity_type VARCHAR(32) NOT NULL DEFAULT '',
+bundle VARCHAR(128) NOT NULL DEFAULT '',
+data LONGBLOB NOT NULL,
+deleted TINYINT NOT NULL DEFAULT 0,
+PRIMARY KEY (id),
+KEY field_name_bundle (field_name, entity_type, bundle)'''),
+    ('taxonomy_vocabulary', '''
+vid INT UNSIGNED NOT NULL AUTO_INCREMENT,
+name VARCHAR(255) NOT NULL DEFAULT '',
+machine_name VARCHAR(255) NOT NULL DEFAULT '',
+PRIMARY KEY (vid),
+UNIQUE KEY machine_name (machine_name)'''),
+    ('taxonomy_term_data', '''
+tid INT UNSIGNED NOT NULL AUTO_INCREMENT,
+vid INT UNSIGNED NOT NULL DEFAULT 0,
+name VARCHAR(255) NOT NULL DEFAULT '',
+PRIMARY KEY (tid),
+KEY vid_name (vid, name)'''),
+    ('field_collection_item', '''
+item_id INT NOT NULL AUTO_INCREMENT,
+revision_id INT NOT NULL,
+field_name VARCHAR(32) NOT NULL,
+archived TINYINT NOT NULL DEFAULT 0,
+label VARCHAR(255),
+PRIMARY KEY (item_id)'''),
+    ('field_collection_item_revision', '''
+revision_id INT NOT NULL AUTO_INCREMENT,
+item_id INT NOT NULL,
+PRIMARY KEY (revision_id),
+KEY item_id (item_id)'''),
+    ('relation', '''
+rid INT UNSIGNED NOT NULL AUTO_INCREMENT,
+relation_type VARCHAR(255) NOT NULL DEFAULT '',
+vid INT UNSIGNED NOT NULL DEFAULT 0,
+uid INT UNSIGNED NOT NULL DEFAULT 0,
+created INT NOT NULL DEFAULT 0,
+changed INT NOT NULL DEFAULT 0,
+arity INT UNSIGNED NOT NULL DEFAULT 0,
+PRIMARY KEY (rid),
+KEY relation_type (relation_type)'''),
+    ('relation_revision', '''
+rid INT UNSIGNED NOT NULL DEFAULT 0,
+vid INT UNSIGNED NOT NULL AUTO_INCREMENT,
+relation_type VARCHAR(255) NOT NULL DEFAULT '',
+uid INT UNSIGNED NOT NULL DEFAULT 0,
+changed INT NOT NULL DEFAULT 0,
+arity INT UNSIGNED NOT NULL DEFAULT 0,
+PRIMARY KEY (vid),
+KEY rid (rid)'''),
+    ('variable', '''
+name VARCHAR(128) NOT NULL DEFAULT '',
+value LONGBLOB NOT NULL,
+PRIMARY KEY (name)'''),
+])
+
+# cache bins; raingutter only empties them
+DRUPAL_CACHE_TABLES = ['cache', 'cache_field', 'cache_page', 'cache_block',
+                       'cache_views_data']
+
+# Drupal fields used by the ocs2drupal templates:
+# (field name, kind, SQL type, entity type, bundle, cardinality)
+# where kind is 'value', 'tid' (term reference), 'ip' (IP range), or 'fc'
+# (field collection); the bundle for field collection subfields is the
+# name of the field collection field
+DRUPAL_FIELDS = [
+    ('ocs_hardware_id', 'value', 'INT', 'node', 'server', 1),
+    ('manufacturer', 'value', 'VARCHAR(255)', 'node', 'server', 1),
+    ('model_number', 'value', 'VARCHAR(255)', 'node', 'server', 1),
+    ('firmware_version', 'value', 'VARCHAR(255)', 'node', 'server', 1),
+    ('cpu', 'value', 'VARCHAR(255)', 'node', 'server', 1),
+    ('ram', 'value', 'DECIMAL(10,2)', 'node', 'server', 1),
+    ('os', 'tid', 'INT UNSIGNED', 'node', 'server', 1),
+    ('os_version', 'value', 'VARCHAR(255)', 'node', 'server', 1),
+    ('kernel_string', 'value', 'VARCHAR(255)', 'node', 'server', 1),
+    ('swap_space', 'value', 'DECIMAL(10,3)', 'node', 'server', 1),
+    ('gateway', 'ip', 'BIGINT', 'node', 'server', 1),
+    ('ip_view', 'value', 'BIGINT', 'node', 'server', -1),
+    ('dimms', 'fc', 'INT', 'node', 'server', -1),
+    ('volumes', 'fc', 'INT', 'node', 'server', -1),
+    ('ports', 'fc', 'INT', 'node', 'server', -1),
+    ('software_versions', 'fc', 'INT', 'node', 'server', -1),
+    ('slot_name', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_dimms', 1),
+    ('dimm_size', 'value', 'DECIMAL(10,2)', 'field_collection_item',
+     'field_dimms', 1),
+    ('dimm_type', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_dimms', 1),
+    ('dimm_speed', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_dimms', 1),
+    ('serial_number', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_dimms', 1),
+    ('mount_point', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_volumes', 1),
+    ('device_name', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_volumes', 1),
+    ('filesystem', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_volumes', 1),
+    ('volume_size', 'value', 'INT', 'field_collection_item',
+     'field_volumes', 1),
+    ('port_name_number', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_ports', 1),
+    ('status', 'tid', 'INT UNSIGNED', 'field_collection_item',
+     'field_ports', 1),
+    ('mac_address', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_ports', 1),
+    ('ip', 'ip', 'BIGINT', 'field_collection_item', 'field_ports', -1),
+    ('software_name', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_software_versions', 1),
+    ('software_version', 'value', 'VARCHAR(255)', 'field_collection_item',
+     'field_software_versions', 1),
+    ('comments', 'value', 'LONGTEXT', 'field_collection_item',
+     'field_software_versions', 1),
+    ('source_path', 'value', 'VARCHAR(255)', 'relation', 'nfs_mounts', 1),
+    ('destination_path', 'value', 'VARCHAR(255)', 'relation', 'nfs_mounts',
+     1),
+]
+
+# columns shared by all of the field data/revision tables
+DRUPAL_FIELD_COLUMNS = '''
+entity_type VARCHAR(128) NOT NULL DEFAULT '',
+bundle VARCHAR(128) NOT NULL DEFAULT '',
+deleted TINYINT NOT NULL DEFAULT 0,
+entity_id INT UNSIGNED NOT NULL,
+revision_id INT UNSIGNED NOT NULL DEFAULT 0,
+language VARCHAR(32) NOT NULL DEFAULT '',
+delta INT UNSIGNED NOT NULL,'''
+
+DRUPAL_VOCABULARIES = ['os', 'status']
+
+
+##############
+# source data
+##############
+
+# (OSNAME, OSVERSION, OSCOMMENTS)
+OCS_OS_CHOICES = [
+    ('FreeBSD 10.1-RELEASE-p5', '10.1',
+     'FreeBSD 10.1-RELEASE-p5 #0: Tue Jan 27 08:55:07 UTC 2015\n'
+     'root@amd64-builder.daemonology.net:/usr/obj/usr/src/sys/GENERIC'),
+    ('FreeBSD 9.3-RELEASE', '9.3',
+     'FreeBSD 9.3-RELEASE #0 r268512: Thu Jul 10 23:44:39 UTC 2014'),
+    ('CentOS release 6.6 (Final)', '2.6.32-504.el6.x86_64',
+     '#1 SMP Wed Oct 15 04:27:16 UTC 2014'),
+    ('Ubuntu 14.04.2 LTS', '3.13.0-46-generic',
+     '#79-Ubuntu SMP Tue Mar 10 20:06:50 UTC 2015'),
+    ('Microsoft Windows Server 2008 R2 Standard', '6.1.7601', ''),
+    ('Microsoft Windows Web Server 2008 R2', '6.1.7601', ''),
+]
+
+# (SMANUFACTURER, SMODEL)
+OCS_MODEL_CHOICES = [
+    ('Dell Inc.', 'PowerEdge R620'),
+    ('Dell Inc.', 'PowerEdge R720'),
+    ('HP', 'ProLiant DL360p Gen8'),
+    ('Supermicro', 'X9DRi-LN4+/X9DR3-LN4+'),
+    ('System manufacturer', 'System Product Name'),
+]
+
+OCS_CPU_CHOICES = [
+    'Intel(R) Xeon(R) CPU E5-2620 0 @ 2.00GHz',
+    'Intel(R) Xeon(R) CPU E5-2640 v2 @  2.00GHz',
+    'Intel(R) Xeon(R) CPU E5-2680 v3 @ 2.50GHz',
+]
+
+# (NAME, VERSION choices); names are matched by ocs2drupal.namelist
+OCS_SOFTWARE_CHOICES = [
+    ('apache24', ['2.4.10', '2.4.12']),
+    ('lighttpd', ['1.4.35']),
+    ('mysql56-server', ['5.6.22', '5.6.23']),
+    ('nginx', ['1.6.2', '1.8.0']),
+    ('openjdk', ['7.76.13', '8.31.13']),
+    ('perl5', ['5.18.4_11', '5.20.2_1']),
+    ('php5', ['5.4.38', '5.5.22']),
+    ('python27', ['2.7.9']),
+    ('python34', ['3.4.2', '3.4.3']),
+    ('rsync', ['3.1.1']),
+    ('samba41', ['4.1.17']),
+    ('tomcat', ['7.0.59', '8.0.20']),
+]
+
+# not matched by ocs2drupal.namelist
+OCS_OTHER_SOFTWARE = ['bash', 'curl', 'git', 'screen', 'sudo', 'vim', 'zsh']
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+###############
+# DB utilities
+###############
+
+def connect(host, port, user, password, database=None):
+
+    """
+    Connect to a MySQL server.
+
+    Returns a connection object (autocommit off).
+
+    Parameters:
+        host, port, user, password: connection details
+        database: the database to use, if any
+
+    Dependencies:
+        globals: db_driver
+        modules: sys
+
+    """
+
+    if db_driver is None:
+        print('Error: no MySQL driver is available (install MySQLdb or '
+              'pymysql); exiting.', file=sys.stderr)
+        sys.exit(1)
+    kwargs = dict(host=host, port=port, user=user, passwd=password,
+                  charset='utf8')
+    if database is not None:
+        kwargs['db'] = database
+    conn = db_driver.connect(**kwargs)
+    conn.autocommit(False)
+    return conn
+
+
+def recreate_database(conn, database, tables):
+    """
+    Drop and recreate a database, with the given tables.
+    Parameters:
+        conn: a connection object, from connect()
+        database: the database name
+        tables: an OrderedDict of table names and column definitions
+    """
+    cur = conn.cursor()
+    cur.execute('DROP DATABASE IF EXISTS `{0}`'.format(database))
+    cur.execute('CREATE DATABASE `{0}` DEFAULT CHARACTER SET utf8' .
+                format(database))
+    cur.execute('USE `{0}`'.format(database))
+    for table, columns in tables.items():
+        cur.execute('CREATE TABLE {0} ({1}\n) ENGINE=InnoDB' .
+                    format(table, columns))
+    conn.commit()
+    cur.close()
+
+
+def get_drupal_tables():
+
+    """
+    Assemble the Drupal table definitions, including the field tables.
+
+    Returns an OrderedDict of table names and column definitions.
+
+    Dependencies:
+        globals: DRUPAL_TABLES, DRUPAL_CACHE_TABLES, DRUPAL_FIELDS,
+                 DRUPAL_FIELD_COLUMNS
+        modules: collections
+
+    """
+
+    tables = collections.OrderedDict(DRUPAL_TABLES)
+    for table in DRUPAL_CACHE_TABLES:
+        tables[table] = '''
+cid VARCHAR(255) NOT NULL DEFAULT '',
+data LONGBLOB,
+expire INT NOT NULL DEFAULT 0,
+created INT NOT NULL DEFAULT 0,
+serialized SMALLINT NOT NULL DEFAULT 0,
+PRIMARY KEY (cid)'''
+    field_specs = [('endpoints', 'endpoints', None)]
+    field_specs += [(field[0], field[1], field[2])
+                    for field in DRUPAL_FIELDS]
+    for field_name, kind, sql_type in field_specs:
+        if kind == 'endpoints':
+            value_columns = '''
+endpoints_entity_type VARCHAR(255) NOT NULL DEFAULT '',
+endpoints_entity_id INT UNSIGNED NOT NULL DEFAULT 0,
+endpoints_r_index INT UNSIGNED NOT NULL DEFAULT 0,'''
+            column_prefix = 'endpoints_'
+            value_column = 'endpoints_entity_id'
+            table_name = 'endpoints'
+        else:
+            column_prefix = 'field_{0}_'.format(field_name)
+            table_name = 'field_' + field_name
+            if kind == 'ip':
+                value_columns = (
+                    '\n{0}start {1},\n{0}end {1},' .
+                    format(column_prefix, sql_type)
+                )
+                value_column = column_prefix + 'start'
+            elif kind == 'fc':
+                value_columns = (
+                    '\n{0}value {1},\n{0}revision_id {1},' .
+                    format(column_prefix, sql_type)
+                )
+                value_column = column_prefix + 'value'
+            else:
+                suffix = 'tid' if kind == 'tid' else 'value'
+                value_columns = ('\n{0}{1} {2},' .
+                                 format(column_prefix, suffix, sql_type))
+                value_column = column_prefix + suffix
+        if sql_type == 'LONGTEXT':
+            value_key = ''
+        else:
+            value_key = '\nKEY {0} ({0}),'.format(value_column)
+        for infix, pk in [
+                ('data',
+                 'entity_type, entity_id, deleted, delta, language'),
+                ('revision',
+                 'entity_type, entity_id, revision_id, deleted, delta, '
+                 'language')]:
+            tables['field_{0}_{1}'.format(infix, table_name)] = (
+                DRUPAL_FIELD_COLUMNS + value_columns + value_key +
+                '\nKEY entity_revision (entity_id, revision_id),'
+                '\nPRIMARY KEY ({0})'.format(pk)
+            )
+    return tables
+
+
+class RowBuffer(object):
+
+    """
+    Buffer rows for multi-row INSERTs, per table.
+
+    """
+
+    def __init__(self, conn, batch_size):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.batch_size = batch_size
+        self.tables = collections.OrderedDict()
+        self.row_count = 0
+
+    def add(self, table, columns, row):
+        """
+        Add a row to the buffer for a table, flushing it if it's full.
+        Parameters:
+            table: the table name
+            columns: a sequence of column names (must be the same for
+                     every row in the same table)
+            row: a sequence of values
+        """
+        if table not in self.tables:
+            self.tables[table] = (columns, [])
+        rows = self.tables[table][1]
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush_table(table)
+
+    def flush_table(self, table):
+        """
+        Write the buffered rows for a table.
+        Parameters:
+            table: the table name
+        """
+        columns, rows = self.tables[table]
+        if not rows:
+            return
+        self.cur.executemany(
+            'INSERT INTO {0} ({1}) VALUES ({2})' .
+            format(table, ', '.join(columns),
+                   ', '.join(['%s'] * len(columns))),
+            rows
+        )
+        self.row_count += len(rows)
+        del rows[:]
+
+    def flush(self):
+        """
+        Write all buffered rows and commit.
+        """
+        for table in self.tables:
+            self.flush_table(table)
+        self.conn.commit()
+
+    def close(self):
+        """
+        Flush the buffer and close the cursor.
+        """
+        self.flush()
+        self.cur.close()
+
+
+##################
+# OCS data model
+##################
+
+def inet_aton(ip):
+    """
+    Convert a dotted-quad string to an integer (as MySQL INET_ATON()).
+    """
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def floor_decimal(value, places):
+    """
+    Round a Decimal down to a number of decimal places (as FLOOR()).
+    """
+    scale = decimal.Decimal(10) ** places
+    return ((value * scale).to_integral_value(rounding=decimal.ROUND_FLOOR) /
+            scale)
+
+
+def make_ocs_server(rng, index, num_servers):
+
+    """
+    Generate the OCS inventory for one server.
+
+    Returns a dict with the keys tag, hardware, bios (dicts of column
+    values), and memories, networks, drives, softwares (lists of dicts of
+    column values).
+
+    Parameters:
+        rng: the random.Random object to use
+        index: the index of the server (0-based)
+        num_servers: the total number of servers
+
+    Dependencies:
+        globals: TAG_FORMAT, OCS_OS_CHOICES, OCS_MODEL_CHOICES,
+                 OCS_CPU_CHOICES, OCS_SOFTWARE_CHOICES, OCS_OTHER_SOFTWARE
+
+    """
+
+    osname, osversion, oscomments = rng.choice(OCS_OS_CHOICES)
+    smanufacturer, smodel = rng.choice(OCS_MODEL_CHOICES)
+    server = dict(tag=TAG_FORMAT.format(index))
+    server['hardware'] = dict(
+        PROCESSORT=rng.choice(OCS_CPU_CHOICES),
+        PROCESSORN=rng.choice([1, 2, 4]),
+        # multiples of 256 MB, so the FLOOR()s are exact
+        MEMORY=rng.choice([8, 16, 32, 64]) * 1024 - 256,
+        OSNAME=osname,
+        OSVERSION=osversion,
+        OSCOMMENTS=oscomments,
+        SWAP=rng.choice([2, 4, 8]) * 1024,
+        LASTDATE=time.strftime(
+            '%Y-%m-%d %H:%M:%S',
+            time.gmtime(1420070400 + rng.randint(0, 86400 * 90))
+        ),
+    )
+    server['bios'] = dict(
+        SMANUFACTURER=smanufacturer,
+        SMODEL=smodel,
+        BVERSION=rng.choice(['1.2.6', '2.0.19', 'P71', '3.0a']),
+        BDATE=rng.choice(['', '04/16/2014', '11/07/2013']),
+    )
+    dimm_size = rng.choice([4096, 8192, 16384])
+    server['memories'] = [
+        dict(
+            CAPACITY=str(dimm_size),
+            TYPE=rng.choice(['DDR3', 'DDR4']),
+            NUMSLOTS=slot,
+            SPEED=rng.choice(['1333', '1600', '2133']),
+            SERIALNUMBER=(
+                'SerNum{0}'.format(slot) if rng.random() < 0.2
+                else '{0:08X}'.format(rng.getrandbits(32))
+            ),
+        )
+        for slot in range(rng.choice([2, 4, 8]))
+    ]
+    subnet = '10.{0}.{1}'.format(index // 250 % 250, index % 250)
+    server['networks'] = []
+    for port in range(rng.randint(1, 4)):
+        has_ip = port == 0 or rng.random() < 0.6
+        server['networks'].append(dict(
+            DESCRIPTION='em{0}'.format(port),
+            STATUS='Up' if has_ip else rng.choice(['Up', 'Down']),
+            MACADDR=':'.join(['{0:02x}'.format(rng.getrandbits(8))
+                              for x in range(6)]),
+            IPADDRESS=('{0}.{1}'.format(subnet, 10 + port) if has_ip
+                       else ''),
+            IPGATEWAY='{0}.1'.format(subnet) if port == 0 else '',
+        ))
+    server['drives'] = [
+        dict(LETTER=mount, TYPE='ufs', FILESYSTEM='ufs',
+             TOTAL=rng.choice([20, 50, 200, 1000]) * 1024,
+             VOLUMN='/dev/ada0p{0}'.format(i + 2))
+        for i, mount in enumerate(['/', '/var', '/usr', '/home']
+                                  [:rng.randint(1, 4)])
+    ]
+    if num_servers > 1 and rng.random() < 0.3:
+        source_index = rng.randrange(num_servers - 1)
+        if source_index >= index:
+            source_index += 1
+        server['drives'].append(dict(
+            LETTER='/mnt/shared', TYPE='nfs', FILESYSTEM='nfs',
+            TOTAL=rng.choice([1000, 4000]) * 1024,
+            VOLUMN='{0}:/export/shared'.format(
+                TAG_FORMAT.format(source_index)
+            ),
+        ))
+    server['softwares'] = [
+        dict(NAME=name, VERSION=rng.choice(versions),
+             COMMENTS=rng.choice([None, 'Installed from ports']))
+        for name, versions in rng.sample(OCS_SOFTWARE_CHOICES,
+                                         rng.randint(2, 6))
+    ]
+    server['softwares'] += [
+        dict(NAME=name, VERSION='1.0', COMMENTS=None)
+        for name in rng.sample(OCS_OTHER_SOFTWARE, 3)
+    ]
+    return server
+
+
+def make_stale_server(rng, server):
+    """
+    Generate a superseded (older) OCS inventory for a server.
+    Returns a dict in the format of make_ocs_server().
+    Parameters:
+        rng: the random.Random object to use
+        server: the current inventory, from make_ocs_server()
+    """
+    stale = dict(server)
+    stale['hardware'] = dict(server['hardware'],
+                             MEMORY=server['hardware']['MEMORY'] // 2,
+                             LASTDATE='2014-01-01 00:00:00')
+    stale['memories'] = server['memories'][:1]
+    stale['softwares'] = [dict(NAME='apache22', VERSION='2.2.29',
+                               COMMENTS=None)]
+    return stale
+
+
+def write_ocs_server(buf, server, hardware_id):
+
+    """
+    Add one server's OCS inventory to a row buffer.
+
+    Parameters:
+        buf: the RowBuffer object to use
+        server: the inventory, from make_ocs_server()
+        hardware_id: the hardware ID to use
+
+    """
+
+    hw = server['hardware']
+    buf.add('hardware',
+            ['ID', 'PROCESSORT', 'PROCESSORN', 'MEMORY', 'OSNAME',
+             'OSVERSION', 'OSCOMMENTS', 'SWAP', 'LASTDATE'],
+            [hardware_id, hw['PROCESSORT'], hw['PROCESSORN'], hw['MEMORY'],
+             hw['OSNAME'], hw['OSVERSION'], hw['OSCOMMENTS'], hw['SWAP'],
+             hw['LASTDATE']])
+    buf.add('accountinfo', ['HARDWARE_ID', 'TAG'],
+            [hardware_id, server['tag']])
+    bios = server['bios']
+    buf.add('bios',
+            ['HARDWARE_ID', 'SMANUFACTURER', 'SMODEL', 'BVERSION',
+             'BDATE'],
+            [hardware_id, bios['SMANUFACTURER'], bios['SMODEL'],
+             bios['BVERSION'], bios['BDATE']])
+    for table in ['memories', 'networks', 'drives', 'softwares']:
+        for row in server[table]:
+            columns = sorted(row)
+            buf.add(table, ['HARDWARE_ID'] + columns,
+                    [hardware_id] + [row[c] for c in columns])
+
+
+########################
+# Drupal data model
+########################
+
+def ocs_source_rows(server, hardware_id):
+
+    """
+    Derive the ocs2drupal source query results for one server.
+
+    This mirrors the ocs2drupal source queries, including the SQL
+    expressions and filters.
+
+    Returns an OrderedDict of template names and lists of raw rows.
+
+    Parameters:
+        server: the inventory, from make_ocs_server()
+        hardware_id: the server's (current) hardware ID
+
+    Dependencies:
+        globals: OCS_SOFTWARE_CHOICES
+        functions: inet_aton(), floor_decimal()
+        modules: collections, decimal
+
+    """
+
+    tag = server['tag']
+    hw = server['hardware']
+    bios = server['bios']
+    source = collections.OrderedDict()
+
+    capacity = sum([decimal.Decimal(m['CAPACITY'])
+                    for m in server['memories']])
+    ram = floor_decimal((capacity if capacity else
+                         decimal.Decimal(hw['MEMORY'])) / 1024, 2)
+    swap = floor_decimal(decimal.Decimal(hw['SWAP']) / 1024, 3)
+    source['single-valued direct fields'] = [(
+        tag, hardware_id, bios['SMANUFACTURER'], bios['SMODEL'],
+        bios['BVERSION'], bios['BDATE'], hw['PROCESSORT'],
+        hw['PROCESSORN'], ram, hw['OSNAME'], hw['OSVERSION'],
+        hw['OSCOMMENTS'], swap,
+    )]
+
+    gateways = [inet_aton(n['IPGATEWAY']) for n in server['networks']
+                if n['IPGATEWAY'] and n['IPGATEWAY'] != '0.0.0.0']
+    source['default gateway'] = (
+        [(tag, min(gateways))] if gateways else []
+    )
+
+    source['DIMMs'] = [
+        (tag, str(m['NUMSLOTS']),
+         floor_decimal(decimal.Decimal(m['CAPACITY']) / 1024, 2),
+         m['TYPE'], m['SPEED'], m['SERIALNUMBER'])
+        for m in sorted(server['memories'], key=lambda m: m['NUMSLOTS'])
+    ]
+
+    drives = server['drives']
+    source['volumes'] = [
+        (tag, d['LETTER'], d['TYPE'], d['VOLUMN'], d['FILESYSTEM'],
+         d['TOTAL'] // 1024)
+        for d in drives if d['FILESYSTEM'].lower() not in ['nfs', 'smb']
+    ]
+    source['NFS mounts'] = [
+        (tag, d['LETTER'], d['TYPE'], d['VOLUMN'])
+        for d in drives if d['FILESYSTEM'].lower() == 'nfs'
+    ]
+
+    networks = sorted(server['networks'], key=lambda n: n['DESCRIPTION'])
+    source['ports: main'] = [
+        (tag, n['DESCRIPTION'], n['STATUS'], n['MACADDR'])
+        for n in networks
+    ]
+    with_ips = [n for n in networks
+                if n['IPADDRESS'] and n['IPADDRESS'] != '0.0.0.0']
+    source['ports: IPs'] = [
+        (tag, n['DESCRIPTION'], inet_aton(n['IPADDRESS']))
+        for n in with_ips
+    ]
+    source['IP view'] = [(tag, inet_aton(n['IPADDRESS']))
+                         for n in with_ips]
+
+    names = [name for name, versions in OCS_SOFTWARE_CHOICES]
+    source['software versions'] = [
+        (tag, s['NAME'], s['VERSION'], s['COMMENTS'])
+        for s in sorted(server['softwares'], key=lambda s: s['NAME'])
+        if s['NAME'] in names
+    ]
+    return source
+
+
+def ocs_to_drupal(server, hardware_id):
+
+    """
+    Derive the Drupal data for one server from its OCS inventory.
+
+    This applies the ocs2drupal templates' transform functions to the
+    results of ocs_source_rows().
+
+    Returns an OrderedDict of template names and lists of transformed
+    rows (without the number of key columns).
+
+    Parameters:
+        server: the inventory, from make_ocs_server()
+        hardware_id: the server's (current) hardware ID
+
+    Dependencies:
+        functions: ocs_source_rows()
+        modules: collections, ocs2drupal
+
+    """
+
+    to_dest_funcs = dict([(t['name'], t.get('to_dest_func'))
+                          for t in ocs2drupal.templates])
+    drupal = collections.OrderedDict()
+    for t_name, rows in ocs_source_rows(server, hardware_id).items():
+        func = to_dest_funcs[t_name]
+        drupal[t_name] = [func(None, row)[1] if func else row
+                          for row in rows]
+    return drupal
+
+
+def apply_drift(rng, drupal, change, missing, extra):
+
+    """
+    Make the Drupal data for one server differ from the OCS data.
+
+    Parameters:
+        rng: the random.Random object to use
+        drupal: the Drupal data, from ocs_to_drupal(); modified in place
+        change: if true, change some values (diff: 'changed')
+        missing: if true, remove some values (diff: 'source only')
+        extra: if true, add some values (diff: 'dest only')
+
+    """
+
+    if change:
+        single = list(drupal['single-valued direct fields'][0])
+        single[8] = (single[8] or '') + ' (old)'  # os_version
+        drupal['single-valued direct fields'][0] = tuple(single)
+        if drupal['DIMMs']:
+            dimm = list(drupal['DIMMs'][0])
+            dimm[3] = dimm[3] / 2  # dimm_size
+            drupal['DIMMs'][0] = tuple(dimm)
+        software = drupal['software versions']
+        if software:
+            i = rng.randrange(len(software))
+            software[i] = software[i][0:3] + ('0.9',) + software[i][4:]
+    if missing:
+        single = list(drupal['single-valued direct fields'][0])
+        single[9] = None  # kernel_string
+        drupal['single-valued direct fields'][0] = tuple(single)
+        for t_name in ['software versions', 'IP view', 'volumes']:
+            if drupal[t_name]:
+                drupal[t_name].pop()
+    if extra:
+        tag = drupal['single-valued direct fields'][0][0]
+        drupal['software versions'].append(
+            (tag, tag + '-apache22', 'apache22', '2.2.29', None)
+        )
+        drupal['IP view'].append((tag, inet_aton('192.0.2.1')))
+
+
+class DrupalWriter(object):
+
+    """
+    Write Drupal nodes, fields, field collections and relations through
+    a RowBuffer, assigning IDs as it goes.
+
+    """
+
+    def __init__(self, buf, timestamp):
+        self.buf = buf
+        self.timestamp = timestamp
+        self.fields = dict([(f[0], f) for f in DRUPAL_FIELDS])
+        self.next_item_id = 1
+        self.next_rid = 1
+        self.next_tid = 1
+        self.vocab_ids = {}
+        self.terms = {}
+
+    def write_metadata(self):
+        """
+        Write the field configuration, vocabularies and variables.
+        """
+        for field_id, field in enumerate(DRUPAL_FIELDS, 1):
+            field_name, kind, sql_type, entity_type, bundle, card = field
+            field_type = dict(value='text', tid='taxonomy_term_reference',
+                              ip='iprange', fc='field_collection')[kind]
+            self.buf.add('field_config',
+                         ['id', 'field_name', 'type', 'cardinality',
+                          'deleted', 'data'],
+                         [field_id, 'field_' + field_name, field_type,
+                          card, 0, 'a:0:{}'])
+            self.buf.add('field_config_instance',
+                         ['field_id', 'field_name', 'entity_type',
+                          'bundle', 'data', 'deleted'],
+                         [field_id, 'field_' + field_name, entity_type,
+                          bundle, 'a:0:{}', 0])
+        for vid, vocab in enumerate(DRUPAL_VOCABULARIES, 1):
+            self.vocab_ids[vocab] = vid
+            self.buf.add('taxonomy_vocabulary',
+                         ['vid', 'name', 'machine_name'],
+                         [vid, vocab, vocab])
+        self.buf.add('variable', ['name', 'value'],
+                     ['site_readonly', 'i:0;'])
+
+    def term_id(self, vocab, name):
+        """
+        Get the ID of a term, creating it if necessary.
+        """
+        if (vocab, name) not in self.terms:
+            self.terms[(vocab, name)] = self.next_tid
+            self.buf.add('taxonomy_term_data', ['tid', 'vid', 'name'],
+                         [self.next_tid, self.vocab_ids[vocab], name])
+            self.next_tid += 1
+        return self.terms[(vocab, name)]
+
+    def node(self, nid, title):
+        """
+        Write a 'server' node (with its revision); the vid is the nid.
+        """
+        self.buf.add('node',
+                     ['nid', 'vid', 'type', 'language', 'title', 'uid',
+                      'created', 'changed'],
+                     [nid, nid, 'server', 'und', title, 1, self.timestamp,
+                      self.timestamp])
+        self.buf.add('node_revision',
+                     ['nid', 'vid', 'uid', 'title', 'log', 'timestamp'],
+                     [nid, nid, 1, title, '', self.timestamp])
+
+    def field(self, entity_type, entity_id, revision_id, field_name,
+              values):
+
+        """
+        Write the values of a field for an entity.
+
+        Parameters:
+            entity_type, entity_id, revision_id: the entity to attach to
+            field_name: the field name (without 'field_')
+            values: a list of values, one per delta; None is skipped
+                    (for field collections, (item_id, revision_id)
+                    tuples; for term references, term names)
+
+        """
+
+        field_name, kind, sql_type, f_entity_type, bundle, card = (
+            self.fields[field_name]
+        )
+        prefix = 'field_{0}_'.format(field_name)
+        if kind == 'ip':
+            value_columns = [prefix + 'start', prefix + 'end']
+        elif kind == 'fc':
+            value_columns = [prefix + 'value', prefix + 'revision_id']
+        elif kind == 'tid':
+            value_columns = [prefix + 'tid']
+        else:
+            value_columns = [prefix + 'value']
+        columns = ['entity_type', 'bundle', 'deleted', 'entity_id',
+                   'revision_id', 'language', 'delta'] + value_columns
+        values = [v for v in values if v is not None]
+        for delta, value in enumerate(values):
+            if kind == 'ip':
+                value = [value, value]
+            elif kind == 'fc':
+                value = list(value)
+            elif kind == 'tid':
+                value = [self.term_id(field_name, value)]
+            else:
+                value = [value]
+            row = [entity_type, bundle, 0, entity_id, revision_id, 'und',
+                   delta] + value
+            for infix in ['data', 'revision']:
+                self.buf.add('field_{0}_field_{1}'.format(infix,
+                                                          field_name),
+                             columns, row)
+
+    def fc(self, fc_name, label):
+        """
+        Write a field collection item (with its revision).
+        Returns (item_id, revision_id); the revision ID is the item ID.
+        """
+        item_id = self.next_item_id
+        self.next_item_id += 1
+        self.buf.add('field_collection_item',
+                     ['item_id', 'revision_id', 'field_name', 'archived',
+                      'label'],
+                     [item_id, item_id, 'field_' + fc_name, 0, label])
+        self.buf.add('field_collection_item_revision',
+                     ['revision_id', 'item_id'], [item_id, item_id])
+        return (item_id, item_id)
+
+    def relation(self, relation_type, nid1, nid2):
+        """
+        Write a relation between two nodes (with its revision).
+        Returns (rid, vid); the vid is the rid.
+        """
+        rid = self.next_rid
+        self.next_rid += 1
+        self.buf.add('relation',
+                     ['rid', 'relation_type', 'vid', 'uid', 'created',
+                      'changed', 'arity'],
+                     [rid, relation_type, rid, 1, self.timestamp,
+                      self.timestamp, 2])
+        self.buf.add('relation_revision',
+                     ['rid', 'vid', 'relation_type', 'uid', 'changed',
+                      'arity'],
+                     [rid, rid, relation_type, 1, self.timestamp, 2])
+        for r_index, nid in enumerate([nid1, nid2]):
+            for infix in ['data', 'revision']:
+                self.buf.add(
+                    'field_{0}_endpoints'.format(infix),
+                    ['entity_type', 'bundle', 'deleted', 'entity_id',
+                     'revision_id', 'language', 'delta',
+                     'endpoints_entity_type', 'endpoints_entity_id',
+                     'endpoints_r_index'],
+                    ['relation', relation_type, 0, rid, rid, 'und',
+                     r_index, 'node', nid, r_index]
+                )
+        return (rid, rid)
+
+
+def write_drupal_server(writer, nid, drupal, nids):
+
+    """
+    Write one server's Drupal data (other than the node itself).
+
+    Parameters:
+        writer: the DrupalWriter object to use
+        nid: the server's node ID (also its revision ID)
+        drupal: the Drupal data, from ocs_to_drupal()
+        nids: a dict of node titles and IDs, for relation endpoints
+
+    """
+
+    single = drupal['single-valued direct fields'][0]
+    for i, field_name in enumerate([
+            'ocs_hardware_id', 'manufacturer', 'model_number',
+            'firmware_version', 'cpu', 'ram', 'os', 'os_version',
+            'kernel_string', 'swap_space'], 1):
+        writer.field('node', nid, nid, field_name, [single[i]])
+    writer.field('node', nid, nid, 'gateway',
+                 [row[1] for row in drupal['default gateway']])
+    writer.field('node', nid, nid, 'ip_view',
+                 [row[1] for row in drupal['IP view']])
+
+    # field collections: (template, fc, subfields)
+    ips = collections.defaultdict(list)
+    for row in drupal['ports: IPs']:
+        ips[row[1]].append(row[2])
+    for t_name, fc_name, subfields in [
+            ('DIMMs', 'dimms', ['slot_name', 'dimm_size', 'dimm_type',
+                                'dimm_speed', 'serial_number']),
+            ('volumes', 'volumes', ['mount_point', 'device_name',
+                                    'filesystem', 'volume_size']),
+            ('ports: main', 'ports', ['port_name_number', 'status',
+                                      'mac_address']),
+            ('software versions', 'software_versions',
+             ['software_name', 'software_version', 'comments'])]:
+        items = []
+        for row in drupal[t_name]:
+            item = writer.fc(fc_name, row[1])
+            items.append(item)
+            for i, field_name in enumerate(subfields, 2):
+                writer.field('field_collection_item', item[0], item[1],
+                             field_name, [row[i]])
+            if fc_name == 'ports':
+                writer.field('field_collection_item', item[0], item[1],
+                             'ip', ips[row[1]])
+        writer.field('node', nid, nid, fc_name, items)
+
+    for row in drupal['NFS mounts']:
+        if row[2] not in nids:
+            continue
+        rid, vid = writer.relation('nfs_mounts', nid, nids[row[2]])
+        writer.field('relation', rid, vid, 'source_path', [row[1]])
+        writer.field('relation', rid, vid, 'destination_path', [row[3]])
+
+
+def generate(host, port, user, password, ocs_db, drupal_db, num_servers,
+             change_rate, missing_rate, extra_rate, stale_rate, seed,
+             batch_size, verbose=False):
+
+    """
+    Build the OCS and Drupal benchmark databases.
+
+    Returns an OrderedDict of statistics: servers, stale, changed, missing,
+    extra, ocs_rows, drupal_rows, seconds.
+
+    Parameters:
+        host, port, user, password: MySQL connection details
+        ocs_db, drupal_db: the database names (dropped and recreated)
+        num_servers: the number of servers
+        change_rate, missing_rate, extra_rate, stale_rate: see the
+                                                            module
+                                                            docstring
+        seed: the random seed
+        batch_size: rows per multi-row INSERT
+        verbose: print progress to stderr?
+
+    Dependencies:
+        globals: OCS_TABLES
+        functions: connect(), recreate_database(), get_drupal_tables(),
+                   make_ocs_server(), make_stale_server(),
+                   write_ocs_server(), ocs_to_drupal(), apply_drift(),
+                   write_drupal_server()
+        classes: RowBuffer, DrupalWriter
+        modules: sys, collections, random, time
+
+    """
+
+    start = time.time()
+    rng = random.Random(seed)
+    ocs_conn = connect(host, port, user, password)
+    recreate_database(ocs_conn, ocs_db, OCS_TABLES)
+    drupal_conn = connect(host, port, user, password)
+    recreate_database(drupal_conn, drupal_db, get_drupal_tables())
+    for conn in [ocs_conn, drupal_conn]:
+        cur = conn.cursor()
+        cur.execute('SET unique_checks = 0, foreign_key_checks = 0')
+        cur.close()
+    ocs_buf = RowBuffer(ocs_conn, batch_size)
+    drupal_buf = RowBuffer(drupal_conn, batch_size)
+    writer = DrupalWriter(drupal_buf, int(start))
+    writer.write_metadata()
+
+    # superseded hardware rows get the lowest IDs, as they would in OCS
+    stale_indexes = set([i for i in range(num_servers)
+                         if rng.random() < stale_rate])
+    next_hardware_id = len(stale_indexes) + 1
+    stale_hardware_id = 1
+    nids = dict([(TAG_FORMAT.format(i), i + 1)
+                 for i in range(num_servers)])
+    stats = collections.OrderedDict([
+        ('servers', num_servers), ('stale', len(stale_indexes)),
+        ('changed', 0), ('missing', 0), ('extra', 0),
+    ])
+    for i in range(num_servers):
+        writer.node(i + 1, TAG_FORMAT.format(i))
+    for i in range(num_servers):
+        server = make_ocs_server(rng, i, num_servers)
+        if i in stale_indexes:
+            write_ocs_server(ocs_buf, make_stale_server(rng, server),
+                             stale_hardware_id)
+            stale_hardware_id += 1
+        write_ocs_server(ocs_buf, server, next_hardware_id)
+        drupal = ocs_to_drupal(server, next_hardware_id)
+        next_hardware_id += 1
+        drift = [rng.random() < rate
+                 for rate in [change_rate, missing_rate, extra_rate]]
+        apply_drift(rng, drupal, *drift)
+        for key, drifted in zip(['changed', 'missing', 'extra'], drift):
+            stats[key] += int(drifted)
+        write_drupal_server(writer, i + 1, drupal, nids)
+        if verbose and (i + 1) % 10000 == 0:
+            print('{0} of {1} servers written'.format(i + 1, num_servers),
+                  file=sys.stderr)
+    ocs_buf.close()
+    drupal_buf.close()
+    ocs_conn.close()
+    drupal_conn.close()
+    stats['ocs_rows'] = ocs_buf.row_count
+    stats['drupal_rows'] = drupal_buf.row_count
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+def add_db_arguments(parser):
+    """
+    Add the MySQL connection / database arguments to an ArgumentParser.
+    """
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--ocs-db', default=DEFAULT_OCS_DB,
+                        help='OCS database name (dropped and recreated)')
+    parser.add_argument('--drupal-db', default=DEFAULT_DRUPAL_DB,
+                        help='Drupal database name (dropped and '
+                             'recreated)')
+
+
+def add_drift_arguments(parser):
+    """
+    Add the dataset shape arguments to an ArgumentParser.
+    """
+    parser.add_argument('--change-rate', type=float,
+                        default=DEFAULT_CHANGE_RATE,
+                        help='fraction of servers with changed values')
+    parser.add_argument('--missing-rate', type=float,
+                        default=DEFAULT_MISSING_RATE,
+                        help='fraction of servers with values missing '
+                             'from Drupal')
+    parser.add_argument('--extra-rate', type=float,
+                        default=DEFAULT_EXTRA_RATE,
+                        help='fraction of servers with extra values in '
+                             'Drupal')
+    parser.add_argument('--stale-rate', type=float,
+                        default=DEFAULT_STALE_RATE,
+                        help='fraction of servers with a superseded OCS '
+                             'hardware row')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--batch-size', type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help='rows per multi-row INSERT')
+
+
+########################################################################
+#                           RUN STANDALONE
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build synthetic OCS and Drupal databases for the '
+                    'raingutter benchmarks.'
+    )
+    add_db_arguments(parser)
+    parser.add_argument('--servers', type=int, default=DEFAULT_SERVERS)
+    add_drift_arguments(parser)
+    args = parser.parse_args()
+    stats = generate(args.host, args.port, args.user, args.password,
+                     args.ocs_db, args.drupal_db, args.servers,
+                     args.change_rate, args.missing_rate, args.extra_rate,
+                     args.stale_rate, args.seed, args.batch_size,
+                     verbose=True)
+    for key, value in stats.items():
+        print('{0}: {1}'.format(key, value))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+
+"""
+This is the end-to-end benchmark for the raingutter ocs2drupal templates.
+
+For each dataset size, it builds the synthetic databases (see dataset.py),
+then runs ocs2drupal in a subprocess for each action (normally 'diff',
+then 'sync'), and reports:
+    rows/s: source rows read per second of wall-clock time
+    queries/row: database statements per source row
+    peak RSS: the subprocess's maximum resident set size
+
+The per-template numbers come from the metrics file (see the metrics_file
+and query_stats config settings).  The dataset is rebuilt before any
+action that follows a sync, so every run starts from the same drift.
+
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import os
+import argparse
+import collections
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+###############
+# this package
+###############
+
+from . import dataset
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_ACTIONS = 'diff,sync'
+
+# how to run ocs2drupal; the config file imports the templates from the
+# running module
+RAINGUTTER_COMMAND = [
+    sys.executable, '-c',
+    'import sys; from raingutter import ocs2drupal; '
+    'sys.argv[0] = "ocs2drupal"; ocs2drupal.main()',
+    'run',
+]
+
+CONFIG_TEMPLATE = '''
+import sys
+templates = sys.modules['raingutter.ocs2drupal'].templates
+
+sourcedb_host = {host!r}
+sourcedb_port = {port!r}
+sourcedb_user = {user!r}
+sourcedb_password = {password!r}
+sourcedb_database = {ocs_db!r}
+
+destdb_host = {host!r}
+destdb_port = {port!r}
+destdb_user = {user!r}
+destdb_password = {password!r}
+destdb_database = {drupal_db!r}
+
+action = {action!r}
+metrics_file = {metrics_file!r}
+query_stats = True
+'''
+
+REPORT_FORMAT = (
+    '{servers:>8} {action:<6} {seconds:>10.3f} {rows:>10} '
+    '{rows_per_sec:>10.1f} {queries:>10} {queries_per_row:>8.2f} '
+    '{peak_rss_mib:>9.1f}'
+)
+REPORT_HEADER = (
+    '{0:>8} {1:<6} {2:>10} {3:>10} {4:>10} {5:>10} {6:>8} {7:>9}' .
+    format('servers', 'action', 'seconds', 'rows', 'rows/s', 'queries',
+           'q/row', 'RSS MiB')
+)
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+def run_raingutter(config_path, log_path):
+
+    """
+    Run ocs2drupal in a subprocess.
+
+    Returns a tuple: (exit value, wall-clock seconds, peak RSS in MiB).
+
+    Parameters:
+        config_path: the config file to use
+        log_path: where to send the subprocess's output
+
+    Dependencies:
+        globals: RAINGUTTER_COMMAND
+        modules: sys, os, subprocess, time
+
+    """
+
+    start = time.time()
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(RAINGUTTER_COMMAND + [config_path],
+                                stdout=log, stderr=subprocess.STDOUT)
+        # wait4() gives the resource usage of this child alone
+        status, rusage = os.wait4(proc.pid, 0)[1:]
+    seconds = time.time() - start
+    # ru_maxrss is in bytes on OS X, KiB elsewhere
+    peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin'
+                                   else 1024)
+    exit_value = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                  else -os.WTERMSIG(status))
+    return (exit_value, seconds, peak_rss)
+
+
+def summarize_metrics(metrics):
+
+    """
+    Summarize a metrics file.
+
+    Returns a tuple: (source rows, statements, per-template list), where
+    the per-template list contains OrderedDicts with the elements name,
+    seconds, rows, and statements.
+
+    Parameters:
+        metrics: the parsed metrics file (see get_run_metrics() in
+                 core.py)
+
+    Dependencies:
+        modules: collections
+
+    """
+
+    statements = collections.defaultdict(int)
+    for q in metrics.get('queries', []):
+        statements[q['template_index']] += q['statements']
+    templates = []
+    total_rows = 0
+    for t_metrics in metrics['templates']:
+        phases = t_metrics['phases']
+        rows = phases.get('source read', {}).get('rows') or 0
+        total_rows += rows
+        templates.append(collections.OrderedDict([
+            ('name', t_metrics['name']),
+            ('seconds', round(sum([p['seconds']
+                                   for p in phases.values()]), 6)),
+            ('rows', rows),
+            ('statements', statements[t_metrics['index']]),
+        ]))
+    return (total_rows, sum(statements.values()), templates)
+
+
+def run_benchmark(args, work_dir):
+
+    """
+    Run the benchmark for every size and action.
+
+    Returns a list of OrderedDicts, one per run, with the elements
+    servers, action, exit_value, seconds, rows, rows_per_sec, queries,
+    queries_per_row, peak_rss_mib, dataset, and templates.
+
+    Parameters:
+        args: the parsed command-line arguments
+        work_dir: a directory for the config, metrics and log files
+
+    Dependencies:
+        globals: CONFIG_TEMPLATE, REPORT_FORMAT, REPORT_HEADER
+        functions: run_raingutter(), summarize_metrics(),
+                   dataset.generate()
+        modules: sys, os, collections, json
+
+    """
+
+    sizes = [int(x) for x in args.servers.split(',')]
+    actions = args.actions.split(',')
+    results = []
+    print(REPORT_HEADER)
+    for num_servers in sizes:
+        ds_stats = None
+        for action in actions:
+            if ds_stats is None or results[-1]['action'] == 'sync':
+                print('(building dataset: {0} servers)' .
+                      format(num_servers), file=sys.stderr)
+                ds_stats = dataset.generate(
+                    args.host, args.port, args.user, args.password,
+                    args.ocs_db, args.drupal_db, num_servers,
+                    args.change_rate, args.missing_rate, args.extra_rate,
+                    args.stale_rate, args.seed, args.batch_size
+                )
+            base = os.path.join(work_dir,
+                                '{0}-{1}'.format(num_servers, action))
+            metrics_path = base + '.metrics.json'
+            with open(base + '.conf', 'w') as f:
+                f.write(CONFIG_TEMPLATE.format(
+                    host=args.host, port=args.port, user=args.user,
+                    password=args.password, ocs_db=args.ocs_db,
+                    drupal_db=args.drupal_db, action=action,
+                    metrics_file=metrics_path,
+                ))
+            exit_value, seconds, peak_rss = run_raingutter(base + '.conf',
+                                                           base + '.log')
+            try:
+                with open(metrics_path) as f:
+                    metrics = json.load(f)
+            except (IOError, OSError, ValueError):
+                print('Warning: no metrics from the {0} run with {1} '
+                      'servers (exit value {2}); see {3}' .
+                      format(action, num_servers, exit_value,
+                             base + '.log'), file=sys.stderr)
+                metrics = dict(templates=[])
+            rows, queries, templates = summarize_metrics(metrics)
+            result = collections.OrderedDict([
+                ('servers', num_servers),
+                ('action', action),
+                ('exit_value', exit_value),
+                ('seconds', round(seconds, 3)),
+                ('rows', rows),
+                ('rows_per_sec', round(rows / seconds, 1)),
+                ('queries', queries),
+                ('queries_per_row',
+                 round(queries / rows, 3) if rows else 0.0),
+                ('peak_rss_mib', round(peak_rss, 1)),
+                ('dataset', ds_stats),
+                ('templates', templates),
+            ])
+            results.append(result)
+            print(REPORT_FORMAT.format(**result))
+            sys.stdout.flush()
+    return results
+
+
+########################################################################
+#                           RUN STANDALONE
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the ocs2drupal templates end to end against '
+                    'synthetic databases.'
+    )
+    dataset.add_db_arguments(parser)
+    parser.add_argument('--servers', default=DEFAULT_SIZES,
+                        help='comma-separated dataset sizes')
+    parser.add_argument('--actions', default=DEFAULT_ACTIONS,
+                        help="comma-separated actions ('diff', 'sync', "
+                             "'count', ...)")
+    dataset.add_drift_arguments(parser)
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the full results to this file')
+    parser.add_argument('--work-dir', metavar='DIR',
+                        help='keep the config, metrics and log files here '
+                             '(default: a temporary directory, removed '
+                             'afterwards)')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='raingutter-bench-')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        results = run_benchmark(args, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
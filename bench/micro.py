@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+
+
+"""
+These are the micro-benchmarks for the raingutter database diff/sync
+tool's pure-Python hot paths.
+
+Each benchmark runs against in-memory fixtures of a configurable size
+(no databases are needed), using copies of the ocs2drupal templates:
+    do_diff_sync:single: one call over a single-valued template's rows
+    do_diff_sync:multiple: one call per key group (multiple-valued)
+    group_rows_by_keys: the multiple-valued grouping in
+                        process_template()
+    key_filter: with global and per-template key lists
+    check_key_list_match: against a key list
+    key_value_copy: for pairs of matching rows
+    drupal_db_query:read: the Cartesian re-collation of the per-field
+                          reads (drupal_db_read() is replaced with the
+                          fixture)
+    render_diff_report: for the diffs from do_diff_sync:single
+    ocs2drupal.<function>: the template transform functions
+
+The results are printed one line per benchmark, in a fixed order and
+format (see REPORT_HEADER); with --json, they're also written to a file,
+which can be given to a later run with --baseline for comparison.
+
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import argparse
+import collections
+import copy
+import gc
+import json
+import logging
+import platform
+import random
+import timeit
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from raingutter import core
+from raingutter import ocs2drupal
+from . import dataset
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+# bump this if the output changes incompatibly
+FORMAT_VERSION = 1
+
+DEFAULT_SIZE = 1000
+DEFAULT_DRIFT = 0.1
+DEFAULT_KEY_LIST_SIZE = 100
+DEFAULT_REPEAT = 5
+DEFAULT_SEED = 1
+
+REPORT_HEADER = '{0:<40} {1:>8} {2:>12} {3:>12} {4:>10}'.format(
+    'benchmark', 'items', 'best (s)', 'median (s)', 'us/item'
+)
+REPORT_FORMAT = (
+    '{name:<40} {items:>8} {best:>12.6f} {median:>12.6f} '
+    '{us_per_item:>10.3f}'
+)
+
+# the registered benchmarks, in order: name -> setup function
+benchmarks = collections.OrderedDict()
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+#########
+# set-up
+#########
+
+def benchmark(name):
+    """
+    Register a benchmark set-up function (decorator).
+    The function is called with a Fixtures object, and must return a
+    tuple of (function to time, number of items, function to call
+    before each timed run or None).
+    """
+    def register(func):
+        benchmarks[name] = func
+        return func
+    return register
+
+
+def setup_config():
+
+    """
+    Set up the config settings and loggers for calling core functions
+    outside of a run.
+
+    The settings get their defaults, the templates are copies of the
+    ocs2drupal templates, and the destination is a Drupal database; the
+    status and email loggers are silenced.
+
+    Dependencies:
+        functions: core.apply_config_defaults()
+        modules: copy, logging, nori, core, ocs2drupal
+
+    """
+
+    for name, setting in nori.core.config_settings.items():
+        if 'default' in setting:
+            nori.core.cfg[name] = copy.deepcopy(setting['default'])
+    nori.core.cfg['templates'] = copy.deepcopy(ocs2drupal.templates)
+    nori.core.cfg['source_type'] = 'generic'
+    nori.core.cfg['dest_type'] = 'drupal'
+    nori.core.cfg['action'] = 'diff'
+    core.apply_config_defaults()
+    null_logger = logging.getLogger('raingutter.bench.micro')
+    null_logger.addHandler(logging.NullHandler())
+    null_logger.propagate = False
+    nori.core.status_logger = null_logger
+    nori.core.email_logger = null_logger
+
+
+def get_t_index(t_name):
+    """
+    Get the index of a template by name.
+    """
+    for t_index, template in enumerate(nori.core.cfg['templates']):
+        if template[core.T_NAME_KEY] == t_name:
+            return t_index
+
+
+class Fixtures(object):
+
+    """
+    In-memory fixtures for the benchmarks, built from the synthetic
+    dataset (see dataset.py).
+
+    """
+
+    def __init__(self, size, drift, key_list_size, seed):
+
+        """
+        Parameters:
+            size: the (approximate) number of rows per template
+            drift: the fraction of destination rows that differ from
+                   the source rows
+            key_list_size: the number of entries in the key lists
+            seed: the random seed
+        Dependencies:
+            functions: dataset.make_ocs_server(),
+                       dataset.ocs_source_rows()
+            modules: collections, random, ocs2drupal
+        """
+
+        self.size = size
+        self.drift = drift
+        self.key_list_size = key_list_size
+        self.rng = random.Random(seed)
+
+        # raw source rows, per template, until each has enough
+        self.raw = collections.defaultdict(list)
+        index = 0
+        while (index < size and
+               min([len(self.raw[t['name']])
+                    for t in ocs2drupal.templates]) < size):
+            server = dataset.make_ocs_server(self.rng, index, size)
+            for t_name, rows in dataset.ocs_source_rows(
+                    server, index + 1).items():
+                self.raw[t_name] += rows
+            index += 1
+        for t_name in self.raw:
+            del self.raw[t_name][size:]
+
+        # transformed rows, as process_template() passes them on
+        self.rows = {}
+        for template in nori.core.cfg['templates']:
+            func = template[core.T_TO_D_FUNC_KEY]
+            num_keys = len(template[core.T_D_QUERY_ARGS_KEY][1]['key_cv'])
+            self.rows[template[core.T_NAME_KEY]] = [
+                func(template, row) if func else (num_keys, row)
+                for row in self.raw[template[core.T_NAME_KEY]]
+            ]
+
+    def drifted(self, rows):
+
+        """
+        Make a drifted copy of a list of rows, as if from the
+        destination database.
+
+        For each drifted row, a value is changed, the row is removed, or
+        an extra row is added after it.
+
+        Returns the new list.
+
+        Parameters:
+            rows: a list of (number of keys, row tuple) tuples
+
+        """
+
+        d_rows = []
+        for num_keys, row in rows:
+            if self.rng.random() >= self.drift:
+                d_rows.append((num_keys, row))
+                continue
+            how = self.rng.randrange(3)
+            if how == 0:
+                d_rows.append((num_keys,
+                               row[:-1] + ('drifted {0}'.format(row[-1]),)))
+            elif how == 2:
+                d_rows.append((num_keys, row))
+                d_rows.append((num_keys, row[:-1] + ('extra',)))
+        return d_rows
+
+    def key_list(self, rows):
+        """
+        Make a key list with (up to) key_list_size entries, from every
+        other key in some rows; the rest of the keys won't match.
+        """
+        keys = list(collections.OrderedDict.fromkeys(
+            [row[1][0] for row in rows]
+        ))
+        return keys[::2][:self.key_list_size]
+
+
+#############
+# benchmarks
+#############
+
+@benchmark('do_diff_sync:single')
+def bench_do_diff_sync_single(fx):
+    t_index = get_t_index('DIMMs')
+    s_rows = fx.rows['DIMMs']
+    d_rows = fx.drifted(s_rows)
+    def before():
+        core.diff_store = core.DiffStore()
+    def run():
+        core.do_diff_sync(t_index, s_rows, d_rows, None, None)
+    return (run, len(s_rows), before)
+
+
+@benchmark('do_diff_sync:multiple')
+def bench_do_diff_sync_multiple(fx):
+    t_index = get_t_index('IP view')
+    s_rows = fx.rows['IP view']
+    s_groups = core.group_rows_by_keys(s_rows)
+    d_groups = core.group_rows_by_keys(fx.drifted(s_rows))
+    def before():
+        core.diff_store = core.DiffStore()
+    def run():
+        for keys in s_groups:
+            core.do_diff_sync(t_index, s_groups[keys],
+                              d_groups.get(keys, []), None, None)
+    return (run, len(s_rows), before)
+
+
+@benchmark('group_rows_by_keys')
+def bench_group_rows_by_keys(fx):
+    rows = fx.rows['ports: IPs']
+    def run():
+        core.group_rows_by_keys(rows)
+    return (run, len(rows), None)
+
+
+@benchmark('key_filter')
+def bench_key_filter(fx):
+    t_index = get_t_index('software versions')
+    rows = fx.rows['software versions']
+    def before():
+        nori.core.cfg['key_mode'] = 'exclude'
+        nori.core.cfg['key_list'] = ['no-such-server']
+        nori.core.cfg['templates'][t_index][core.T_KEY_MODE_KEY] = (
+            'include'
+        )
+        nori.core.cfg['templates'][t_index][core.T_KEY_LIST_KEY] = (
+            fx.key_list(rows)
+        )
+    def run():
+        for num_keys, row in rows:
+            core.key_filter(t_index, num_keys, row)
+    return (run, len(rows), before)
+
+
+@benchmark('check_key_list_match')
+def bench_check_key_list_match(fx):
+    rows = fx.rows['software versions']
+    key_list = fx.key_list(rows)
+    def run():
+        for num_keys, row in rows:
+            core.check_key_list_match('include', key_list, num_keys, row)
+    return (run, len(rows), None)
+
+
+@benchmark('key_value_copy')
+def bench_key_value_copy(fx):
+    template = nori.core.cfg['templates'][get_t_index('DIMMs')]
+    key_cv = template[core.T_D_QUERY_ARGS_KEY][1]['key_cv']
+    value_cv = template[core.T_D_QUERY_ARGS_KEY][1]['value_cv']
+    s_rows = fx.rows['DIMMs']
+    pairs = list(zip([row[1] for row in s_rows],
+                     [row[1] for row in fx.drifted(s_rows)]))
+    def run():
+        for s_data, d_data in pairs:
+            core.key_value_copy(s_data, d_data, key_cv, value_cv)
+    return (run, len(pairs), None)
+
+
+@benchmark('drupal_db_query:read')
+def bench_drupal_db_query_read(fx):
+
+    # per-field read results for the ports field collections, with
+    # multiple IPs for some ports (for the Cartesian products)
+    template = nori.core.cfg['templates'][get_t_index('ports: main')]
+    key_cv = template[core.T_D_QUERY_ARGS_KEY][1]['key_cv']
+    value_cv = (template[core.T_D_QUERY_ARGS_KEY][1]['value_cv'] +
+                [(('field', 'ip'), 'ip')])
+    reads = collections.defaultdict(list)
+    for num_keys, row in fx.rows['ports: main']:
+        for i, cv in enumerate(value_cv[:-1]):
+            if row[num_keys + i] is not None:
+                reads[cv[0]].append(row[0:num_keys] + (row[num_keys + i],))
+        for ip in range(fx.rng.choice([0, 1, 1, 2])):
+            reads[value_cv[-1][0]].append(row[0:num_keys] + (ip,))
+    orig_read = core.drupal_db_read
+    def fake_read(db_obj, db_cur, key_cv, value_cv):
+        return reads[value_cv[0][0]]
+    def run():
+        core.drupal_db_read = fake_read
+        try:
+            core.drupal_db_query(None, None, 'read', None, key_cv,
+                                 value_cv)
+        finally:
+            core.drupal_db_read = orig_read
+    return (run, len(fx.rows['ports: main']), None)
+
+
+@benchmark('render_diff_report')
+def bench_render_diff_report(fx):
+    t_index = get_t_index('DIMMs')
+    s_rows = fx.rows['DIMMs']
+    d_rows = fx.drifted(s_rows)
+    def before():
+        core.diff_store = core.DiffStore()
+        core.do_diff_sync(t_index, s_rows, d_rows, None, None)
+    def run():
+        core.render_diff_report()
+    return (run, len(s_rows), before)
+
+
+def register_transform_benchmarks():
+    """
+    Register a benchmark for each ocs2drupal transform function.
+    """
+    def make_setup(t_name, func):
+        def setup(fx):
+            template = nori.core.cfg['templates'][get_t_index(t_name)]
+            rows = fx.raw[t_name]
+            def run():
+                for row in rows:
+                    func(template, row)
+            return (run, len(rows), None)
+        return setup
+    for template in ocs2drupal.templates:
+        func = template.get('to_dest_func')
+        if func is not None:
+            benchmarks['ocs2drupal.' + func.__name__] = make_setup(
+                template['name'], func
+            )
+
+register_transform_benchmarks()
+
+
+##########
+# running
+##########
+
+def time_benchmark(setup, fx, repeat):
+
+    """
+    Time one benchmark.
+
+    Returns an OrderedDict with the elements items, best, median, and
+    us_per_item.
+
+    Parameters:
+        setup: the benchmark's set-up function
+        fx: the Fixtures object to use
+        repeat: the number of timed runs
+
+    Dependencies:
+        modules: collections, gc, timeit
+
+    """
+
+    run, items, before = setup(fx)
+    times = []
+    for i in range(repeat):
+        if before is not None:
+            before()
+        gc.collect()
+        gc.disable()
+        try:
+            start = timeit.default_timer()
+            run()
+            times.append(timeit.default_timer() - start)
+        finally:
+            gc.enable()
+    times.sort()
+    return collections.OrderedDict([
+        ('items', items),
+        ('best', round(times[0], 6)),
+        ('median', round(times[len(times) // 2], 6)),
+        ('us_per_item', round(times[0] * 1e6 / items, 3) if items else 0.0),
+    ])
+
+
+def run_benchmarks(args):
+
+    """
+    Run the selected benchmarks and print the results.
+
+    Returns an OrderedDict with the elements format, python, parameters,
+    and results (an OrderedDict of benchmark names and results from
+    time_benchmark()).
+
+    Parameters:
+        args: the parsed command-line arguments
+
+    Dependencies:
+        globals: benchmarks, FORMAT_VERSION, REPORT_HEADER,
+                 REPORT_FORMAT
+        functions: setup_config(), time_benchmark()
+        classes: Fixtures
+        modules: sys, collections, platform
+
+    """
+
+    setup_config()
+    fx = Fixtures(args.size, args.drift, args.key_list_size, args.seed)
+    parameters = collections.OrderedDict([
+        ('size', args.size), ('drift', args.drift),
+        ('key_list_size', args.key_list_size), ('repeat', args.repeat),
+        ('seed', args.seed),
+    ])
+    output = collections.OrderedDict([
+        ('format', FORMAT_VERSION),
+        ('python', platform.python_version()),
+        ('parameters', parameters),
+        ('results', collections.OrderedDict()),
+    ])
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print('# raingutter micro-benchmarks (format {0})' .
+          format(FORMAT_VERSION))
+    print('# python {0}, {1}'.format(
+        output['python'],
+        ', '.join(['{0}={1}'.format(k, v) for k, v in parameters.items()])
+    ))
+    print(REPORT_HEADER + ('    change' if baseline else ''))
+    for name, setup in benchmarks.items():
+        if args.only and not any([name.startswith(x) for x in args.only]):
+            continue
+        result = time_benchmark(setup, fx, args.repeat)
+        output['results'][name] = result
+        line = REPORT_FORMAT.format(name=name, **result)
+        if baseline and baseline.get(name, {}).get('best'):
+            line += ' {0:>+8.1f}%'.format(
+                (result['best'] / baseline[name]['best'] - 1) * 100
+            )
+        print(line)
+        sys.stdout.flush()
+    return output
+
+
+########################################################################
+#                           RUN STANDALONE
+########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the raingutter micro-benchmarks.'
+    )
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help='rows per fixture')
+    parser.add_argument('--drift', type=float, default=DEFAULT_DRIFT,
+                        help='fraction of destination rows that differ')
+    parser.add_argument('--key-list-size', type=int,
+                        default=DEFAULT_KEY_LIST_SIZE,
+                        help='entries in the key lists')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='timed runs per benchmark')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--only', action='append', metavar='PREFIX',
+                        help='run only the benchmarks starting with this '
+                             '(can be repeated)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to this file')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with the results in this file '
+                             '(from --json)')
+    args = parser.parse_args()
+    output = run_benchmarks(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+
+"""
+This is the checkpoint module for the raingutter database diff and sync
+tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import os
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from .template_keys import *
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# constants
+############
+
+# the format version of checkpoint files; see write_checkpoint()
+CHECKPOINT_VERSION = 2
+
+
+############
+# run state
+############
+
+# The current checkpoint, if checkpointing is enabled; see
+# start_checkpoint().  This is a dict with the elements written to the
+# checkpoint file (see write_checkpoint()).
+checkpoint = None
+
+# the time the checkpoint file was last written
+checkpoint_time = 0
+
+# When resuming an interrupted run: a tuple of (template index, set of
+# completed key tuples, list of changes already made) for the template
+# that was in progress, or None; the changes are in the format used by
+# core.template_changes.  This is cleared when the template is reached.
+resume_point = None
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+##############
+# checkpoints
+##############
+
+def checkpoint_enabled():
+    """
+    Check if checkpoints should be kept (see checkpoint_file).
+    Returns True or False.
+    Dependencies:
+        config settings: action, readonly_window, checkpoint_file
+        modules: nori
+    """
+    return (nori.core.cfg['checkpoint_file'] is not None and
+            nori.core.cfg['action'] == 'sync' and
+            nori.core.cfg['readonly_window'] == 'full')
+
+
+def write_checkpoint(pending_changes, touched_entities):
+
+    """
+    Write the current checkpoint to the checkpoint file.
+
+    The state needed to finish the callbacks for the changes made so
+    far (see checkpoint_file) is updated first.
+
+    The file is replaced atomically, so an interruption while writing
+    leaves the previous checkpoint.  Keys are pickled, since they may
+    not be representable in simpler formats.
+
+    Parameters:
+        pending_changes: the changes made for the current template that
+                         haven't been passed to the batch change
+                         callbacks yet (see core.template_changes)
+        touched_entities: the Drupal entities touched so far (see
+                          core.drupal_touched_entities)
+
+    Dependencies:
+        config settings: checkpoint_file
+        globals: checkpoint, checkpoint_time
+        modules: os, time, pickle, nori
+
+    """
+
+    global checkpoint_time
+
+    checkpoint['pending_changes'] = list(pending_changes)
+    if pending_changes:
+        checkpoint['changes_made'] = True
+    checkpoint['touched_entities'] = list(touched_entities)
+    checkpoint_file = nori.core.cfg['checkpoint_file']
+    temp_file = checkpoint_file + '.tmp'
+    try:
+        with open(temp_file, 'wb') as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_file, checkpoint_file)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        nori.core.email_logger.error(
+            'Warning: could not write checkpoint file {0}:\n{1}' .
+            format(nori.pps(checkpoint_file), e)
+        )
+    checkpoint_time = time.time()
+
+
+def read_checkpoint():
+
+    """
+    Read the checkpoint file, for resuming an interrupted run.
+
+    Returns the checkpoint dict, or None if there is no checkpoint file.
+
+    Dependencies:
+        config settings: checkpoint_file, reverse, templates
+        globals: CHECKPOINT_VERSION, T_NAME_KEY
+        modules: os, sys, pickle, nori
+
+    """
+
+    checkpoint_file = nori.core.cfg['checkpoint_file']
+    if not os.path.exists(checkpoint_file):
+        nori.core.status_logger.info(
+            'No checkpoint file found; starting from the beginning.'
+        )
+        return None
+    try:
+        with open(checkpoint_file, 'rb') as f:
+            ckpt = pickle.load(f)
+    except Exception as e:
+        nori.core.email_logger.error(
+            'Error: could not read checkpoint file {0}:\n{1}\n'
+            'Exiting.'.format(nori.pps(checkpoint_file), e)
+        )
+        sys.exit(nori.core.exitvals['startup']['num'])
+    t_names = [t[T_NAME_KEY] for t in nori.core.cfg['templates']]
+    if (not isinstance(ckpt, dict) or
+          ckpt.get('version') != CHECKPOINT_VERSION or
+          ckpt.get('reverse') != nori.core.cfg['reverse'] or
+          ckpt.get('templates') != t_names):
+        nori.core.email_logger.error(
+            'Error: checkpoint file {0} is from an incompatible run\n'
+            '(different version, reverse setting, or templates); '
+            'exiting.'.format(nori.pps(checkpoint_file))
+        )
+        sys.exit(nori.core.exitvals['startup']['num'])
+    return ckpt
+
+
+def start_checkpoint(touched_entities):
+
+    """
+    Set up checkpointing, if enabled, and the resume point, if any.
+
+    When resuming, the Drupal entities touched by the interrupted run
+    are restored, for cache clearing.
+
+    Parameters:
+        touched_entities: the dict of touched Drupal entities to restore
+                          them to (see core.drupal_touched_entities)
+
+    Dependencies:
+        config settings: resume, reverse, templates
+        globals: checkpoint, resume_point, CHECKPOINT_VERSION, T_NAME_KEY
+        functions: checkpoint_enabled(), read_checkpoint()
+        modules: nori
+
+    """
+
+    global checkpoint, resume_point
+
+    if not checkpoint_enabled():
+        return
+    if nori.core.cfg['resume']:
+        checkpoint = read_checkpoint()
+    if checkpoint is not None:
+        if checkpoint['current'] is not None:
+            resume_point = (checkpoint['current'][0],
+                            checkpoint['current'][1],
+                            checkpoint.get('pending_changes', []))
+        for entity in checkpoint.get('touched_entities', []):
+            touched_entities[entity] = True
+        nori.core.status_logger.info(
+            'Resuming: {0} template(s) already done.' .
+            format(len(checkpoint['done']))
+        )
+        return
+    checkpoint = dict(
+        version=CHECKPOINT_VERSION,
+        reverse=nori.core.cfg['reverse'],
+        templates=[t[T_NAME_KEY] for t in nori.core.cfg['templates']],
+        done=[],
+        current=None,
+        pending_changes=[],
+        changes_made=False,
+        touched_entities=[],
+    )
+
+
+def checkpoint_key(t_index, keys, pending_changes, touched_entities):
+    """
+    Record that all changes for a key have been made for a template.
+    The checkpoint file is only written every checkpoint_interval
+    seconds.
+    Parameters:
+        t_index: the index of the template in the templates setting
+        keys: the key tuple
+        pending_changes, touched_entities: see write_checkpoint()
+    Dependencies:
+        config settings: checkpoint_interval
+        globals: checkpoint, checkpoint_time
+        functions: write_checkpoint()
+        modules: time, nori
+    """
+    if checkpoint is None:
+        return
+    if checkpoint['current'] is None or checkpoint['current'][0] != t_index:
+        checkpoint['current'] = (t_index, set())
+    checkpoint['current'][1].add(keys)
+    if (time.time() - checkpoint_time >=
+          nori.core.cfg['checkpoint_interval']):
+        write_checkpoint(pending_changes, touched_entities)
+
+
+def checkpoint_template(t_index, changed, pending_changes,
+                        touched_entities):
+    """
+    Record that a template has been completed.
+    Parameters:
+        t_index: the index of the template in the templates setting
+        changed: True if the template needs the global change
+                 callbacks
+        pending_changes, touched_entities: see write_checkpoint()
+    Dependencies:
+        globals: checkpoint
+        functions: write_checkpoint()
+    """
+    if checkpoint is None:
+        return
+    if changed:
+        checkpoint['changes_made'] = True
+    checkpoint['done'].append(t_index)
+    checkpoint['current'] = None
+    write_checkpoint(pending_changes, touched_entities)
+
+
+def resumed_changes_made():
+    """
+    Check if an interrupted run that is being resumed made any changes
+    (which still need the global change callbacks).
+    Returns True or False.
+    Dependencies:
+        globals: checkpoint
+    """
+    return bool(checkpoint is not None and checkpoint.get('changes_made'))
+
+
+def finish_checkpoint():
+    """
+    Remove the checkpoint file at the end of a complete run (after the
+    global change callbacks).
+    Dependencies:
+        config settings: checkpoint_file
+        globals: checkpoint
+        modules: os, nori
+    """
+    global checkpoint
+    if checkpoint is None:
+        return
+    checkpoint = None
+    if os.path.exists(nori.core.cfg['checkpoint_file']):
+        os.remove(nori.core.cfg['checkpoint_file'])
+
+
+def skip_done_rows(s_rows, done_keys):
+
+    """
+    Remove the rows already synced in an interrupted run.
+
+    The rows are skipped by key, so rows whose keys were added to the
+    source after the interruption are never skipped, wherever they fall
+    in the template's order.
+
+    Returns a tuple of (remaining rows, set of skipped key tuples); the
+    set only includes the keys that are still in the source, so the
+    destination rows for keys that have been removed since are still
+    handled.
+
+    Parameters:
+        s_rows: the transformed and filtered source rows, in a list of
+                (num_keys, data) tuples
+        done_keys: the set of key tuples recorded in the checkpoint
+
+    Dependencies:
+        modules: nori
+
+    """
+
+    remaining = []
+    skipped_keys = set()
+    for s_row in s_rows:
+        keys = s_row[1][0:s_row[0]]
+        if keys in done_keys:
+            skipped_keys.add(keys)
+        else:
+            remaining.append(s_row)
+    nori.core.status_logger.info(
+        'Resuming after {0} already-synced key(s).'.format(len(skipped_keys))
+    )
+    return (remaining, skipped_keys)
@@ -22,16 +22,39 @@ from __future__ import print_function
 from pprint import pprint as pp  # for debugging
 
 import sys
+import os
 import atexit
+import signal
 import operator
 import collections
 import itertools
-import socket
-import logging
-import logging.handlers
 import copy
 import time
 import re
+import array
+import tempfile
+import json
+import random
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import resource
+except ImportError:  # not Unix
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
 
 
 #########
@@ -46,6 +69,20 @@ except ImportError:
 import nori
 
 
+###############
+# this package
+###############
+
+from .template_keys import *
+from . import metrics
+from . import progress
+from . import profiling
+from . import dbtrace
+from . import pools
+from . import snapshots
+from . import checkpoints
+
+
 ########################################################################
 #                              VARIABLES
 ########################################################################
@@ -57,33 +94,31 @@ import nori
 # the name of this package
 PACKAGE_NAME = 'raingutter'
 
-# template elements (see the 'templates' setting)
-T_NAME_KEY = 'name'
-T_MULTIPLE_KEY = 'multiple_values'
-T_S_QUERY_ARGS_KEY = 'source_query_args'
-T_TO_D_FUNC_KEY = 'to_dest_func'
-T_S_NO_REPL_KEY = 'source_no_replicate'
-T_S_CHANGE_CB_KEY = 'source_change_callbacks'
-T_D_QUERY_ARGS_KEY = 'dest_query_args'
-T_TO_S_FUNC_KEY = 'to_source_func'
-T_D_NO_REPL_KEY = 'dest_no_replicate'
-T_D_CHANGE_CB_KEY = 'dest_change_callbacks'
-T_KEY_MODE_KEY = 'key_mode'
-T_KEY_LIST_KEY = 'key_list'
-T_KEYS = [
-    T_NAME_KEY,
-    T_MULTIPLE_KEY,
-    T_S_QUERY_ARGS_KEY,
-    T_TO_D_FUNC_KEY,
-    T_S_NO_REPL_KEY,
-    T_S_CHANGE_CB_KEY,
-    T_D_QUERY_ARGS_KEY,
-    T_TO_S_FUNC_KEY,
-    T_D_NO_REPL_KEY,
-    T_D_CHANGE_CB_KEY,
-    T_KEY_MODE_KEY,
-    T_KEY_LIST_KEY,
-]
+# the format version of sync plan files; see write_sync_plan()
+SYNC_PLAN_VERSION = 1
+
+# the maximum number of changed keys to restrict an incremental
+# destination read to; with more, the whole table is read and filtered
+# (see process_template())
+INCREMENTAL_MAX_KEYS = 1000
+
+# the maximum number of cache IDs to delete per query; see
+# clear_drupal_cache_targeted()
+DRUPAL_CACHE_CHUNK_SIZE = 500
+
+# the number of rows to fetch at a time in the read phases, so their
+# progress can be counted as they go; see db_fetchall()
+READ_FETCH_SIZE = 1000
+
+# the diff statuses (see diff_status()), as written to the JSON Lines
+# report, and their descriptions in the text diff report (see
+# render_diff_status())
+DIFF_STATUS_DESCRS = {
+    'planned': 'planned',
+    'unchanged': 'unchanged',
+    'partial': 'partially changed - action may be needed!',
+    'changed': 'changed',
+}
 
 
 ##################
@@ -121,7 +156,7 @@ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
 EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
-# exit value
+# exit values
 nori.core.exitvals['drupal'] = dict(
     num=40,
     descr=(
@@ -130,22 +165,73 @@ Problem with a Drupal database.
 '''
     ),
 )
+nori.core.exitvals['sync_plan'] = dict(
+    num=41,
+    descr=(
+'''
+Problem with the sync plan file.
+'''
+    ),
+)
+nori.core.exitvals['db_trace'] = dict(
+    num=42,
+    descr=(
+'''
+Problem with the database trace file, or a query missing from it.
+'''
+    ),
+)
+
+# script modes
+nori.core.script_modes['daemon'] = dict(
+    descr=(
+'''
+'daemon': do diffs/syncs repeatedly (see daemon_interval), keeping the
+database connections open between runs
+'''
+    ),
+    callback=lambda: run_daemon(),
+    req_config=True,
+)
 
 # see the post_action_callbacks setting and run_mode_hook()
 post_action_callbacks = []
 
+# in daemon mode: the pending signal action ('reload' or 'stop'), if any,
+# and the open database connections; see run_daemon()
+daemon_signal = None
+daemon_dbs = None
+
+# Results of Drupal schema and term lookups, which don't change during a
+# run; the keys are tuples of (lookup name, id(db_obj), *arguments).
+# This is cleared between runs in daemon mode, because fields and terms
+# can be added or changed in the meantime.  See
+# clear_drupal_lookup_cache().
+drupal_lookup_cache = {}
+
 # see pre_action_drupal_readonly(), post_action_drupal_readonly()
 s_drupal_readonly = None
 d_drupal_readonly = None
 
-# This ordered dict contains the database diffs.  The format is one of:
-#     * rendered database 'key' strings ->
-#       lists of tuples in the format (template_index, exists_in_source,
-#       source_row, exists_in_dest, dest_row, has_been_changed)
-#     * indexes into the templates config setting ->
-#       lists of tuples in the format (exists_in_source, source_row,
-#       exists_in_dest, dest_row, has_been_changed)
-# depending on the report_order config setting.
+# This is used as an ordered set of the Drupal entities changed by the
+# sync, for cache clearing; the keys are tuples of (entity_type,
+# entity_id), and the values are always True.  An entity_id of None
+# means 'all entities of this type'.  See record_drupal_entity() and
+# clear_drupal_cache_targeted().
+drupal_touched_entities = collections.OrderedDict()
+
+# the in-place Drupal updates whose entities have already been looked
+# up and recorded, so each is only looked up once per run; see
+# record_drupal_updated_entities()
+drupal_updated_keys = set()
+
+# This DiffStore object (see below) contains the database diffs; it is
+# created by run_mode_hook().  The diffs are grouped by one of:
+#     * database 'key' tuples
+#     * indexes into the templates config setting
+# depending on the report_order config setting; each diff is a tuple in
+# the format (template_index, exists_in_source, source_row,
+# exists_in_dest, dest_row, has_been_changed).
 # The exists_in_source / exists in dest elements are augmented booleans:
 #     for single-valued templates, True if the relevant key exists in
 #     the database, otherwise False; for multiple-valued templates,
@@ -155,15 +241,50 @@ d_drupal_readonly = None
 # The has_been_changed element can be True (fully changed), False
 # (partly changed), or None (unchanged).
 # See the diff functions, below.
-diff_dict = collections.OrderedDict()
-
-
-############
-# resources
-############
-
-sourcedb = nori.MySQL('sourcedb')
-destdb = nori.MySQL('destdb')
+diff_store = None
+
+# the open JSON Lines report stream, if any; see open_jsonl_report()
+jsonl_stream = None
+
+# For the 'count' action: for each template index, a dictionary of
+# category names and reservoir samples (lists of at most count_sample_size
+# tuples in the format (exists_in_source, source_row, exists_in_dest,
+# dest_row); see log_diff()).
+diff_samples = {}
+
+# This list contains the database changes found in the 'plan' action (or
+# read from the sync plan file in the 'apply' action).  Each entry is a
+# tuple in the format (template_index, mode, scope, exists_in_source,
+# source_row, exists_in_dest, dest_row, new_key_cv, new_value_cv); see
+# do_sync() and log_diff() for the meanings of the elements.
+sync_plan = []
+
+# This list runs parallel to sync_plan; each entry is a tuple of
+# (diff_k, diff_i) indicating the diff in diff_store that the change
+# belongs to.  It is not saved in the sync plan file.
+sync_plan_diffs = []
+
+# This list contains the changes made for the current template, for the
+# batch change callbacks.  Each entry is a tuple in the format (mode,
+# scope, source_row, dest_row, new_key_cv, new_value_cv); see do_sync()
+# and dispatch_batch_callbacks().
+template_changes = []
+
+# For incremental runs: the high-water marks read from the state file, in
+# the format {'forward'/'reverse': {template_name: timestamp}}, plus the
+# times of the last full runs, in the format {'full_runs':
+# {'forward'/'reverse': {template_name: UNIX_time}}}; see
+# read_incremental_state().
+incremental_state = {}
+
+# For incremental runs: the new high-water marks for templates which have
+# been processed, but whose changes haven't all been made yet; the keys
+# are template indexes, and the values are tuples of (timestamp, start
+# time of the full read or None).
+incremental_pending = {}
+
+# the indexes of templates for which a sync has failed (fully or partly)
+failed_templates = set()
 
 
 #########################
@@ -174,9 +295,137 @@ destdb = nori.MySQL('destdb')
 # available config settings
 #
 
-sourcedb.create_settings(heading='Source Database')
+pools.sourcedb.create_settings(heading='Source Database')
+
+nori.core.config_settings['sourcedb_pool_size'] = dict(
+    descr=(
+'''
+The number of connections to keep open to the source database.
+
+The first connection uses the settings above; any others are opened with the
+same settings.  (If an SSH tunnel is used, the extra connections must be
+able to share it.)
+'''
+    ),
+    default=1,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['sourcedb_replica'] = dict(
+    descr=(
+'''
+Send reads from the source database to a read replica?
+
+If this is true, the template reads from the source database, and lookups
+that don't need to see this run's changes (e.g., Drupal field and term
+lookups), use the replica connection settings below, while changes are made
+through the primary database above.  Once fields (or, for generic
+databases, rows) have been written to in a run, template reads that
+include the same fields go to the primary as well, so they see the
+changes; other template reads keep using the replica.  Lookups done as part
+of a change (e.g., getting the IDs of a newly inserted field collection)
+always use the primary.
+
+The replica connections use the same pool size as the primary
+(sourcedb_pool_size).
+
+Note that replication lag can make the data read out of date.  With the
+incremental setting, changes that hadn't reached the replica would be
+missed for good (the high-water mark would move past them), so the replica
+of the database being read from (the source, after applying the 'reverse'
+setting) isn't used at all in incremental runs.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+pools.sourcedb_replica.create_settings(heading='Source Database Replica',
+                                       extra_requires=['sourcedb_replica'])
+
+pools.destdb.create_settings(heading='Destination Database')
+
+nori.core.config_settings['destdb_pool_size'] = dict(
+    descr=(
+'''
+The number of connections to keep open to the destination database.
+
+See sourcedb_pool_size.
+'''
+    ),
+    default=1,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['destdb_replica'] = dict(
+    descr=(
+'''
+Send reads from the destination database to a read replica?
+
+See sourcedb_replica.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+pools.destdb_replica.create_settings(
+    heading='Destination Database Replica', extra_requires=['destdb_replica']
+)
+
+nori.core.config_settings['db_trace_heading'] = dict(
+    heading='Database Tracing',
+)
+
+nori.core.config_settings['db_trace_mode'] = dict(
+    descr=(
+'''
+Record or replay the database traffic?
+
+Must be one of:
+    None: use the databases normally
+    'record': use the databases normally, but also record every call to the
+              database objects (queries, results, and timings) in
+              db_trace_file
+    'replay': don't connect to the databases at all; instead, serve the
+              results recorded in db_trace_file (the connection settings
+              must still be valid, but aren't used)
+
+Replaying lets the rest of the tool be run, profiled, and tested offline with
+a realistic mix of queries.  A query is matched to a recorded one with the
+same SQL and arguments (in order), or failing that, to the next recorded one
+with the same SQL (e.g., for queries that include the current time); a query
+that wasn't recorded at all is an error.
+'''
+    ),
+    default=None,
+    cl_coercer=lambda x: None if x.lower() == 'none' else x,
+)
+
+nori.core.config_settings['db_trace_file'] = dict(
+    descr=(
+'''
+The database trace file to record to or replay from (see db_trace_mode).
+
+The file is gzip-compressed.  When recording, it is overwritten.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['db_replay_latency'] = dict(
+    descr=(
+'''
+The simulated latency of each database call when replaying, in seconds, or
+None to use the times taken when the trace was recorded.
 
-destdb.create_settings(heading='Destination Database')
+Ignored unless db_trace_mode is 'replay'.
+'''
+    ),
+    default=None,
+    cl_coercer=lambda x: None if x.lower() == 'none' else float(x),
+)
 
 nori.core.config_settings['diffsync_heading'] = dict(
     heading='Diff / Sync',
@@ -187,13 +436,242 @@ nori.core.config_settings['action'] = dict(
 '''
 Just find differences between the databases, or actually change them?
 
-Must be either 'diff' or 'sync'.
+Must be one of:
+    'diff': find and report differences only
+    'sync': find differences and change the destination database to match
+    'plan': find differences and write the changes that would be made by a
+            sync to a sync plan file (see sync_plan_file), without changing
+            anything
+    'apply': don't look for differences; instead, read a sync plan file
+             created by a previous 'plan' run, and make the changes listed
+             in it
+    'count': find differences, but only count them per template and
+             category (see count_sample_size); memory use doesn't depend
+             on the number of diffs
+
+The 'plan' and 'apply' actions allow the (potentially long) diff to be
+separated from the database changes; when applying a plan, the changes are
+grouped by template and type, and run together in a short window.
 '''
     ),
     default='diff',
     cl_coercer=str,
 )
 
+nori.core.config_settings['sync_plan_file'] = dict(
+    descr=(
+'''
+The sync plan file to write (if action is 'plan') or read (if action is
+'apply').
+
+Ignored for other actions.
+
+The templates setting must be the same when the plan is written and when it
+is applied (templates are matched by index and name), as must the reverse
+setting.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['incremental'] = dict(
+    descr=(
+'''
+Only process source rows which have changed since the last successful run?
+
+Can be True or False.
+
+This only affects templates with change-timestamp columns; see the
+templates setting.  The high-water mark for each template is kept in
+incremental_state_file; it is advanced only by the 'sync' action, and only
+if all of the template's changes were made successfully.  (Other actions
+use the existing high-water marks, if any.)  Templates with no high-water
+mark yet are processed in full, as are templates due for a full run (see
+incremental_max_age).
+
+Only changes that update a source row's change-timestamp column are seen.
+For example, with OCS, hardware.LASTDATE is updated by inventories, so
+rows removed from child tables (software, network cards, etc.) aren't
+seen until the next full run, and neither are computers deleted from
+OCS.  In particular, destination rows for deleted source rows are never
+removed by an incremental run, even with bidir.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+nori.core.config_settings['incremental_max_age'] = dict(
+    descr=(
+'''
+How long (in seconds) to go without a full run of a template, in
+incremental mode, or None for no limit.
+
+When a template's last full 'sync' is older than this, it is processed in
+full, to pick up the changes incremental runs can't detect (see
+incremental).  The age is measured from the start of the full read.
+'''
+    ),
+    default=86400,
+    cl_coercer=lambda x: None if x.lower() == 'none' else int(x),
+)
+
+nori.core.config_settings['incremental_state_file'] = dict(
+    descr=(
+'''
+The file to keep the incremental high-water marks in (see incremental).
+
+Ignored unless incremental is True.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['dest_snapshot_file'] = dict(
+    descr=(
+'''
+A local file in which to keep a snapshot of the destination data, or None
+to always read the destination database.
+
+The snapshot holds the transformed destination rows for each template, as
+of the last read, updated with every change made since then.  When a
+template's snapshot is current (see dest_snapshot_max_age), it is diffed
+against instead of reading the destination database.
+
+Only use this if nothing else changes the destination database (for the
+templates involved).  If any change to a template fails, or the run stops
+before a template's changes are finished, its snapshot is discarded, so it
+will be re-read on the next run.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['dest_snapshot_max_age'] = dict(
+    descr=(
+'''
+How old (in seconds) a template's destination snapshot can be before the
+destination database is re-read to verify and replace it, or None for no
+limit.
+
+The age is measured from the last actual read, not the last change.  If the
+re-read data doesn't match the snapshot, a warning is logged.
+'''
+    ),
+    default=86400,
+    cl_coercer=lambda x: None if x.lower() == 'none' else int(x),
+)
+
+nori.core.config_settings['checkpoint_file'] = dict(
+    descr=(
+'''
+A file in which to record the progress of the run, so that it can be
+resumed if it is interrupted (see resume), or None for no checkpoints.
+
+The file records the templates which have been completed, the keys synced
+so far in the current template (see checkpoint_interval), and the changes
+whose callbacks are still pending: the current template's changes (for the
+batch change callbacks), whether any changes have been made at all (for the
+global change callbacks), and the Drupal entities touched (for cache
+clearing).  When resuming, these are dispatched along with the rest of the
+run's changes.  The file is removed when the run finishes, after the global
+change callbacks.
+
+Ignored unless action is 'sync' and readonly_window is 'full' (otherwise,
+there is nothing committed to resume from).
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['checkpoint_interval'] = dict(
+    descr=(
+'''
+The minimum number of seconds between checkpoints within a template (see
+checkpoint_file).
+
+Checkpoints are always written when a template is finished.
+'''
+    ),
+    default=60,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['resume'] = dict(
+    descr=(
+'''
+Resume an interrupted run from the checkpoint file?
+
+Can be True or False.
+
+Finished templates are skipped, and the template that was in progress is
+continued after the last checkpointed key.  If there is no checkpoint file,
+the run starts from the beginning.  The pre-action callbacks are called
+again (e.g., to put a Drupal site back into read-only mode).
+
+The reverse and templates settings must be the same as in the interrupted
+run.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+nori.core.config_settings['daemon_interval'] = dict(
+    descr=(
+'''
+In daemon mode, the number of seconds from the start of one run to the
+start of the next.
+
+If a run takes longer than this, the next one starts immediately.
+'''
+    ),
+    default=3600,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['daemon_retry_delay'] = dict(
+    descr=(
+'''
+In daemon mode, the number of seconds to wait after a failed run.
+
+The delay is doubled for each consecutive failure, up to
+daemon_max_backoff.
+'''
+    ),
+    default=60,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['daemon_max_backoff'] = dict(
+    descr=(
+'''
+In daemon mode, the maximum number of seconds to wait after a failed run
+(see daemon_retry_delay).
+'''
+    ),
+    default=3600,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['count_sample_size'] = dict(
+    descr=(
+'''
+The number of example diffs to keep for each template and category, if the
+action is 'count'.
+
+The examples are a uniform random sample of the diffs found.  Set to 0 to
+only report the counts.
+'''
+    ),
+    default=5,
+    cl_coercer=int,
+)
+
 nori.core.config_settings['reverse'] = dict(
     descr=(
 '''
@@ -239,6 +717,41 @@ in which some of the data can theoretically be recovered.
     cl_coercer=nori.str_to_bool,
 )
 
+nori.core.config_settings['drupal_cache_mode'] = dict(
+    descr=(
+'''
+How to clear Drupal caches after a sync (see drupal_cache_callback()).
+
+Must be one of:
+    'targeted': delete only the cache_field (and entitycache module, if
+                present) entries for the entities that were changed, and
+                empty the bins in drupal_cache_flush_bins
+    'all': empty every table whose name starts with 'cache'
+
+In 'targeted' mode, if no entities were recorded at all, all of the caches
+are cleared.
+'''
+    ),
+    default='targeted',
+    cl_coercer=str,
+)
+
+nori.core.config_settings['drupal_cache_flush_bins'] = dict(
+    descr=(
+'''
+Drupal cache tables to empty completely (with TRUNCATE) after a sync, if
+drupal_cache_mode is 'targeted'.
+
+These should be the bins containing rendered output that may include the
+changed data.  Tables that don't exist are skipped.
+
+Ignored if drupal_cache_mode is 'all'.
+'''
+    ),
+    default=['cache_page', 'cache_block', 'cache_views_data'],
+    cl_coercer=lambda x: x.split(','),
+)
+
 nori.core.config_settings['pre_action_callbacks'] = dict(
     descr=(
 '''
@@ -312,6 +825,33 @@ registered before the pre-action functions are called.
     ),
 )
 
+nori.core.config_settings['readonly_window'] = dict(
+    descr=(
+'''
+How long to keep Drupal sites in read-only mode during a sync.
+
+Must be one of:
+    'full': the site is made read-only by the pre-action callbacks (see
+            pre_action_drupal_readonly()), and stays that way until the
+            post-action callbacks are run; this covers the whole run,
+            including reading and diffing the data
+    'write': the data is read and diffed inside a consistent-snapshot
+             (REPEATABLE READ) transaction on each database, and the site's
+             read-only status is only recorded by the pre-action callbacks;
+             once all of the templates have been diffed, the site is made
+             read-only, the rows affected by each change are re-read and
+             re-verified against the snapshot (changes whose rows have been
+             modified in the meantime are skipped, with a warning), and the
+             changes are made
+
+This only matters if action is 'sync' and pre_action_drupal_readonly() is
+one of the pre-action callbacks.
+'''
+    ),
+    default='full',
+    cl_coercer=str,
+)
+
 nori.core.config_settings['source_type'] = dict(
     descr=(
 '''
@@ -505,8 +1045,8 @@ other *args and **kwargs:
                   be updated / inserted included
     d_db: the connection object for the destination database
     d_cur: the cursor object for the destination database
-    diff_k: the key of the diff list within diff_dict
-    diff_i: the index of the diff within the list indicated by
+    diff_k: the key of the diff group within diff_store
+    diff_i: the index of the diff within the group indicated by
             diff_k
 and return True (success) or False (failure).
 (Note that 'source' and 'destination' in these descriptions are subject to
@@ -515,13 +1055,55 @@ the value of the 'reverse' setting.)
 If the source database is changed by a template, the functions are called at
 the end of processing the template, before the functions specified in the
 template itself.  They are called in order.
+
+See also source_template_batch_callbacks, which are called only once per
+template.
+'''
+    ),
+    # see apply_config_defaults() for default
+    default_descr='[]',
+)
+
+nori.core.config_settings['source_template_batch_callbacks'] = dict(
+    descr=(
+'''
+Functions to call once after processing each template, if the source
+database was changed by that template (which can only happen if the
+'reverse' setting is True).
+
+These are like source_template_change_callbacks, but instead of being called
+once for each changed row, they are called once per template with a list of
+all of the changes, which allows the work to be batched.
+
+The setting must contain a sequence of tuples in the format:
+    (function, *args, **kwargs)
+The sequence may be empty if there are no template batch callbacks.
+
+The callback functions must take these keyword arguments in addition to any
+other *args and **kwargs:
+    t_index: the index of the relevant template in the templates
+             setting
+    changes: a list of tuples, one for each change actually made, in the
+             format (mode, scope, s_row, d_row, new_key_cv, new_value_cv);
+             see source_template_change_callbacks and the templates
+             setting for the meanings of the elements
+    d_db: the connection object for the destination database
+    d_cur: the cursor object for the destination database
+and return True (success) or False (failure).
+(Note that 'source' and 'destination' in these descriptions are subject to
+the value of the 'reverse' setting.)
+
+The functions are called after all of the per-row change callbacks for the
+template, before the batch functions specified in the template itself.
+They are called in order.
 '''
     ),
     # see apply_config_defaults() for default
     default_descr=(
 """depends on source_type;
 'generic': []
-'drupal': [({0}.drupal_timestamp_callback, [], {{}})]""" .
+'drupal': [({0}.drupal_timestamp_batch_callback, [], {{}})], unless
+          source_template_change_callbacks is set (in which case, [])""" .
         format(PACKAGE_NAME)
     ),
 )
@@ -632,13 +1214,27 @@ Functions to call after processing each template, if the destination
 database was changed.
 
 See source_template_change_callbacks for more information.
+'''
+    ),
+    # see apply_config_defaults() for default
+    default_descr='[]',
+)
+
+nori.core.config_settings['dest_template_batch_callbacks'] = dict(
+    descr=(
+'''
+Functions to call once after processing each template, if the destination
+database was changed by that template.
+
+See source_template_batch_callbacks for more information.
 '''
     ),
     # see apply_config_defaults() for default
     default_descr=(
 """depends on dest_type;
 'generic': []
-'drupal': [({0}.drupal_timestamp_callback, [], {{}})]""" .
+'drupal': [({0}.drupal_timestamp_batch_callback, [], {{}})], unless
+          dest_template_change_callbacks is set (in which case, [])""" .
         format(PACKAGE_NAME)
     ),
 )
@@ -708,7 +1304,21 @@ This must be a sequence of dicts; the dicts must have these elements:
     {11}:
         key list [list; default: []]
 
-Elements with a default indicated can be omitted.
+    {12}:
+        source-DB batch change callback functions [sequence of tuples:
+        [(function, *args, **kwargs)]; default: []]
+
+    {13}:
+        dest-DB batch change callback functions [sequence of tuples:
+        [(function, *args, **kwargs)]; default: []]
+
+    {14}:
+        source-DB change-timestamp column [string; default: None]
+
+    {15}:
+        dest-DB change-timestamp column [string; default: None]
+
+Elements with a default indicated can be omitted.
 
 In this context, 'keys' are identifiers for use in accessing the correct
 entity in the opposite database, and 'values' are the actual content to
@@ -801,8 +1411,8 @@ diff or sync.
                       needing to be updated / inserted included
         d_db: the connection object for the destination database
         d_cur: the cursor object for the destination database
-        diff_k: the key of the diff list within diff_dict
-        diff_i: the index of the diff within the list indicated by
+        diff_k: the key of the diff group within diff_store
+        diff_i: the index of the diff within the group indicated by
                 diff_k
     and return True (success) or False (failure).
     (Note that 'destination' in these descriptions is subject to the value
@@ -837,6 +1447,49 @@ diff or sync.
     than are in the key list, but if a row has more key columns, columns
     which have no corresponding entry in the key list will be ignored for
     purposes of the comparison.
+
+{12}, {13}:
+
+    The batch change callback functions, if specified, are like the change
+    callback functions (see above), but are called once after the template
+    has been processed, with a list of all of the changes made, instead of
+    once per changed row.  (Again, only the destination sequence is used.)
+
+    The callback functions must take these keyword arguments in addition to
+    any other *args and **kwargs:
+        t_index: the index of the relevant template in the templates
+                 setting
+        changes: a list of tuples, one for each change actually made, in
+                 the format (mode, scope, s_row, d_row, new_key_cv,
+                 new_value_cv); see above for the meanings of the
+                 elements
+        d_db: the connection object for the destination database
+        d_cur: the cursor object for the destination database
+    and return True (success) or False (failure).
+
+    If the destination database is changed by this template, the functions
+    are called after the database-level batch functions (see above).  They
+    are called in order.
+
+{14}, {15}:
+
+    The change-timestamp columns are used in incremental runs (see the
+    incremental setting); only the source column is used, where 'source'
+    depends on the value of the 'reverse' setting.  If it is None, the
+    template is always processed in full.
+
+    The column must be usable in the WHERE clause of the source query; it
+    is added to the where_str and where_args query-function arguments, so
+    the source query function must accept these (as generic_db_query()
+    does).  For example, for OCS: 'hardware.LASTDATE'.
+
+    In an incremental run, only source rows changed since the template's
+    last successful run are read, and the destination read is restricted
+    to the (first-column) keys of those rows, so the first key column must
+    not be changed by the transform functions.  Rows deleted from the
+    source database can't be detected this way, nor can changes that
+    don't update the column (e.g., removed child rows); these are picked
+    up by the periodic full runs (see the incremental_max_age setting).
 ''' .
         format(*map(nori.pps, T_KEYS))
     ),
@@ -925,6 +1578,240 @@ database keys ('keys')?
     cl_coercer=str,
 )
 
+nori.core.config_settings['diff_memory_limit'] = dict(
+    descr=(
+'''
+The maximum number of diffs to keep in memory for the report, or None for
+no limit.
+
+Once this many diffs have been found, the rest are appended to a temporary
+file (see diff_spill_dir) and read back when the report is rendered.  Only
+a few bytes per diff are kept in memory for those.
+'''
+    ),
+    default=100000,
+    cl_coercer=lambda x: None if x.lower() == 'none' else int(x),
+)
+
+nori.core.config_settings['diff_spill_dir'] = dict(
+    descr=(
+'''
+The directory for the temporary diff file (see diff_memory_limit), or None
+for the system default.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['report_format'] = dict(
+    descr=(
+'''
+The format(s) of the diff / sync report.
+
+Must be one of:
+    'text': the human-readable report (see report_file)
+    'jsonl': JSON Lines, written to jsonl_report_file as the diffs are
+             found (or synced)
+    'both': both of the above
+
+Each JSON Lines record is an object with the following elements:
+    template_index: the index of the template in the templates setting
+    template_name: the name of the template
+    keys: the list of key values
+    source_values: the list of values in the source database, or null
+    dest_values: the list of values in the destination database, or null
+    exists_in_source, exists_in_dest: true, false, or null (see the
+                                      templates setting)
+    status: 'changed', 'partial', 'unchanged', or 'planned'
+Values that can't be represented in JSON are converted to strings.
+'''
+    ),
+    default='text',
+    cl_coercer=str,
+)
+
+nori.core.config_settings['jsonl_report_file'] = dict(
+    descr=(
+'''
+The file to write the JSON Lines report to, or '-' for standard output.
+
+Ignored unless report_format is 'jsonl' or 'both'.  The file is overwritten
+on each run, and is flushed after every record.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['report_file'] = dict(
+    descr=(
+'''
+A file to write the full diff / sync report to, or None.
+
+If this is set, the report is written to the file incrementally as it is
+rendered, and the report email and output log only get a summary, the first
+report_email_max_diffs diffs, and the name of the file.  Otherwise, the
+full report is built in memory and sent to both.
+
+The file is overwritten on each run.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['report_email_max_diffs'] = dict(
+    descr=(
+'''
+The maximum number of diffs to include in the report email (and output log)
+when report_file is set.
+
+Ignored if report_file is None.
+'''
+    ),
+    default=100,
+    cl_coercer=int,
+)
+
+nori.core.config_settings['report_timings'] = dict(
+    descr=(
+'''
+Append the per-phase timings to the diff / sync report?  (True/False)
+
+For each template, the time spent (and the number of rows handled) in each
+phase of the run is listed: reading, transforming, and filtering the source
+and destination rows, diffing, making changes, and the callbacks; the
+global callbacks and the report rendering are listed separately.
+'''
+    ),
+    default=True,
+    cl_coercer=nori.str_to_bool,
+)
+
+nori.core.config_settings['metrics_file'] = dict(
+    descr=(
+'''
+A file to write the run's metrics to, in JSON format, or None.
+
+The metrics include the per-phase timings described under report_timings.
+The file is overwritten on each run.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['prometheus_file'] = dict(
+    descr=(
+'''
+A file to write the run's metrics to, in the Prometheus text format, or None.
+
+This is meant for the node_exporter textfile collector; the file should be
+in the collector's directory and end in '.prom'.  It is replaced
+atomically at the end of each run, and includes the run duration, the
+per-template durations, the rows read from each side, the diffs by
+category, the sync operations by mode and outcome, the database statements
+executed, and the peak memory use.  Per-template series are labelled with
+both the template's index and its name, since names needn't be unique.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['query_stats'] = dict(
+    descr=(
+'''
+Keep statistics on the database queries?  (True/False)
+
+If this is true, the number of statements executed, the time taken, and the
+number of rows and (approximate) bytes fetched are recorded for each
+combination of template, Drupal chain type (e.g., 'n-f'; see
+get_drupal_chain_type()), and function running the query (e.g.,
+'get_drupal_node_ids').  The statistics are appended to the diff / sync
+report (if report_timings is true) and included in the metrics file.
+
+The byte counts are estimates, based on the lengths of the fetched values
+as text.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+nori.core.config_settings['slow_query_log_file'] = dict(
+    descr=(
+'''
+A file to log slow database queries to, or None.
+
+Queries taking at least slow_query_threshold seconds are appended to the
+file, with their SQL, arguments, and context.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['slow_query_threshold'] = dict(
+    descr=(
+'''
+The minimum time, in seconds, for a query to be logged as slow.
+
+Ignored if slow_query_log_file is None.
+'''
+    ),
+    default=1.0,
+    cl_coercer=float,
+)
+
+nori.core.config_settings['progress_interval'] = dict(
+    descr=(
+'''
+The minimum number of seconds between progress messages, or None.
+
+During long phases of a template, a progress message is logged (to the
+status log) every progress_interval seconds, with the number of items
+handled so far, the rate, and (if the total is known or can be estimated)
+the percentage done and the estimated time remaining.  The phases, and the
+items counted, are:
+    * source read / dest read: rows fetched from the database (for generic
+      databases, in batches of 1000; for Drupal databases, as each of the
+      per-field queries finishes)
+    * source transform/filter / dest transform/filter: rows transformed
+    * diff: source rows compared
+    * sync writes: sync operations applied
+
+The totals for the reads are estimated from the previous run (in daemon
+mode) and are unknown otherwise; the totals for syncs made during the diff
+are unknown, but syncs from a sync plan have known totals.
+
+If this is None, no progress messages are logged or written.
+'''
+    ),
+    default=60.0,
+    cl_coercer=lambda x: None if x.lower() == 'none' else float(x),
+)
+
+nori.core.config_settings['progress_file'] = dict(
+    descr=(
+'''
+A file to append progress events to, or None.
+
+Each progress message (see progress_interval) is also written to this file
+as a single line of JSON, with the elements time (seconds since the epoch),
+template_index, template_name, phase, unit, done, total, estimated (True if
+the total is an estimate), rate (per second), eta (in seconds, or null),
+elapsed (in seconds), and final (True for the message at the end of a
+phase).  The file is flushed after each event, so it can be tailed.
+
+Ignored if progress_interval is None.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
 nori.create_email_settings('report', 'report')
 nori.core.config_settings['send_report_emails']['descr'] = (
 '''
@@ -932,6 +1819,382 @@ Send reports on diffs / syncs by email?  (True/False)
 '''
 )
 
+nori.core.config_settings['profiling_heading'] = dict(
+    heading='Profiling',
+)
+
+nori.core.config_settings['profile'] = dict(
+    descr=(
+'''
+Profile the run?  (True/False)
+
+If this is true, the pre-action callbacks, each template, and the
+post-action callbacks are profiled separately, and the results are written
+to profile_dir:
+    * NAME.pstats: cProfile output, for the pstats module, snakeviz, etc.
+    * NAME.folded: collapsed stacks from a sampling profiler (see
+      profile_sample_interval), for flamegraph.pl, speedscope, etc.
+where NAME is 'pre-action', 'post-action', or 'template-NN-NAME' (with
+the template's index and name).  The files are overwritten on each run.
+
+Profiling slows the run down noticeably.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+nori.core.config_settings['profile_dir'] = dict(
+    descr=(
+'''
+The directory to write the profiles to (see profile).
+
+It is created if necessary.  Ignored if profile is False.
+'''
+    ),
+    default=None,
+    cl_coercer=str,
+)
+
+nori.core.config_settings['profile_sample_interval'] = dict(
+    descr=(
+'''
+The interval, in seconds, between call-stack samples for the collapsed-stack
+profiles, or None to skip them (see profile).
+
+Ignored if profile is False.
+'''
+    ),
+    default=0.01,
+    cl_coercer=lambda x: None if x.lower() == 'none' else float(x),
+)
+
+nori.core.config_settings['memory_stats'] = dict(
+    descr=(
+'''
+Track memory use per phase?  (True/False)
+
+If this is true, the following are recorded at the end of each timed phase
+of each template (see report_timings), and reported with the timings and in
+the metrics file:
+    * the peak resident set size (RSS) of the process so far
+    * the peak memory allocated by Python during the phase (using the
+      tracemalloc module; on Python < 3.9, this is the peak since the start
+      of the run)
+    * the top allocation sites (source lines) of the memory still allocated
+      at the end of the phase (see memory_top_sites); this is only recorded
+      for the outermost phases, not for phases nested inside others (e.g.,
+      the sync writes and template callbacks during the diff), which can
+      happen once per row
+
+The tracemalloc module requires Python 3.4 or later; without it, only the
+peak RSS is recorded.  Tracing allocations slows the run down and uses extra
+memory.
+'''
+    ),
+    default=False,
+    cl_coercer=nori.str_to_bool,
+)
+
+nori.core.config_settings['memory_top_sites'] = dict(
+    descr=(
+'''
+The number of allocation sites to record per phase (see memory_stats).
+
+Ignored if memory_stats is False.
+'''
+    ),
+    default=5,
+    cl_coercer=int,
+)
+
+
+########################################################################
+#                               CLASSES
+########################################################################
+
+##########################
+# lazy log-message helpers
+##########################
+
+class LazyPps(object):
+
+    """
+    Defer a call to nori.pps() until the result is actually needed.
+
+    Instances can be passed as arguments to LazyFormat (or used directly
+    as log messages); the pretty-printing is only done if a handler
+    actually renders the message, so it costs nothing when the logger
+    or handlers are not enabled for the message's level.
+
+    """
+
+    __slots__ = ('obj', 'rendered')
+
+    def __init__(self, obj):
+        """
+        Parameters:
+            obj: the object to pretty-print
+        """
+        self.obj = obj
+        self.rendered = None
+
+    def __str__(self):
+        """
+        Render (once) and return the pretty-printed object.
+        Dependencies:
+            modules: nori
+        """
+        if self.rendered is None:
+            self.rendered = nori.pps(self.obj)
+        return self.rendered
+
+
+class LazyFormat(object):
+
+    """
+    A log message whose str.format() call is deferred until rendering.
+
+    Pass an instance as the message to a logging method, e.g.:
+        logger.debug(LazyFormat('Rows:\n{0}', LazyPps(rows)))
+    The message is only formatted (once, even with multiple handlers) if
+    a handler actually emits it; any LazyPps arguments are rendered at
+    the same time.
+
+    """
+
+    __slots__ = ('fmt', 'args', 'kwargs', 'rendered')
+
+    def __init__(self, fmt, *args, **kwargs):
+        """
+        Parameters:
+            fmt: the format string
+            *args, **kwargs: the arguments for fmt.format()
+        """
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+        self.rendered = None
+
+    def __str__(self):
+        """
+        Render (once) and return the formatted message.
+        """
+        if self.rendered is None:
+            self.rendered = self.fmt.format(*self.args, **self.kwargs)
+        return self.rendered
+
+
+###################
+# query arguments
+###################
+
+class KeyValues(tuple):
+
+    """
+    A tuple of alternative values for a key column.
+
+    When used as the value element of the first tuple in key_cv in a
+    read, the query functions will read the rows for any of these values
+    instead of just one; see key_value_cond().  This is used to restrict
+    incremental destination reads to the changed keys.
+
+    """
+
+    __slots__ = ()
+
+
+###############
+# diff storage
+###############
+
+class DiffRecord(object):
+
+    """
+    A single in-memory diff; see diff_store.
+
+    The sync status is kept separately, in DiffStore.statuses, so that
+    it can be changed in place even for diffs that have been spilled to
+    disk.
+
+    """
+
+    __slots__ = ('template_index', 'exists_in_source', 'source_row',
+                 'exists_in_dest', 'dest_row')
+
+    def __init__(self, template_index, exists_in_source, source_row,
+                 exists_in_dest, dest_row):
+        """
+        Parameters:
+            see log_diff()
+        """
+        self.template_index = template_index
+        self.exists_in_source = exists_in_source
+        self.source_row = source_row
+        self.exists_in_dest = exists_in_dest
+        self.dest_row = dest_row
+
+    def to_tuple(self):
+        """
+        Return the diff as a tuple, without the status.
+        """
+        return (self.template_index, self.exists_in_source, self.source_row,
+                self.exists_in_dest, self.dest_row)
+
+
+class DiffStore(object):
+
+    """
+    Compact storage for the diffs found, grouped by a key.
+
+    Each diff gets a sequential record number.  The first memory_limit
+    diffs are kept in memory as DiffRecord objects; after that, diffs
+    are pickled and appended to a temporary spill file, and only their
+    offsets are kept in memory.  The groups map keys to arrays of record
+    numbers, and the statuses and template indexes are kept in arrays
+    indexed by record number.
+
+    Diffs are addressed by (group key, index within the group), which
+    is what log_diff() returns as (diff_k, diff_i).
+
+    """
+
+    # status codes in the statuses array
+    STATUS_CODES = {None: -1, False: 0, True: 1}
+    STATUS_VALUES = {-1: None, 0: False, 1: True}
+
+    def __init__(self, memory_limit=None, spill_dir=None):
+        """
+        Parameters:
+            memory_limit: the maximum number of diffs to keep in memory,
+                          or None for no limit
+            spill_dir: the directory for the spill file, or None for
+                       the system default
+        Dependencies:
+            modules: collections, array
+        """
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.groups = collections.OrderedDict()
+        self.statuses = array.array('b')
+        self.template_indexes = array.array('l')
+        self.records = []
+        self.spill_file = None
+        try:
+            self.spill_offsets = array.array('q')
+        except ValueError:  # Python < 3.3
+            self.spill_offsets = array.array('l')
+
+    def __len__(self):
+        """
+        Return the total number of diffs.
+        """
+        return len(self.statuses)
+
+    def __bool__(self):
+        """
+        Return True if there are any diffs.
+        """
+        return len(self.statuses) > 0
+
+    __nonzero__ = __bool__  # Python 2
+
+    def __iter__(self):
+        """
+        Iterate over the group keys, in the order they were added.
+        """
+        return iter(self.groups)
+
+    def add(self, diff_k, template_index, exists_in_source, source_row,
+            exists_in_dest, dest_row):
+        """
+        Add a diff to a group, with a status of None.
+        Returns a tuple of (diff_k, diff_i).
+        Parameters:
+            diff_k: the group key
+            see log_diff() for the rest
+        Dependencies:
+            modules: array, tempfile, pickle
+        """
+        rec_num = len(self.statuses)
+        if (self.memory_limit is None or
+              len(self.records) < self.memory_limit):
+            self.records.append(DiffRecord(template_index, exists_in_source,
+                                           source_row, exists_in_dest,
+                                           dest_row))
+        else:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+            self.spill_file.seek(0, 2)
+            self.spill_offsets.append(self.spill_file.tell())
+            pickle.dump((template_index, exists_in_source, source_row,
+                         exists_in_dest, dest_row), self.spill_file,
+                        pickle.HIGHEST_PROTOCOL)
+        self.statuses.append(self.STATUS_CODES[None])
+        self.template_indexes.append(template_index)
+        if diff_k not in self.groups:
+            self.groups[diff_k] = array.array('l')
+        self.groups[diff_k].append(rec_num)
+        return (diff_k, len(self.groups[diff_k]) - 1)
+
+    def set_status(self, diff_k, diff_i, changed):
+        """
+        Set the status of a diff.
+        Parameters:
+            diff_k: the group key
+            diff_i: the index within the group
+            changed: can be True (fully changed), False (partly
+                     changed), or None (unchanged)
+        """
+        self.statuses[self.groups[diff_k][diff_i]] = (
+            self.STATUS_CODES[changed]
+        )
+
+    def get_record(self, rec_num):
+        """
+        Get a diff by record number.
+        Returns a tuple in the format (template_index, exists_in_source,
+        source_row, exists_in_dest, dest_row, has_been_changed).
+        Parameters:
+            rec_num: the record number
+        Dependencies:
+            modules: pickle
+        """
+        num_in_memory = len(self.records)
+        if rec_num < num_in_memory:
+            diff_t = self.records[rec_num].to_tuple()
+        else:
+            self.spill_file.seek(self.spill_offsets[rec_num - num_in_memory])
+            diff_t = pickle.load(self.spill_file)
+        return diff_t + (self.STATUS_VALUES[self.statuses[rec_num]], )
+
+    def get(self, diff_k, diff_i):
+        """
+        Get a diff by group key and index; see get_record().
+        Parameters:
+            diff_k: the group key
+            diff_i: the index within the group
+        """
+        return self.get_record(self.groups[diff_k][diff_i])
+
+    def group(self, diff_k):
+        """
+        Iterate over the diffs in a group; see get_record().
+        Parameters:
+            diff_k: the group key
+        """
+        for rec_num in self.groups[diff_k]:
+            yield self.get_record(rec_num)
+
+    def close(self):
+        """
+        Discard all of the diffs and remove the spill file, if any.
+        """
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.__init__(self.memory_limit, self.spill_dir)
+
 
 ########################################################################
 #                              FUNCTIONS
@@ -976,15 +2239,18 @@ def apply_config_defaults():
         config settings: source_type, source_query_func,
                          source_query_defaulter, source_query_validator,
                          source_template_change_callbacks,
+                         source_template_batch_callbacks,
                          source_global_change_callbacks,
                          dest_type, dest_query_func,
                          dest_query_defaulter, dest_query_validator,
                          dest_template_change_callbacks,
+                         dest_template_batch_callbacks,
                          dest_global_change_callbacks, templates
         globals: (almost all of) T_*
         functions: generic_db_query(), drupal_db_query(),
                    validate_generic_args(), validate_drupal_args(),
-                   drupal_timestamp_callback(), drupal_cache_callback()
+                   drupal_timestamp_batch_callback(),
+                   drupal_cache_callback()
         modules: nori
         Python: 2.0/3.2, for callable()
 
@@ -1026,13 +2292,20 @@ def apply_config_defaults():
         elif nori.core.cfg['source_type'] == 'drupal':
             nori.core.cfg['source_query_validator'] = validate_drupal_args
 
-    if 'source_template_change_callbacks' not in nori.cfg:
-        if nori.core.cfg['source_type'] == 'generic':
-            nori.core.cfg['source_template_change_callbacks'] = []
-        elif nori.core.cfg['source_type'] == 'drupal':
-            nori.core.cfg['source_template_change_callbacks'] = [
-                (drupal_timestamp_callback, [], {})
+    # the timestamps are only updated by default if the per-row
+    # callbacks (which used to do it) haven't been set explicitly, so
+    # existing configs keep their behavior
+    if 'source_template_batch_callbacks' not in nori.cfg:
+        if ((nori.core.cfg['source_type'] == 'drupal') and
+              ('source_template_change_callbacks' not in nori.cfg)):
+            nori.core.cfg['source_template_batch_callbacks'] = [
+                (drupal_timestamp_batch_callback, [], {})
             ]
+        else:
+            nori.core.cfg['source_template_batch_callbacks'] = []
+
+    if 'source_template_change_callbacks' not in nori.cfg:
+        nori.core.cfg['source_template_change_callbacks'] = []
 
     if 'source_global_change_callbacks' not in nori.cfg:
         if nori.core.cfg['source_type'] == 'generic':
@@ -1065,13 +2338,20 @@ def apply_config_defaults():
         elif nori.core.cfg['dest_type'] == 'drupal':
             nori.core.cfg['dest_query_validator'] = validate_drupal_args
 
-    if 'dest_template_change_callbacks' not in nori.cfg:
-        if nori.core.cfg['dest_type'] == 'generic':
-            nori.core.cfg['dest_template_change_callbacks'] = []
-        elif nori.core.cfg['dest_type'] == 'drupal':
-            nori.core.cfg['dest_template_change_callbacks'] = [
-                (drupal_timestamp_callback, [], {})
+    # the timestamps are only updated by default if the per-row
+    # callbacks (which used to do it) haven't been set explicitly, so
+    # existing configs keep their behavior
+    if 'dest_template_batch_callbacks' not in nori.cfg:
+        if ((nori.core.cfg['dest_type'] == 'drupal') and
+              ('dest_template_change_callbacks' not in nori.cfg)):
+            nori.core.cfg['dest_template_batch_callbacks'] = [
+                (drupal_timestamp_batch_callback, [], {})
             ]
+        else:
+            nori.core.cfg['dest_template_batch_callbacks'] = []
+
+    if 'dest_template_change_callbacks' not in nori.cfg:
+        nori.core.cfg['dest_template_change_callbacks'] = []
 
     if 'dest_global_change_callbacks' not in nori.cfg:
         if nori.core.cfg['dest_type'] == 'generic':
@@ -1137,6 +2417,18 @@ def apply_config_defaults():
         if T_KEY_LIST_KEY not in template:
             nori.core.cfg['templates'][i][T_KEY_LIST_KEY] = []
 
+        if T_S_BATCH_CB_KEY not in template:
+            nori.core.cfg['templates'][i][T_S_BATCH_CB_KEY] = []
+
+        if T_D_BATCH_CB_KEY not in template:
+            nori.core.cfg['templates'][i][T_D_BATCH_CB_KEY] = []
+
+        if T_S_CHANGED_KEY not in template:
+            nori.core.cfg['templates'][i][T_S_CHANGED_KEY] = None
+
+        if T_D_CHANGED_KEY not in template:
+            nori.core.cfg['templates'][i][T_D_CHANGED_KEY] = None
+
 
 def validate_generic_chain(key_index, key_cv, value_index, value_cv):
     """
@@ -1421,40 +2713,124 @@ def validate_config():
     Validate diff/sync and reporting config settings.
 
     Dependencies:
-        config settings: action, reverse, bidir, source_type,
-                         source_query_func, source_query_validator,
+        config settings: sourcedb_pool_size, destdb_pool_size,
+                         sourcedb_replica, destdb_replica,
+                         db_trace_mode, db_trace_file,
+                         db_replay_latency, action, sync_plan_file,
+                         reverse, bidir,
+                         pre_action_callbacks, post_action_callbacks,
+                         readonly_window, drupal_cache_mode,
+                         drupal_cache_flush_bins, source_type,
+                         source_query_func,
+                         source_query_validator,
                          source_template_change_callbacks,
+                         source_template_batch_callbacks,
                          source_global_change_callbacks,
                          dest_type, dest_query_func,
                          dest_query_validator,
                          dest_template_change_callbacks,
+                         dest_template_batch_callbacks,
                          dest_global_change_callbacks, templates,
                          template_mode, template_list, key_mode,
-                         key_list, report_order
+                         key_list, report_order, diff_memory_limit,
+                         diff_spill_dir, report_format,
+                         jsonl_report_file, report_file,
+                         report_email_max_diffs, report_timings,
+                         metrics_file, prometheus_file, query_stats,
+                         slow_query_log_file,
+                         slow_query_threshold, progress_interval,
+                         progress_file, profile, profile_dir,
+                         profile_sample_interval, memory_stats,
+                         memory_top_sites
         globals: T_*
         modules: nori
 
     """
 
+    # connection pools
+    for setting_name in ['sourcedb_pool_size', 'destdb_pool_size']:
+        nori.setting_check_type(setting_name, int)
+        if nori.core.cfg[setting_name] < 1:
+            nori.err_exit('Error: {0} must be at least 1; exiting.' .
+                          format(setting_name),
+                          nori.core.exitvals['startup']['num'])
+
+    # read replicas
+    for setting_name in ['sourcedb_replica', 'destdb_replica']:
+        nori.setting_check_type(setting_name, bool)
+
+    # database tracing
+    nori.setting_check_list('db_trace_mode', [None, 'record', 'replay'])
+    if nori.core.cfg['db_trace_mode'] is not None:
+        nori.setting_check_not_blank('db_trace_file')
+    if nori.core.cfg['db_trace_mode'] == 'replay':
+        nori.setting_check_type('db_replay_latency',
+                                (int, float, nori.core.NONE_TYPE))
+        if (nori.core.cfg['db_replay_latency'] is not None and
+              nori.core.cfg['db_replay_latency'] < 0):
+            nori.err_exit('Error: db_replay_latency must not be negative; '
+                          'exiting.', nori.core.exitvals['startup']['num'])
+
     # diff/sync settings, not including templates (see below)
-    nori.setting_check_list('action', ['diff', 'sync'])
+    nori.setting_check_list('action',
+                            ['diff', 'sync', 'plan', 'apply', 'count'])
+    if nori.core.cfg['action'] in ['plan', 'apply']:
+        nori.setting_check_not_blank('sync_plan_file')
+    nori.setting_check_type('incremental', bool)
+    if nori.core.cfg['incremental']:
+        nori.setting_check_not_blank('incremental_state_file')
+        nori.setting_check_type('incremental_max_age',
+                                (int, nori.core.NONE_TYPE))
+    nori.setting_check_type('dest_snapshot_file',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    if nori.core.cfg['dest_snapshot_file'] is not None:
+        nori.setting_check_not_blank('dest_snapshot_file')
+    nori.setting_check_type('dest_snapshot_max_age',
+                            (int, nori.core.NONE_TYPE))
+    nori.setting_check_type('checkpoint_file',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    if nori.core.cfg['checkpoint_file'] is not None:
+        nori.setting_check_not_blank('checkpoint_file')
+    nori.setting_check_type('checkpoint_interval', int)
+    nori.setting_check_type('resume', bool)
+    if nori.core.cfg['resume']:
+        nori.setting_check_not_blank('checkpoint_file')
+    for setting_name in ['daemon_interval', 'daemon_retry_delay',
+                         'daemon_max_backoff']:
+        nori.setting_check_type(setting_name, int)
+        if nori.core.cfg[setting_name] < 0:
+            nori.err_exit('Error: {0} must be non-negative; exiting.' .
+                          format(setting_name),
+                          nori.core.exitvals['startup']['num'])
+    nori.setting_check_type('count_sample_size', int)
+    if nori.core.cfg['count_sample_size'] < 0:
+        nori.err_exit('Error: count_sample_size must be non-negative; '
+                      'exiting.', nori.core.exitvals['startup']['num'])
     nori.setting_check_type('reverse', bool)
     nori.setting_check_type('bidir', bool)
     nori.setting_check_callbacks('pre_action_callbacks')
     nori.setting_check_callbacks('post_action_callbacks', 1, 1)
     for i, cb_t in enumerate(nori.core.cfg['post_action_callbacks']):
         nori.setting_check_type(('post_action_callbacks', i, 3), bool)
+    nori.setting_check_list('readonly_window', ['full', 'write'])
+    nori.setting_check_list('drupal_cache_mode', ['targeted', 'all'])
+    nori.setting_check_type('drupal_cache_flush_bins',
+                            nori.core.MAIN_SEQUENCE_TYPES)
+    for i, bin_name in enumerate(nori.core.cfg['drupal_cache_flush_bins']):
+        nori.setting_check_not_blank(('drupal_cache_flush_bins', i))
     nori.setting_check_list('source_type', ['generic', 'drupal'])
     nori.setting_check_callable('source_query_func', may_be_none=False)
     nori.setting_check_callable('source_query_defaulter', may_be_none=True)
     nori.setting_check_callable('source_query_validator', may_be_none=False)
     nori.setting_check_callbacks('source_template_change_callbacks')
+    nori.setting_check_callbacks('source_template_batch_callbacks')
     nori.setting_check_callbacks('source_global_change_callbacks')
     nori.setting_check_list('dest_type', ['generic', 'drupal'])
     nori.setting_check_callable('dest_query_func', may_be_none=False)
     nori.setting_check_callable('dest_query_defaulter', may_be_none=True)
     nori.setting_check_callable('dest_query_validator', may_be_none=False)
     nori.setting_check_callbacks('dest_template_change_callbacks')
+    nori.setting_check_callbacks('dest_template_batch_callbacks')
     nori.setting_check_callbacks('dest_global_change_callbacks')
     nori.setting_check_list('template_mode', ['all', 'include', 'exclude'])
     if nori.core.cfg['template_mode'] != 'all':
@@ -1510,6 +2886,18 @@ def validate_config():
         if template[T_KEY_MODE_KEY] != 'all':
             # key list
             nori.setting_check_not_empty(('templates', i, T_KEY_LIST_KEY))
+        # source-DB batch change callbacks
+        nori.setting_check_callbacks(('templates', i, T_S_BATCH_CB_KEY))
+        # dest-DB batch change callbacks
+        nori.setting_check_callbacks(('templates', i, T_D_BATCH_CB_KEY))
+        # change-timestamp columns
+        for t_key in [T_S_CHANGED_KEY, T_D_CHANGED_KEY]:
+            nori.setting_check_type(
+                ('templates', i, t_key),
+                nori.core.STRING_TYPES + (nori.core.NONE_TYPE, )
+            )
+            if template[t_key] is not None:
+                nori.setting_check_not_blank(('templates', i, t_key))
 
         # templates: query-function arguments
         for (sd, t_key, validator_key) in [
@@ -1534,25 +2922,220 @@ def validate_config():
 
     # reporting settings
     nori.setting_check_list('report_order', ['template', 'keys'])
+    nori.setting_check_type('diff_memory_limit', (int, nori.core.NONE_TYPE))
+    nori.setting_check_type('diff_spill_dir',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    nori.setting_check_list('report_format', ['text', 'jsonl', 'both'])
+    if nori.core.cfg['report_format'] in ['jsonl', 'both']:
+        nori.setting_check_not_blank('jsonl_report_file')
+    nori.setting_check_type('report_file',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    if nori.core.cfg['report_file'] is not None:
+        nori.setting_check_not_blank('report_file')
+    nori.setting_check_type('report_email_max_diffs', int)
+    nori.setting_check_type('report_timings', bool)
+    nori.setting_check_type('metrics_file',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    if nori.core.cfg['metrics_file'] is not None:
+        nori.setting_check_not_blank('metrics_file')
+    nori.setting_check_type('prometheus_file',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    if nori.core.cfg['prometheus_file'] is not None:
+        nori.setting_check_not_blank('prometheus_file')
+    nori.setting_check_type('query_stats', bool)
+    nori.setting_check_type('slow_query_log_file',
+                            nori.core.STRING_TYPES + (nori.core.NONE_TYPE, ))
+    if nori.core.cfg['slow_query_log_file'] is not None:
+        nori.setting_check_not_blank('slow_query_log_file')
+        nori.setting_check_type('slow_query_threshold', (int, float))
+    nori.setting_check_type('progress_interval',
+                            (int, float, nori.core.NONE_TYPE))
+    if nori.core.cfg['progress_interval'] is not None:
+        nori.setting_check_type(
+            'progress_file', nori.core.STRING_TYPES + (nori.core.NONE_TYPE, )
+        )
+        if nori.core.cfg['progress_file'] is not None:
+            nori.setting_check_not_blank('progress_file')
+    nori.setting_check_type('profile', bool)
+    if nori.core.cfg['profile']:
+        nori.setting_check_not_blank('profile_dir')
+        nori.setting_check_type('profile_sample_interval',
+                                (int, float, nori.core.NONE_TYPE))
+    nori.setting_check_type('memory_stats', bool)
+    if nori.core.cfg['memory_stats']:
+        nori.setting_check_type('memory_top_sites', int)
     # the rest are handled by nori.validate_email_config()
 
 
-###########################
-# database query functions
-###########################
+##################
+# query execution
+##################
 
-#
-# (listed mostly in top-down order because the docstrings in the
-# higher-level functions explain what's going on)
-#
+def db_execute(db_obj, db_cur, query_str, query_args=None,
+               has_results=False):
 
-def query_dispatcher(mode, scope, db_obj, db_cur, dest_func, dest_args,
-                     dest_kwargs, new_key_cv, new_value_cv):
+    """
+    Execute a database query, keeping statistics and logging slow
+    queries.
+
+    All queries should go through this function (and db_fetchall()).
+    The statement is always counted for the current template (from the
+    phase being timed; see metrics.start_phase()) in statement_counts.  The
+    statistics (see query_stats) are attributed to the current template,
+    the current Drupal chain type, and the name of the calling function.
+
+    Returns the return value of db_obj.execute().
+
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+        query_str: the query string
+        query_args: a list of values to interpolate into the query
+                    string, or None
+        has_results: see nori's DBMS.execute()
+
+    Dependencies:
+        config settings: query_stats, slow_query_log_file,
+                         slow_query_threshold
+        globals: metrics.query_stats, metrics.last_query_stats,
+                 metrics.statement_counts, metrics.query_chain_type,
+                 metrics.phase_stack, metrics.monotonic
+        functions: metrics.log_slow_query()
+        modules: sys, nori, metrics
+
+    """
+
+    t_index = metrics.phase_stack[-1][0] if metrics.phase_stack else None
+    metrics.statement_counts[t_index] = (
+        metrics.statement_counts.get(t_index, 0) + 1
+    )
+
+    stats_on = nori.core.cfg['query_stats']
+    slow_on = nori.core.cfg['slow_query_log_file'] is not None
+    if not (stats_on or slow_on):
+        return db_obj.execute(db_cur, query_str, query_args,
+                              has_results=has_results)
+
+    func_name = sys._getframe(1).f_code.co_name
+    start = metrics.monotonic()
+    ret = db_obj.execute(db_cur, query_str, query_args,
+                         has_results=has_results)
+    elapsed = metrics.monotonic() - start
+
+    if stats_on:
+        stats_key = (t_index, metrics.query_chain_type, func_name)
+        if stats_key not in metrics.query_stats:
+            metrics.query_stats[stats_key] = [0, 0.0, 0, 0]
+        metrics.last_query_stats = metrics.query_stats[stats_key]
+        metrics.last_query_stats[0] += 1
+        metrics.last_query_stats[1] += elapsed
+    if slow_on and elapsed >= nori.core.cfg['slow_query_threshold']:
+        metrics.log_slow_query(elapsed, t_index, func_name, query_str,
+                               query_args)
+
+    return ret
+
+
+def db_fetchall(db_obj, db_cur, progress_phase=None):
+
+    """
+    Fetch the results of a query run by db_execute(), adding them to the
+    query statistics.
+
+    If the progress of progress_phase is being counted (see
+    progress.start_progress()), the rows are fetched READ_FETCH_SIZE at a time
+    (see db_fetchmany()), and the count is advanced after each batch.
+
+    Returns the return value of db_obj.fetchall().
+
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+        progress_phase: the name of the phase to count the rows towards,
+                        or None
+
+    Dependencies:
+        config settings: query_stats
+        globals: metrics.last_query_stats, progress.progress_counters,
+                 READ_FETCH_SIZE
+        functions: metrics.estimate_rows_bytes(), db_fetchmany(),
+                   progress.advance_progress()
+        modules: nori, metrics, progress
+
+    """
+
+    if progress_phase in progress.progress_counters:
+        rows = []
+        while True:
+            ret = db_fetchmany(db_obj, db_cur, READ_FETCH_SIZE)
+            if not ret[0]:
+                return ret
+            if not ret[1]:
+                break
+            rows.extend(ret[1])
+            progress.advance_progress(progress_phase, len(ret[1]))
+        ret = (True, rows)
+    else:
+        ret = db_obj.fetchall(db_cur)
+    if (nori.core.cfg['query_stats'] and
+          metrics.last_query_stats is not None and ret[0] and ret[1]):
+        metrics.last_query_stats[2] += len(ret[1])
+        metrics.last_query_stats[3] += metrics.estimate_rows_bytes(ret[1])
+    return ret
+
+
+def db_fetchmany(db_obj, db_cur, size):
+
+    """
+    Fetch the next batch of results of a query run by db_execute().
+
+    nori's DBMS objects only have fetchall(), so unless db_obj is one of
+    the trace wrappers (see dbtrace.RecordingDB and dbtrace.ReplayDB),
+    the batch is fetched from the DB-API cursor directly.
+
+    Returns a tuple of (success, rows), like db_obj.fetchall(); the list
+    of rows is empty when there are no more.
+
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+        size: the maximum number of rows to fetch
+
+    Dependencies:
+        classes: dbtrace.RecordingDB, dbtrace.ReplayDB
+        modules: nori, dbtrace
+
+    """
+
+    if isinstance(db_obj, (dbtrace.RecordingDB, dbtrace.ReplayDB)):
+        return db_obj.fetchmany(db_cur, size)
+    try:
+        return (True, list(db_cur.fetchmany(size)))
+    except Exception as e:
+        nori.core.email_logger.error(
+            'Error: could not fetch the query results: {0}'.format(e)
+        )
+        return (False, None)
+
+
+###########################
+# database query functions
+###########################
+
+#
+# (listed mostly in top-down order because the docstrings in the
+# higher-level functions explain what's going on)
+#
+
+def query_dispatcher(mode, scope, db_obj, db_cur, dest_func, dest_args,
+                     dest_kwargs, new_key_cv, new_value_cv):
 
     """
     Call database query functions separately for each value_cv tuple.
 
-    Not used for reads, only updates / inserts / deletes.
+    Not used for reads, only updates / inserts / deletes.  The fields
+    changed are recorded as written to, for read-replica routing (see
+    pools.get_read_db()).
 
     The source_data tuple, dest_data tuple, and (dest_key_cv +
     dest_value_cv) must all be the same length, and the number of keys
@@ -1578,11 +3161,22 @@ def query_dispatcher(mode, scope, db_obj, db_cur, dest_func, dest_args,
                       inserted included
 
     Dependencies:
-        functions: (contents of dest_func)
-        modules: copy, nori
+        globals: pools.written_dbs
+        functions: pools.cv_idents(), (contents of dest_func)
+        modules: copy, nori, pools
 
     """
 
+    # from now on, reads of these fields can't use a replica; with
+    # generic databases, inserts and deletes also change the key columns
+    # (Drupal keys are entities, which aren't created or removed here)
+    written = pools.cv_idents(new_value_cv)
+    if mode != 'update' and 'tables' in dest_kwargs:
+        written |= pools.cv_idents(new_key_cv)
+    if id(db_obj) not in pools.written_dbs:
+        pools.written_dbs[id(db_obj)] = set()
+    pools.written_dbs[id(db_obj)] |= written
+
     # log what we're doing
     if mode == 'update':
         nori.core.status_logger.info(
@@ -1640,6 +3234,36 @@ probably required.
     return status
 
 
+def key_value_cond(column, value):
+    """
+    Render a query condition requiring a column to have a value.
+    A value of None is matched with IS NULL ('= NULL' matches nothing).
+    Returns a tuple of (condition string, list of query arguments).
+    Parameters:
+        column: the column name
+        value: the required value, or a KeyValues tuple of alternatives
+    Dependencies:
+        classes: KeyValues
+    """
+    if isinstance(value, KeyValues):
+        values = [v for v in value if v is not None]
+        conds = []
+        if values:
+            conds.append('{0} IN ({1})'.format(column,
+                                               ', '.join(['%s'] *
+                                                         len(values))))
+        if len(values) < len(value):
+            conds.append('{0} IS NULL'.format(column))
+        if not conds:
+            return ('1 = 0', [])
+        if len(conds) > 1:
+            return ('(' + ' OR '.join(conds) + ')', values)
+        return (conds[0], values)
+    if value is None:
+        return ('{0} IS NULL'.format(column), [])
+    return ('{0} = %s'.format(column), [value])
+
+
 def generic_db_query(db_obj, db_cur, mode, scope, tables, key_cv, value_cv,
                      where_str=None, where_args=[], more_str=None,
                      more_args=[]):
@@ -1743,7 +3367,8 @@ def generic_db_read(db_obj, db_cur, tables, key_cv, value_cv,
         see generic_db_query()
 
     Dependencies:
-        modules: operator, nori
+        functions: key_value_cond(), progress.read_progress_phase()
+        modules: operator, nori, progress
 
     """
 
@@ -1765,8 +3390,9 @@ def generic_db_read(db_obj, db_cur, tables, key_cv, value_cv,
         query_args += where_args
     for cv in key_cv:
         if len(cv) > 2:
-            where_parts.append('({0} = %s)'.format(cv[0]))
-            query_args.append(cv[2])
+            cond_str, cond_args = key_value_cond(cv[0], cv[2])
+            where_parts.append('(' + cond_str + ')')
+            query_args += cond_args
     if where_parts:
         query_str += 'WHERE ' + '\nAND\n'.join(where_parts) + '\n'
     if more_str:
@@ -1774,10 +3400,10 @@ def generic_db_read(db_obj, db_cur, tables, key_cv, value_cv,
         query_args += more_args
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur, progress.read_progress_phase())
     if not ret[0]:
         return None
     if not ret[1]:
@@ -1843,8 +3469,8 @@ Exiting.'''.format(*map(nori.pps, [db_obj, db_cur, tables, key_cv, value_cv,
     query_str += 'WHERE ' + '\nAND\n'.join(where_parts) + '\n'
 
     # execute the query
-    ret = db_obj.execute(db_cur, query_str.split(), query_args,
-                         has_results=False)
+    ret = db_execute(db_obj, db_cur, query_str.split(), query_args,
+                     has_results=False)
     return None if not ret else True
 
 
@@ -2102,9 +3728,11 @@ def drupal_db_query(db_obj, db_cur, mode, scope, key_cv, value_cv):
                     sequence must contain exactly one tuple
 
     Dependencies:
-        functions: drupal_db_read(), drupal_db_update(),
-                   drupal_db_insert()
-        modules: sys, collections, itertools, nori
+        globals: metrics.query_chain_type
+        functions: drupal_db_read(), drupal_db_update(), drupal_db_insert(),
+                   get_drupal_chain_type(), progress.read_progress_phase(),
+                   progress.advance_progress()
+        modules: sys, collections, itertools, nori, metrics, progress
 
     """
 
@@ -2127,95 +3755,107 @@ Exiting.'''.format(*map(nori.pps, [db_obj, db_cur, mode, scope, key_cv,
         )
         sys.exit(nori.core.exitvals['internal']['num'])
 
-    if mode == 'read':
-        #
-        # I finally realized that if you try to retrieve multiple fields
-        # simultaneously, and there are bogus rows with deleted = 1,
-        # you will lose entire result rows.  Even a construct like
-        #     'AND (f.deleted = 0 OR f.deleted IS NULL)'
-        # doesn't help, because the column is only NULL if the join
-        # fails entirely.  Moreover, the same problem applies if (for
-        # example) there is a row with the same entity_id but a
-        # different entity_type, so it's not just a question of removing
-        # old/bogus rows from the database.  There are basically two
-        # solutions:
-        # 1) pull out just the matching rows into a temp table, so joins
-        #    to that will either match properly or fail completely
-        # 2) retrieve only one field at a time, and forget about the
-        #    'IS NULL' - the query will just return no results if there
-        #    are no matches
-        # Clearly, the second option is much better.
-        #
-
-        #
-        # First, we need to run a SELECT on each value_cv entry, and
-        # collate the results. Suppose the multiple-valued flag is true
-        # in the template, and there are three sets of keys in the
-        # database for this query.  The first set of keys has two
-        # results for the first value_cv entry, the second has none, and
-        # the third has one.  Now we need to transform this:
-        #     [(K1a, K2a, V1a),
-        #      (K1a, K2a, V1b),
-        #      (K1c, K2c, V1c)]
-        # to this:
-        #     results[(K1a, K2a)][1] = [V1a, V1b]
-        #     results[(K1c, K2c)][1] = [V1c]
-        # For the second value_cv entry, we might have:
-        #     [(K1a, K2a, V2a),
-        #      (K1b, K2b, V2b),
-        #      (K1b, K2b, V2c),
-        #      (K1c, K2c, V2d)]
-        # which becomes:
-        #     results[(K1a, K2a)][2] = [V2a]
-        #     results[(K1b, K2b)][2] = [V2b, V2c]
-        #     results[(K1c, K2c)][2] = [V2d]
-        # and so on.
-        #
-        results = collections.OrderedDict()
-        for i, cv in enumerate(value_cv):
-            ret = drupal_db_read(db_obj, db_cur, key_cv, [cv])
-            if ret is None:
-                return None
-            for row in ret:
-                if row[0:-1] not in results:
-                    results[row[0:-1]] = {}
-                if i not in results[row[0:-1]]:
-                    results[row[0:-1]][i] = []
-                results[row[0:-1]][i].append(row[-1])
-
-        #
-        # Now we need to re-collate the results into the sort of rows we
-        # would get if we retrieved all of the value_cv entries at once.
-        # Multiple entries should produce Cartesian products, and
-        # missing entries should be replaced with None.  For the example
-        # above, we get:
-        # [(K1a, K2a, V1a, V2a),
-        #  (K1a, K2a, V1b, V2a),
-        #  (K1b, K2b, None, V2b),
-        #  (K1b, K2b, None, V2c),
-        #  (K1c, K2c, V1c, V2d)]
-        #
-        full_rows = []
-        for key_t in results:
-            column_lists = [[x] for x in key_t]
+    # for the query statistics (see db_execute()); the previous value is
+    # restored afterwards, so later queries aren't attributed to this
+    # chain type
+    saved_chain_type = metrics.query_chain_type
+    metrics.query_chain_type = get_drupal_chain_type(key_cv, value_cv)
+    try:
+        if mode == 'read':
+            #
+            # I finally realized that if you try to retrieve multiple fields
+            # simultaneously, and there are bogus rows with deleted = 1,
+            # you will lose entire result rows.  Even a construct like
+            #     'AND (f.deleted = 0 OR f.deleted IS NULL)'
+            # doesn't help, because the column is only NULL if the join
+            # fails entirely.  Moreover, the same problem applies if (for
+            # example) there is a row with the same entity_id but a
+            # different entity_type, so it's not just a question of removing
+            # old/bogus rows from the database.  There are basically two
+            # solutions:
+            # 1) pull out just the matching rows into a temp table, so joins
+            #    to that will either match properly or fail completely
+            # 2) retrieve only one field at a time, and forget about the
+            #    'IS NULL' - the query will just return no results if there
+            #    are no matches
+            # Clearly, the second option is much better.
+            #
+
+            #
+            # First, we need to run a SELECT on each value_cv entry, and
+            # collate the results. Suppose the multiple-valued flag is true
+            # in the template, and there are three sets of keys in the
+            # database for this query.  The first set of keys has two
+            # results for the first value_cv entry, the second has none, and
+            # the third has one.  Now we need to transform this:
+            #     [(K1a, K2a, V1a),
+            #      (K1a, K2a, V1b),
+            #      (K1c, K2c, V1c)]
+            # to this:
+            #     results[(K1a, K2a)][1] = [V1a, V1b]
+            #     results[(K1c, K2c)][1] = [V1c]
+            # For the second value_cv entry, we might have:
+            #     [(K1a, K2a, V2a),
+            #      (K1b, K2b, V2b),
+            #      (K1b, K2b, V2c),
+            #      (K1c, K2c, V2d)]
+            # which becomes:
+            #     results[(K1a, K2a)][2] = [V2a]
+            #     results[(K1b, K2b)][2] = [V2b, V2c]
+            #     results[(K1c, K2c)][2] = [V2d]
+            # and so on.
+            #
+            results = collections.OrderedDict()
+            progress_phase = progress.read_progress_phase()
             for i, cv in enumerate(value_cv):
-                if i not in results[key_t]:
-                    column_lists.append([None])
-                else:
-                    column_lists.append(results[key_t][i])
-            for full_row in itertools.product(*column_lists):
-                full_rows.append(full_row)
-
-        return full_rows
-
-    if mode == 'update':
-        return drupal_db_update(db_obj, db_cur, key_cv, value_cv)
-
-    if mode == 'insert':
-        return drupal_db_insert(db_obj, db_cur, key_cv, value_cv)
-
-    if mode == 'delete':
-        return drupal_db_delete(db_obj, db_cur, scope, key_cv, value_cv)
+                ret = drupal_db_read(db_obj, db_cur, key_cv, [cv])
+                if ret is None:
+                    return None
+                # each field is a separate query, so count the progress
+                # as they finish
+                progress.advance_progress(progress_phase, len(ret))
+                for row in ret:
+                    if row[0:-1] not in results:
+                        results[row[0:-1]] = {}
+                    if i not in results[row[0:-1]]:
+                        results[row[0:-1]][i] = []
+                    results[row[0:-1]][i].append(row[-1])
+
+            #
+            # Now we need to re-collate the results into the sort of rows we
+            # would get if we retrieved all of the value_cv entries at once.
+            # Multiple entries should produce Cartesian products, and
+            # missing entries should be replaced with None.  For the example
+            # above, we get:
+            # [(K1a, K2a, V1a, V2a),
+            #  (K1a, K2a, V1b, V2a),
+            #  (K1b, K2b, None, V2b),
+            #  (K1b, K2b, None, V2c),
+            #  (K1c, K2c, V1c, V2d)]
+            #
+            full_rows = []
+            for key_t in results:
+                column_lists = [[x] for x in key_t]
+                for i, cv in enumerate(value_cv):
+                    if i not in results[key_t]:
+                        column_lists.append([None])
+                    else:
+                        column_lists.append(results[key_t][i])
+                for full_row in itertools.product(*column_lists):
+                    full_rows.append(full_row)
+
+            return full_rows
+
+        if mode == 'update':
+            return drupal_db_update(db_obj, db_cur, key_cv, value_cv)
+
+        if mode == 'insert':
+            return drupal_db_insert(db_obj, db_cur, key_cv, value_cv)
+
+        if mode == 'delete':
+            return drupal_db_delete(db_obj, db_cur, scope, key_cv, value_cv)
+    finally:
+        metrics.query_chain_type = saved_chain_type
 
 
 def drupal_db_read(db_obj, db_cur, key_cv, value_cv):
@@ -2232,7 +3872,7 @@ def drupal_db_read(db_obj, db_cur, key_cv, value_cv):
         see drupal_db_query()
 
     Dependencies:
-        functions: get_drupal_chain_type()
+        functions: get_drupal_chain_type(), key_value_cond()
         modules: sys, nori
 
     """
@@ -2278,8 +3918,12 @@ Exiting.'''.format(*map(nori.pps, [db_obj, db_cur, key_cv, value_cv]))
 
         # handle specified node value
         node_value_cond = ''
+        node_value_args = []
         if len(node_cv) > 2:
-            node_value_cond = 'AND {0} = %s'.format(key_column)
+            node_value_cond, node_value_args = key_value_cond(
+                key_column, node_value
+            )
+            node_value_cond = 'AND ' + node_value_cond
 
         field_idents = {}
         field_value_types = {}
@@ -2364,8 +4008,7 @@ ORDER BY node.title, node.nid, {7}
                    ', '.join(v_order_columns))
         )
         query_args = [node_type]
-        if len(node_cv) > 2:
-            query_args.append(node_value)
+        query_args += node_value_args
         query_args += field_values
 
     #
@@ -2389,8 +4032,12 @@ ORDER BY node.title, node.nid, {7}
 
         # handle specified key-node value
         k_node_value_cond = ''
+        k_node_value_args = []
         if len(k_node_cv) > 2:
-            k_node_value_cond = 'AND {0} = %s'.format(node_key_column)
+            k_node_value_cond, k_node_value_args = key_value_cond(
+                node_key_column, k_node_value
+            )
+            k_node_value_cond = 'AND ' + k_node_value_cond
 
         # relation details
         relation_cv = key_cv[1]
@@ -2525,8 +4172,7 @@ ORDER BY k_node.title, k_node.nid, e1.entity_id, v_node.title, v_node.nid
                    v_node_value_cond)
         )
         query_args = [k_node_type]
-        if len(k_node_cv) > 2:
-            query_args.append(k_node_value)
+        query_args += k_node_value_args
         query_args.append(relation_type)
         if len(relation_ident) > 2 and len(relation_cv) > 2:
             query_args.append(relation_value)
@@ -2556,8 +4202,12 @@ ORDER BY k_node.title, k_node.nid, e1.entity_id, v_node.title, v_node.nid
 
         # handle specified node1 value
         node1_value_cond = ''
+        node1_value_args = []
         if len(node1_cv) > 2:
-            node1_value_cond = 'AND {0} = %s'.format(node1_key_column)
+            node1_value_cond, node1_value_args = key_value_cond(
+                node1_key_column, node1_value
+            )
+            node1_value_cond = 'AND ' + node1_value_cond
 
         # relation details
         relation_cv = key_cv[1]
@@ -2757,8 +4407,7 @@ ORDER BY node1.title, node1.nid, e1.entity_id, {14}
                    ', '.join(v_order_columns))
         )
         query_args = [node1_type]
-        if len(node1_cv) > 2:
-            query_args.append(node1_value)
+        query_args += node1_value_args
         query_args.append(relation_type)
         if len(relation_ident) > 2 and len(relation_cv) > 2:
             query_args.append(relation_value)
@@ -2788,8 +4437,12 @@ ORDER BY node1.title, node1.nid, e1.entity_id, {14}
 
         # handle specified node value
         node_value_cond = ''
+        node_value_args = []
         if len(node_cv) > 2:
-            node_value_cond = 'AND {0} = %s'.format(key_column)
+            node_value_cond, node_value_args = key_value_cond(
+                key_column, node_value
+            )
+            node_value_cond = 'AND ' + node_value_cond
 
         # fc details
         fc_cv = key_cv[1]
@@ -2920,18 +4573,17 @@ ORDER BY node.title, node.nid, fcf.delta, {11}
                    ', '.join(v_order_columns))
         )
         query_args = [node_type]
-        if len(node_cv) > 2:
-            query_args.append(node_value)
+        query_args += node_value_args
         if len(fc_cv) > 2:
             query_args.append(fc_value)
         query_args += field_values
 
     ######################## execute the query ########################
 
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -2953,7 +4605,9 @@ def drupal_db_update(db_obj, db_cur, key_cv, value_cv):
         functions: get_drupal_chain_type(), get_drupal_node_ids(),
                    get_drupal_relation_ids(),
                    update_drupal_node_timestamp(),
-                   update_drupal_relation_timestamp()
+                   update_drupal_relation_timestamp(),
+                   drupal_update_lookups_needed(),
+                   record_drupal_updated_entities()
         modules: sys, nori
 
     """
@@ -3501,8 +5155,8 @@ AND f.deleted = 0
     ####################### execute the queries #######################
 
     for dr_str in ['data', 'revision']:
-        if not db_obj.execute(db_cur, query_str[dr_str].strip(),
-                              query_args[dr_str], has_results=False):
+        if not db_execute(db_obj, db_cur, query_str[dr_str].strip(),
+                          query_args[dr_str], has_results=False):
             # won't be reached currently; script will exit on errors
             db_obj.rollback()  # ignore errors
             db_obj.autocommit(db_ac)
@@ -3523,9 +5177,149 @@ AND f.deleted = 0
         )
         return drupal_db_insert(db_obj, db_cur, key_cv, value_cv)
 
+    # note the changes for cache clearing, unless the timestamp
+    # callbacks will do it (or nothing will use them)
+    if drupal_update_lookups_needed():
+        record_drupal_updated_entities(db_obj, db_cur, chain_type, key_cv,
+                                       value_cv)
+
     return True
 
 
+def drupal_update_lookups_needed():
+
+    """
+    Check if the entities changed by in-place Drupal updates have to be
+    looked up, for targeted cache clearing.
+
+    The lookups cost extra queries, so they're only done if the
+    destination's global callbacks include drupal_cache_callback() in
+    'targeted' mode, and the current template's callbacks don't include
+    the timestamp callbacks (which look up and record the same entities
+    anyway; see update_drupal_node_timestamp()).
+
+    Returns True or False.
+
+    Dependencies:
+        config settings: reverse, drupal_cache_mode, templates,
+                         (source/dest)_global_change_callbacks,
+                         (source/dest)_template_batch_callbacks,
+                         (source/dest)_template_change_callbacks
+        globals: metrics.phase_stack, (some of) T_*
+        functions: drupal_cache_callback(), drupal_timestamp_callback(),
+                   drupal_timestamp_batch_callback()
+        modules: nori, metrics
+
+    """
+
+    if nori.core.cfg['drupal_cache_mode'] != 'targeted':
+        return False
+    side = 'source' if nori.core.cfg['reverse'] else 'dest'
+    global_cbs = nori.core.cfg[side + '_global_change_callbacks']
+    if drupal_cache_callback not in [cb[0] for cb in global_cbs]:
+        return False
+    t_index = metrics.phase_stack[-1][0] if metrics.phase_stack else None
+    if t_index is None:
+        return True
+    template = nori.core.cfg['templates'][t_index]
+    if side == 'dest':
+        t_cbs = template[T_D_BATCH_CB_KEY] + template[T_D_CHANGE_CB_KEY]
+    else:
+        t_cbs = template[T_S_BATCH_CB_KEY] + template[T_S_CHANGE_CB_KEY]
+    cb_funcs = [cb[0] for cb in
+                (t_cbs + nori.core.cfg[side + '_template_batch_callbacks'] +
+                 nori.core.cfg[side + '_template_change_callbacks'])]
+    return not (drupal_timestamp_batch_callback in cb_funcs or
+                drupal_timestamp_callback in cb_funcs)
+
+
+def record_drupal_updated_entities(db_obj, db_cur, chain_type, key_cv,
+                                   value_cv):
+
+    """
+    Record the Drupal entities changed by an in-place update.
+
+    Used by drupal_db_update(), whose UPDATE queries don't return the
+    IDs of the rows they change; the IDs are looked up here, the same way
+    as for the timestamp updates (see drupal_db_update_timestamps()), and
+    only once per entity per run.  If a lookup fails, all entities of the
+    relevant type are recorded instead.
+
+    Parameters:
+        chain_type: the chain type, from get_drupal_chain_type()
+        see drupal_db_query() for the rest
+
+    Dependencies:
+        globals: drupal_updated_keys
+        functions: get_drupal_node_ids(), get_drupal_relation_ids(),
+                   get_drupal_fc_ids(), record_drupal_entity()
+
+    """
+
+    # the entities are determined by the keys (and, for n-r-n, by the
+    # value); see drupal_timestamp_batch_callback()
+    if chain_type == 'n-r-n':
+        update_key = (chain_type, repr(key_cv), repr(value_cv[0]))
+    else:
+        update_key = (chain_type, repr(key_cv))
+    if update_key in drupal_updated_keys:
+        return
+    drupal_updated_keys.add(update_key)
+
+    #
+    # node -> field (including term references)
+    #
+    if chain_type == 'n-f':
+        ret = get_drupal_node_ids(db_obj, db_cur, key_cv[0])
+        if ret is None:
+            record_drupal_entity('node', None)
+        elif ret:
+            record_drupal_entity('node', ret[0][0])
+
+    #
+    # node -> relation -> node, and
+    # node -> relation & node -> relation_field (incl. term refs)
+    #
+    elif chain_type in ('n-r-n', 'n-rn-rf'):
+        if chain_type == 'n-r-n':
+            node2_cv = value_cv[0]
+        else:
+            node2_cv = key_cv[2]
+        ret1 = get_drupal_node_ids(db_obj, db_cur, key_cv[0])
+        ret2 = get_drupal_node_ids(db_obj, db_cur, node2_cv)
+        if ret1 is None or ret2 is None:
+            record_drupal_entity('relation', None)
+            return
+        if not (ret1 and ret2):
+            return
+        # as elsewhere, only the first matching node is used
+        ret = get_drupal_relation_ids(db_obj, db_cur, 'node', ret1[0][0],
+                                      key_cv[1], 'node', ret2[0][0])
+        if ret is None:
+            record_drupal_entity('relation', None)
+        elif ret:
+            record_drupal_entity('relation', ret[0][0])
+
+    #
+    # node -> fc -> field (including term references)
+    #
+    elif chain_type == 'n-fc-f':
+        node_cv = key_cv[0]
+        ret = get_drupal_node_ids(db_obj, db_cur, node_cv)
+        if ret is None:
+            record_drupal_entity('field_collection_item', None)
+            return
+        if not ret:
+            return
+        n_id, n_vid = ret[0]
+        ret = get_drupal_fc_ids(db_obj, db_cur, 'node', node_cv[0][1],
+                                n_id, n_vid, key_cv[1])
+        if ret is None:
+            record_drupal_entity('field_collection_item', None)
+        elif ret:
+            record_drupal_entity('field_collection_item', ret[0][0])
+
+
 def drupal_db_insert(db_obj, db_cur, key_cv, value_cv):
 
     """
@@ -4405,7 +6199,8 @@ def drupal_db_update_timestamps(db_obj, db_cur, mode, scope, key_cv,
         functions: get_drupal_node_ids_timestamp(),
                    update_drupal_node_timestamp(),
                    get_drupal_relation_ids_timestamp(),
-                   update_drupal_relation_timestamp()
+                   update_drupal_relation_timestamp(),
+                   record_drupal_entity()
 
     """
 
@@ -4514,6 +6309,9 @@ Exiting.'''.format(*map(nori.pps, [db_obj, db_cur, key_cv, value_cv]))
             if not update_drupal_node_timestamp(db_obj, db_cur, ret[0],
                                                 ret[1]):
                 return False
+        # the FC item IDs aren't available here (field collections don't
+        # have timestamps)
+        record_drupal_entity('field_collection_item', None)
 
     return True
 
@@ -4535,11 +6333,59 @@ def drupal_timestamp_callback(t_index, mode, scope, s_row, d_row,
                                        new_value_cv)
 
 
+def drupal_timestamp_batch_callback(t_index, changes, d_db, d_cur):
+
+    """
+    A batch wrapper around drupal_db_update_timestamps().
+
+    Interfaces between what's passed to batch callbacks and what the
+    function actually needs.  Changes that would update the same
+    timestamps (e.g., several field values on the same node) are only
+    processed once.
+
+    Parameters:
+        see the description of the source_template_batch_callbacks
+        setting
+
+    Dependencies:
+        functions: get_drupal_chain_type(), drupal_db_update_timestamps()
+
+    """
+
+    done = set()
+    ret = True
+    for mode, scope, s_row, d_row, new_key_cv, new_value_cv in changes:
+        # work out which entities' timestamps will be touched; see
+        # drupal_db_update_timestamps()
+        chain_type = get_drupal_chain_type(new_key_cv, new_value_cv)
+        if chain_type in ['n-f', 'n-fc-f']:
+            ts_id = (chain_type, repr(new_key_cv[0]))
+        elif chain_type == 'n-r-n':
+            ts_id = (chain_type, repr(new_key_cv), repr(new_value_cv[0]),
+                     mode != 'delete')
+        elif chain_type == 'n-rn-rf':
+            ts_id = (chain_type, repr(new_key_cv),
+                     mode != 'delete' or scope != 'k')
+        else:
+            ts_id = None
+        if ts_id is not None:
+            if ts_id in done:
+                continue
+            done.add(ts_id)
+        if not drupal_db_update_timestamps(d_db, d_cur, mode, scope,
+                                           new_key_cv, new_value_cv):
+            ret = False
+    return ret
+
+
 #
 # Note: even if we got some of the info the functions below retrieve
 # when we did the original SELECTs, it's possible for one template
 # to cause an insert that won't be picked up on by a later one
-# unless we check again.
+# unless we check again.  For the same reason, the ID lookups below
+# (which are mostly done right after inserts) always use the connection
+# they're given, never a read replica; only the schema and term lookups
+# are routed (see pools.get_read_db()).
 #
 
 def get_drupal_node_ids(db_obj, db_cur, node_cv):
@@ -4588,10 +6434,10 @@ AND {0} = %s
     query_args = [node_type, node_value]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -4746,10 +6592,10 @@ AND e2.deleted = 0
         query_args.append(relation_value)
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -4879,10 +6725,10 @@ AND {1} = %s
     query_args = [entity_type, bundle, entity_id, revision_id, fc_value]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -4932,10 +6778,10 @@ GROUP BY entity_type, bundle, entity_id, revision_id
     query_args = [entity_type, bundle, entity_id, revision_id]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -4964,6 +6810,8 @@ def get_drupal_field_list(db_obj, db_cur, entity_type, bundle):
     Returns None on error, an empty array if there are no results, or
     an array of field name strings.
 
+    Successful results are cached in drupal_lookup_cache.
+
     Parameters:
         db_obj: the database connection object to use
         db_cur: the database cursor object to use
@@ -4971,8 +6819,20 @@ def get_drupal_field_list(db_obj, db_cur, entity_type, bundle):
         bundle: the bundle (e.g., node content type) of the entity to
                 check
 
+    Dependencies:
+        globals: drupal_lookup_cache
+        functions: pools.get_read_db()
+        modules: nori, pools
+
     """
 
+    cache_key = ('field_list', id(db_obj), entity_type, bundle)
+    if cache_key in drupal_lookup_cache:
+        return drupal_lookup_cache[cache_key]
+
+    # this doesn't need to see the run's changes, so a replica will do
+    db_obj, db_cur = pools.get_read_db(db_obj, db_cur, False)
+
     # query string and arguments
     query_str = (
 '''
@@ -4988,16 +6848,18 @@ AND fc.deleted = 0
     query_args = [entity_type, bundle]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
-    if not ret[1]:
-        return []
-
-    return [x[0][6:] for x in ret[1] if x[0].startswith('field_')]
+    field_list = []
+    if ret[1]:
+        field_list = [x[0][6:] for x in ret[1]
+                      if x[0].startswith('field_')]
+    drupal_lookup_cache[cache_key] = field_list
+    return field_list
 
 
 def get_drupal_field_defaults(db_obj, db_cur, entity_type, bundle):
@@ -5018,10 +6880,14 @@ def get_drupal_field_defaults(db_obj, db_cur, entity_type, bundle):
                 check
 
     Dependencies:
-        modules: sys, re, nori
+        functions: pools.get_read_db()
+        modules: sys, re, nori, pools
 
     """
 
+    # this doesn't need to see the run's changes, so a replica will do
+    db_obj, db_cur = pools.get_read_db(db_obj, db_cur, False)
+
     # query string and arguments
     query_str = (
 '''
@@ -5037,10 +6903,10 @@ AND fc.deleted = 0
     query_args = [entity_type, bundle]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -5085,16 +6951,27 @@ def get_drupal_field_cardinality(db_obj, db_cur, field_name):
     Returns None on error, an empty array if there are no results, or
     a single row tuple.
 
+    Successful results are cached in drupal_lookup_cache.
+
     Parameters:
         db_obj: the database connection object to use
         db_cur: the database cursor object to use
         field_name: the name of the field
 
     Dependencies:
-        modules: nori
+        globals: drupal_lookup_cache
+        functions: pools.get_read_db()
+        modules: nori, pools
 
     """
 
+    cache_key = ('field_cardinality', id(db_obj), field_name)
+    if cache_key in drupal_lookup_cache:
+        return drupal_lookup_cache[cache_key]
+
+    # this doesn't need to see the run's changes, so a replica will do
+    db_obj, db_cur = pools.get_read_db(db_obj, db_cur, False)
+
     # query string and arguments
     query_str = (
 '''
@@ -5107,13 +6984,14 @@ AND deleted = 0
     query_args = ['field_' + field_name]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
+        drupal_lookup_cache[cache_key] = []
         return []
     # in theory, Drupal field names are unique, but it's not enforced in
     # the database, so add a sanity check
@@ -5123,6 +7001,7 @@ AND deleted = 0
             format(nori.pps(field_name))
         )
         return None
+    drupal_lookup_cache[cache_key] = ret[1][0]
     return ret[1][0]
 
 
@@ -5134,6 +7013,9 @@ def get_drupal_term_id(db_obj, db_cur, vocab_name, term_name):
     Returns None on error, an empty array if there are no results, or
     a single row tuple.
 
+    Terms that are found are cached in drupal_lookup_cache (missing
+    terms aren't, in case they're added).
+
     Parameters:
         db_obj: the database connection object to use
         db_cur: the database cursor object to use
@@ -5141,10 +7023,19 @@ def get_drupal_term_id(db_obj, db_cur, vocab_name, term_name):
         term_name: the name of the term
 
     Dependencies:
-        modules: nori
+        globals: drupal_lookup_cache
+        functions: pools.get_read_db()
+        modules: nori, pools
 
     """
 
+    cache_key = ('term_id', id(db_obj), vocab_name, term_name)
+    if cache_key in drupal_lookup_cache:
+        return drupal_lookup_cache[cache_key]
+
+    # this doesn't need to see the run's changes, so a replica will do
+    db_obj, db_cur = pools.get_read_db(db_obj, db_cur, False)
+
     # query string and arguments
     query_str = (
 '''
@@ -5159,10 +7050,10 @@ AND t.name = %s
     query_args = [vocab_name, term_name]
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=True):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
     if not ret[1]:
@@ -5174,9 +7065,19 @@ AND t.name = %s
                                                      vocab_name]))
         )
         return None
+    drupal_lookup_cache[cache_key] = ret[1][0]
     return ret[1][0]
 
 
+def clear_drupal_lookup_cache():
+    """
+    Clear the cached Drupal lookup results (see drupal_lookup_cache).
+    Dependencies:
+        globals: drupal_lookup_cache
+    """
+    drupal_lookup_cache.clear()
+
+
 def update_drupal_node_timestamp(db_obj, db_cur, nid, vid):
 
     """
@@ -5191,10 +7092,14 @@ def update_drupal_node_timestamp(db_obj, db_cur, nid, vid):
         vid: the node revision ID
 
     Dependencies:
+        functions: record_drupal_entity()
         modules: time
 
     """
 
+    # note the change for cache clearing
+    record_drupal_entity('node', nid)
+
     # prepare for a transaction
     db_ac = db_obj.autocommit(None)
     db_obj.autocommit(False)
@@ -5216,8 +7121,8 @@ AND vid = %s
     # execute the queries
     for dr_str, col_name in [('', 'changed'), ('_revision', 'timestamp')]:
         query_str = query_str_raw.format(dr_str, col_name)
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             # won't be reached currently; script will exit on errors
             db_obj.rollback()  # ignore errors
             db_obj.autocommit(db_ac)
@@ -5243,10 +7148,14 @@ def update_drupal_relation_timestamp(db_obj, db_cur, rid, vid):
         vid: the relation revision ID
 
     Dependencies:
+        functions: record_drupal_entity()
         modules: time
 
     """
 
+    # note the change for cache clearing
+    record_drupal_entity('relation', rid)
+
     # prepare for a transaction
     db_ac = db_obj.autocommit(None)
     db_obj.autocommit(False)
@@ -5268,8 +7177,8 @@ AND vid = %s
     # execute the queries
     for dr_str in ['', '_revision']:
         query_str = query_str_raw.format(dr_str)
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             # won't be reached currently; script will exit on errors
             db_obj.rollback()  # ignore errors
             db_obj.autocommit(db_ac)
@@ -5332,8 +7241,8 @@ VALUES
 '''
     )
     query_args = [relation_type, curr_time, curr_time]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -5358,8 +7267,8 @@ VALUES
 '''
     )
     query_args = [rid, relation_type, curr_time]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -5383,8 +7292,8 @@ WHERE rid = %s
 '''
     )
     query_args = [vid, rid]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -5408,8 +7317,8 @@ VALUES
             )
             query_args = [relation_type, rid, vid, i, ep_entity_type,
                           ep_entity_id, i]
-            if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                                  has_results=False):
+            if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                              has_results=False):
                 # won't be reached currently; script will exit on errors
                 db_obj.rollback()  # ignore errors
                 db_obj.autocommit(db_ac)
@@ -5510,8 +7419,8 @@ VALUES
 '''
         )
         query_args = ['field_' + fc_type, fc_value]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -5537,8 +7446,8 @@ VALUES
 '''
     )
     query_args = [fcid]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -5562,8 +7471,8 @@ WHERE item_id = %s
 '''
     )
     query_args = [vid, fcid]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -5692,7 +7601,8 @@ def insert_drupal_field(db_obj, db_cur, entity_type, bundle, entity_id,
                   handling transaction management
 
     Dependencies:
-        functions: drupal_field_ok_to_insert(), get_drupal_term_id()
+        functions: drupal_field_ok_to_insert(), get_drupal_term_id(),
+                   record_drupal_entity()
         modules: operator, nori
 
     """
@@ -5708,6 +7618,9 @@ def insert_drupal_field(db_obj, db_cur, entity_type, bundle, entity_id,
     field_value = field_cv[2]
     field_name = field_ident[1]
 
+    # note the change for cache clearing
+    record_drupal_entity(entity_type, entity_id)
+
     # room to insert another entry?
     ins_ok = drupal_field_ok_to_insert(db_obj, db_cur, entity_type, bundle,
                                        entity_id, revision_id, field_name)
@@ -5770,8 +7683,8 @@ VALUES
         if extra_values:
             query_args += extra_values
 
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             # won't be reached currently; script will exit on errors
             if not no_trans:
                 db_obj.rollback()  # ignore errors
@@ -5917,8 +7830,8 @@ AND revision_id = %s
                 format(table_infix)
             )
         query_args = [relation_type, relation_id, relation_rev]
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             # won't be reached currently; script will exit on errors
             db_obj.rollback()  # ignore errors
             db_obj.autocommit(db_ac)
@@ -5936,8 +7849,8 @@ AND vid = %s
             format(table_suffix)
         )
         query_args = [relation_type, relation_id, relation_rev]
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             # won't be reached currently; script will exit on errors
             db_obj.rollback()  # ignore errors
             db_obj.autocommit(db_ac)
@@ -6064,8 +7977,8 @@ AND field_name = %s
 '''
     )
     query_args = [fc_id, fc_rev, 'field_' + fc_type]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -6078,8 +7991,8 @@ AND revision_id = %s
 '''
     )
     query_args = [fc_id, fc_rev]
-    if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                          has_results=False):
+    if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                      has_results=False):
         # won't be reached currently; script will exit on errors
         db_obj.rollback()  # ignore errors
         db_obj.autocommit(db_ac)
@@ -6123,7 +8036,7 @@ def delete_drupal_field(db_obj, db_cur, entity_type, bundle, entity_id,
 
     Dependencies:
         config settings: delayed_drupal_deletes
-        functions: get_drupal_term_id()
+        functions: get_drupal_term_id(), record_drupal_entity()
         modules: operator, nori
 
     """
@@ -6133,6 +8046,9 @@ def delete_drupal_field(db_obj, db_cur, entity_type, bundle, entity_id,
     if extra_data is None:
         extra_data = []
 
+    # note the change for cache clearing
+    record_drupal_entity(entity_type, entity_id)
+
     # field details
     field_ident = field_cv[0]
     field_value_type = field_cv[1]
@@ -6214,8 +8130,8 @@ AND revision_id = %s
         if extra_values:
             query_args += extra_values
 
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             # won't be reached currently; script will exit on errors
             if not no_trans:
                 db_obj.rollback()  # ignore errors
@@ -6253,10 +8169,10 @@ WHERE name='site_readonly'
 '''
         )
         query_args = []
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=True):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=True):
             return None
-        ret = db_obj.fetchall(db_cur)
+        ret = db_fetchall(db_obj, db_cur)
         if not ret[0]:
             return None
         if not ret[1]:
@@ -6270,8 +8186,8 @@ VALUES
 '''
             )
             query_args = ['site_readonly', 'i:0;']
-            if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                                  has_results=False):
+            if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                              has_results=False):
                 return None
             return False
         return (ret[1][0][0] == 'i:1;')
@@ -6284,8 +8200,8 @@ WHERE name='site_readonly'
 '''
         )
         query_args = ['i:1;' if what else 'i:0;']
-        if not db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False):
+        if not db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False):
             return False
 
         query_str = (
@@ -6294,13 +8210,16 @@ DELETE FROM cache_bootstrap WHERE cid='variables'
 '''
         )
         query_args = []
-        return db_obj.execute(db_cur, query_str.strip(), query_args,
-                              has_results=False)
+        return db_execute(db_obj, db_cur, query_str.strip(), query_args,
+                          has_results=False)
 
 
 def pre_action_drupal_readonly(s_db, s_cur, d_db, d_cur):
     """
     Wrapper around drupal_readonly_status() for pre-action callbacks.
+    If the read-only window is limited to the write phase (see
+    write_phase_deferred()), the current status is only recorded; see
+    write_phase_drupal_readonly().
     Parameters:
         s_db: the source-database connection object to use
         s_cur: the source-database cursor object to use
@@ -6309,7 +8228,7 @@ def pre_action_drupal_readonly(s_db, s_cur, d_db, d_cur):
     Dependencies:
         config settings: reverse, source_type, dest_type
         globals: s_drupal_readonly, d_drupal_readonly
-        functions: drupal_readonly_status()
+        functions: drupal_readonly_status(), write_phase_deferred()
         modules: sys, nori
     """
     global s_drupal_readonly, d_drupal_readonly
@@ -6326,6 +8245,8 @@ def pre_action_drupal_readonly(s_db, s_cur, d_db, d_cur):
                 "Error: can't set Drupal site read-only; exiting."
             )
             sys.exit(nori.core.exitvals['drupal']['num'])
+        elif write_phase_deferred():
+            return True
         else:
             return drupal_readonly_status(s_db, s_cur, True)
     if d_type == 'drupal':
@@ -6335,10 +8256,37 @@ def pre_action_drupal_readonly(s_db, s_cur, d_db, d_cur):
                 "Error: can't set Drupal site read-only; exiting."
             )
             sys.exit(nori.core.exitvals['drupal']['num'])
+        elif write_phase_deferred():
+            return True
         else:
             return drupal_readonly_status(d_db, d_cur, True)
 
 
+def write_phase_drupal_readonly(s_db, s_cur, d_db, d_cur):
+    """
+    Make Drupal sites read-only at the start of a deferred write phase.
+    Only affects sites whose status was recorded by
+    pre_action_drupal_readonly().
+    Parameters:
+        see pre_action_drupal_readonly()
+    Dependencies:
+        globals: s_drupal_readonly, d_drupal_readonly
+        functions: drupal_readonly_status()
+        modules: sys, nori
+    """
+    for db_obj, db_cur, prev_status in [(s_db, s_cur, s_drupal_readonly),
+                                        (d_db, d_cur, d_drupal_readonly)]:
+        if prev_status is None:
+            continue
+        nori.core.status_logger.info('Setting Drupal site read-only...')
+        if not drupal_readonly_status(db_obj, db_cur, True):
+            nori.core.email_logger.error(
+                "Error: can't set Drupal site read-only; exiting."
+            )
+            sys.exit(nori.core.exitvals['drupal']['num'])
+        nori.core.status_logger.info('Drupal site is now read-only.')
+
+
 def post_action_drupal_readonly(s_db, s_cur, d_db, d_cur):
     """
     Wrapper around drupal_readonly_status() for post-action callbacks.
@@ -6370,6 +8318,18 @@ def post_action_drupal_readonly(s_db, s_cur, d_db, d_cur):
     return True
 
 
+def record_drupal_entity(entity_type, entity_id):
+    """
+    Note that a Drupal entity has been changed, for cache clearing.
+    Parameters:
+        entity_type: the entity type (e.g., 'node')
+        entity_id: the entity ID, or None for all entities of the type
+    Dependencies:
+        globals: drupal_touched_entities
+    """
+    drupal_touched_entities[(entity_type, entity_id)] = True
+
+
 def clear_drupal_cache(db_obj, db_cur):
     """
     Clear all caches in a Drupal database.
@@ -6382,25 +8342,121 @@ def clear_drupal_cache(db_obj, db_cur):
         return False
     for table in ret[1]:
         if table[0].startswith('cache'):
-            ret = db_obj.execute(db_cur,
-                                 'DELETE FROM {0};'.format(table[0]),
-                                 has_results=False)
+            ret = db_execute(db_obj, db_cur,
+                             'DELETE FROM {0};'.format(table[0]),
+                             has_results=False)
             if not ret:
                 return False
     return True
 
 
-def drupal_cache_callback(d_db, d_cur):
+def clear_drupal_cache_targeted(db_obj, db_cur):
+
     """
-    A wrapper around clear_drupal_cache().
-    Interfaces between what's passed to callbacks and what the function
-    actually needs.
+    Clear the Drupal caches affected by the entities changed in a sync.
+
+    Deletes the cache_field entries (and the entitycache module's
+    cache_entity_* entries, if any) for the entities in
+    drupal_touched_entities, then empties the bins listed in the
+    drupal_cache_flush_bins setting.  If no entities have been recorded,
+    calls clear_drupal_cache() instead.
+
+    Returns True (success) / False (failure).
+
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+
+    Dependencies:
+        config settings: drupal_cache_flush_bins
+        globals: drupal_touched_entities, DRUPAL_CACHE_CHUNK_SIZE
+        functions: clear_drupal_cache()
+        modules: collections, nori
+
+    """
+
+    if not drupal_touched_entities:
+        return clear_drupal_cache(db_obj, db_cur)
+
+    ret = db_obj.get_table_list(db_cur)
+    if not ret[0]:
+        return False
+    tables = set([table[0] for table in ret[1]])
+
+    # group the entity IDs by type
+    entity_ids = collections.OrderedDict()
+    for entity_type, entity_id in drupal_touched_entities:
+        if entity_type not in entity_ids:
+            entity_ids[entity_type] = []
+        if entity_ids[entity_type] is None:
+            continue
+        if entity_id is None:
+            entity_ids[entity_type] = None
+        else:
+            entity_ids[entity_type].append(entity_id)
+
+    # assemble the list of (table, cid prefix, IDs) to clear
+    to_clear = []
+    for entity_type, ids in entity_ids.items():
+        if 'cache_field' in tables:
+            to_clear.append(('cache_field', 'field:{0}:'.format(entity_type),
+                             ids))
+        if 'cache_entity_{0}'.format(entity_type) in tables:
+            to_clear.append(('cache_entity_{0}'.format(entity_type), '',
+                             ids))
+
+    # clear the entries
+    for table, prefix, ids in to_clear:
+        if ids is None:
+            if prefix:
+                query_str = 'DELETE FROM {0} WHERE cid LIKE %s'.format(table)
+                query_args = [prefix + '%']
+            else:
+                query_str = 'TRUNCATE TABLE {0}'.format(table)
+                query_args = []
+            if not db_execute(db_obj, db_cur, query_str, query_args,
+                              has_results=False):
+                return False
+            continue
+        for i in range(0, len(ids), DRUPAL_CACHE_CHUNK_SIZE):
+            chunk = ids[i:i + DRUPAL_CACHE_CHUNK_SIZE]
+            query_str = (
+                'DELETE FROM {0} WHERE cid IN ({1})' .
+                format(table, ', '.join(['%s'] * len(chunk)))
+            )
+            query_args = [prefix + str(entity_id) for entity_id in chunk]
+            if not db_execute(db_obj, db_cur, query_str, query_args,
+                              has_results=False):
+                return False
+
+    # flush the bins
+    for bin_name in nori.core.cfg['drupal_cache_flush_bins']:
+        if bin_name not in tables:
+            continue
+        if not db_execute(db_obj, db_cur,
+                          'TRUNCATE TABLE {0}'.format(bin_name),
+                          has_results=False):
+            return False
+
+    drupal_touched_entities.clear()
+    return True
+
+
+def drupal_cache_callback(d_db, d_cur):
+    """
+    A wrapper around clear_drupal_cache_targeted() / clear_drupal_cache().
+    Interfaces between what's passed to callbacks and what the functions
+    actually need.
     Parameters:
         see the description of the source_global_change_callbacks
         setting
     Dependencies:
-        functions: clear_drupal_cache()
+        config settings: drupal_cache_mode
+        functions: clear_drupal_cache_targeted(), clear_drupal_cache()
+        modules: nori
     """
+    if nori.core.cfg['drupal_cache_mode'] == 'targeted':
+        return clear_drupal_cache_targeted(d_db, d_cur)
     return clear_drupal_cache(d_db, d_cur)
 
 
@@ -6561,8 +8617,11 @@ def log_diff(template_index, exists_in_source, source_row, exists_in_dest,
     destination databases, after applying the value of the 'reverse'
     setting.
 
-    Returns a tuple: (the key used in diff_dict, the index added to
-                      the list).
+    The diff is counted in diff_counts.
+
+    Returns a tuple: (the group key used in diff_store, the index added
+                      to the group), or (None, None) if the action is
+                      'count' (see sample_diff()).
 
     Parameters:
         template_index: the index of the relevant template in the
@@ -6584,193 +8643,499 @@ def log_diff(template_index, exists_in_source, source_row, exists_in_dest,
                   tuple from the destination DB's query function)
 
     Dependencies:
-        config settings: templates, report_order
-        globals: diff_dict, T_NAME_KEY
-        modules: nori
+        config settings: action, templates, report_order
+        globals: diff_store, metrics.diff_counts, T_NAME_KEY
+        functions: sample_diff(), render_diff_category()
+        classes: LazyPps, LazyFormat
+        modules: collections, nori, metrics
 
     """
 
+    if template_index not in metrics.diff_counts:
+        metrics.diff_counts[template_index] = collections.OrderedDict()
+    counts = metrics.diff_counts[template_index]
+    category = render_diff_category(exists_in_source, exists_in_dest)
+    counts[category] = counts.get(category, 0) + 1
+
+    if nori.core.cfg['action'] == 'count':
+        sample_diff(template_index, category, counts[category],
+                    exists_in_source, source_row, exists_in_dest,
+                    dest_row)
+        return (None, None)
+
     template = nori.core.cfg['templates'][template_index]
 
     if nori.core.cfg['report_order'] == 'template':
-        if template_index not in diff_dict:
-            diff_dict[template_index] = []
-        diff_dict[template_index].append((exists_in_source, source_row,
-                                          exists_in_dest, dest_row, None))
-        diff_k = template_index
-        diff_i = len(diff_dict[template_index]) - 1
+        group_key = template_index
     elif nori.core.cfg['report_order'] == 'keys':
-        keys_str = ()
         if source_row is not None:
             num_keys = source_row[0]
             source_data = source_row[1]
-            keys_tuple = source_data[0:num_keys]
+            group_key = tuple(source_data[0:num_keys])
         elif dest_row is not None:
             num_keys = dest_row[0]
             dest_data = dest_row[1]
-            keys_tuple = dest_data[0:num_keys]
-        if keys_tuple not in diff_dict:
-            diff_dict[keys_tuple] = []
-        diff_dict[keys_tuple].append((template_index, exists_in_source,
-                                      source_row, exists_in_dest, dest_row,
-                                      None))
-        diff_k = keys_tuple
-        diff_i = len(diff_dict[keys_tuple]) - 1
+            group_key = tuple(dest_data[0:num_keys])
+    diff_k, diff_i = diff_store.add(group_key, template_index,
+                                    exists_in_source, source_row,
+                                    exists_in_dest, dest_row)
 
+    # only pretty-print the rows if the message is actually logged
     if exists_in_source:
-        source_str = nori.pps(source_row[1])
+        source_str = LazyPps(source_row[1])
     elif exists_in_source is None:
         source_str = '[no value match in source database]'
     else:
         source_str = '[no key match in source database]'
     if exists_in_dest:
-        dest_str = nori.pps(dest_row[1])
+        dest_str = LazyPps(dest_row[1])
     elif exists_in_dest is None:
         dest_str = '[no value match in destination database]'
     else:
         dest_str = '[no key match in destination database]'
 
-    nori.core.status_logger.info(
-        'Diff found for template {0} ({1}):\nS: {2}\nD: {3}' .
-        format(template_index, nori.pps(template[T_NAME_KEY]),
-               source_str, dest_str)
-    )
+    nori.core.status_logger.info(LazyFormat(
+        'Diff found for template {0} ({1}):\nS: {2}\nD: {3}',
+        template_index, LazyPps(template[T_NAME_KEY]), source_str, dest_str
+    ))
     return (diff_k, diff_i)
 
 
+def render_diff_category(exists_in_source, exists_in_dest):
+    """
+    Render the category of a diff for the 'count' action.
+    Returns a string.
+    Parameters:
+        exists_in_source, exists_in_dest: see log_diff()
+    """
+    if exists_in_dest is False:
+        return 'no key in dest'
+    if exists_in_source is False:
+        return 'no key in source'
+    if exists_in_dest is None:
+        return 'no value match in dest'
+    if exists_in_source is None:
+        return 'no value match in source'
+    return 'value differs'
+
+
+def sample_diff(template_index, category, num, exists_in_source,
+                source_row, exists_in_dest, dest_row):
+
+    """
+    Sample a difference between the two databases (for the 'count'
+    action).
+
+    The diff itself isn't kept, except possibly as one of the sample
+    diffs for its template and category (a reservoir sample of at most
+    count_sample_size diffs).
+
+    Parameters:
+        category: the diff's category (see render_diff_category())
+        num: the number of diffs counted so far in the category,
+             including this one (see diff_counts)
+        see log_diff() for the rest
+
+    Dependencies:
+        config settings: count_sample_size
+        globals: diff_samples
+        modules: random, nori
+
+    """
+
+    if template_index not in diff_samples:
+        diff_samples[template_index] = {}
+    samples = diff_samples[template_index]
+
+    sample_size = nori.core.cfg['count_sample_size']
+    if not sample_size:
+        return
+    diff_t = (exists_in_source, source_row, exists_in_dest, dest_row)
+    if category not in samples:
+        samples[category] = []
+    if num <= sample_size:
+        samples[category].append(diff_t)
+    else:
+        j = random.randrange(num)
+        if j < sample_size:
+            samples[category][j] = diff_t
+
+
 def update_diff(diff_k, diff_i, changed):
     """
     Mark a diff as updated.
     Parameters:
-        diff_k: the key used in diff_dict
-        diff_i: the index in the list
+        diff_k: the group key used in diff_store
+        diff_i: the index in the group
         changed: can be True (fully changed), False (partly changed), or
                  None (unchanged)
     Dependencies:
-        config settings: report_order
-        globals: diff_dict
+        globals: diff_store
+    """
+    diff_store.set_status(diff_k, diff_i, changed)
+
+
+def open_jsonl_report():
+    """
+    Open the JSON Lines report stream, if requested.
+    Dependencies:
+        config settings: report_format, jsonl_report_file
+        globals: jsonl_stream
+        modules: sys, nori
+    """
+    global jsonl_stream
+    if nori.core.cfg['report_format'] not in ['jsonl', 'both']:
+        return
+    if nori.core.cfg['jsonl_report_file'] == '-':
+        jsonl_stream = sys.stdout
+        return
+    try:
+        jsonl_stream = open(nori.core.cfg['jsonl_report_file'], 'w')
+    except (IOError, OSError) as e:
+        nori.core.email_logger.error(
+            'Error: could not open JSON Lines report file {0}:\n{1}\n'
+            'Exiting.'.format(nori.pps(nori.core.cfg['jsonl_report_file']), e)
+        )
+        sys.exit(nori.core.exitvals['startup']['num'])
+
+
+def close_jsonl_report():
+    """
+    Close the JSON Lines report stream, if it's open.
+    Dependencies:
+        globals: jsonl_stream
+        modules: sys
+    """
+    global jsonl_stream
+    if jsonl_stream is not None and jsonl_stream is not sys.stdout:
+        jsonl_stream.close()
+    jsonl_stream = None
+
+
+def write_jsonl_diff(diff_k, diff_i):
+
+    """
+    Write a diff to the JSON Lines report stream, if it's open (and
+    the diff was stored; see log_diff()).
+
+    Parameters:
+        diff_k: the group key used in diff_store
+        diff_i: the index in the group
+
+    Dependencies:
+        config settings: templates
+        globals: jsonl_stream, diff_store, T_NAME_KEY
+        functions: diff_status()
+        modules: json, nori
+
+    """
+
+    if jsonl_stream is None or diff_k is None:
+        return
+
+    (template_index, exists_in_source, source_row, exists_in_dest,
+       dest_row, has_been_changed) = diff_store.get(diff_k, diff_i)
+    template = nori.core.cfg['templates'][template_index]
+    key_row = source_row if source_row is not None else dest_row
+    record = collections.OrderedDict([
+        ('template_index', template_index),
+        ('template_name', template[T_NAME_KEY]),
+        ('keys', list(key_row[1][0:key_row[0]])),
+        ('source_values', (list(source_row[1][source_row[0]:])
+                           if exists_in_source else None)),
+        ('dest_values', (list(dest_row[1][dest_row[0]:])
+                         if exists_in_dest else None)),
+        ('exists_in_source', exists_in_source),
+        ('exists_in_dest', exists_in_dest),
+        ('status', diff_status(has_been_changed)),
+    ])
+    jsonl_stream.write(json.dumps(record, default=str) + '\n')
+    jsonl_stream.flush()
+
+
+def diff_status(has_been_changed):
+    """
+    Get the sync status of a diff.
+    Returns a key of DIFF_STATUS_DESCRS.
+    Parameters:
+        has_been_changed: the changed element of the diff tuple; see
+                          update_diff()
+    Dependencies:
+        config settings: action
         modules: nori
     """
-    diff_t = diff_dict[diff_k][diff_i]
-    if nori.core.cfg['report_order'] == 'template':
-        diff_dict[diff_k][diff_i] = ((diff_t[0], diff_t[1], diff_t[2],
-                                      diff_t[3], changed))
-    elif nori.core.cfg['report_order'] == 'keys':
-        diff_dict[diff_k][diff_i] = ((diff_t[0], diff_t[1], diff_t[2],
-                                      diff_t[3], diff_t[4], changed))
+    if has_been_changed is None:
+        if nori.core.cfg['action'] == 'plan':
+            return 'planned'
+        return 'unchanged'
+    elif not has_been_changed:
+        return 'partial'
+    return 'changed'
 
 
-def render_diff_report():
+def render_diff_status(has_been_changed):
     """
-    Render a summary of the diffs found and/or changed.
+    Render the sync status of a diff for the diff report.
+    Returns a string.
+    Parameters:
+        has_been_changed: the changed element of the diff tuple; see
+                          update_diff()
+    Dependencies:
+        globals: DIFF_STATUS_DESCRS
+        functions: diff_status()
+    """
+    return DIFF_STATUS_DESCRS[diff_status(has_been_changed)]
+
+
+def render_count_report():
+
+    """
+    Render the diff counts and samples from the 'count' action.
+
+    Returns a string.
+
+    Dependencies:
+        config settings: templates
+        globals: metrics.diff_counts, diff_samples, T_NAME_KEY
+        modules: nori, metrics
+
+    """
+
+    diff_report = ' Diff Count Report '
+    diff_report = ('#' * len(diff_report) + '\n' +
+                   diff_report + '\n' +
+                   '#' * len(diff_report) + '\n\n')
+    for template_index in sorted(metrics.diff_counts):
+        template = nori.core.cfg['templates'][template_index]
+        counts = metrics.diff_counts[template_index]
+        section_header = (
+            'Template {0} ({1}): {2} diff(s)' .
+            format(template_index, nori.pps(template[T_NAME_KEY]),
+                   sum(counts.values()))
+        )
+        diff_report += (section_header + '\n' +
+                        ('-' * len(section_header)) + '\n\n')
+        for category, num in counts.items():
+            diff_report += '{0}: {1}\n'.format(category, num)
+            for (exists_in_source, source_row, exists_in_dest,
+                   dest_row) in diff_samples[template_index].get(category,
+                                                                 []):
+                source_str = (nori.pps(source_row[1]) if exists_in_source
+                              else '-')
+                dest_str = nori.pps(dest_row[1]) if exists_in_dest else '-'
+                diff_report += ('    Source: {0}\n    Dest: {1}\n' .
+                                format(source_str, dest_str))
+        diff_report += '\n'
+    return diff_report.strip()
+
+
+def render_diff_summary():
+    """
+    Render per-template counts of the diffs found and their statuses.
     Returns a string.
+    Dependencies:
+        config settings: templates
+        globals: diff_store, T_NAME_KEY
+        functions: render_diff_status()
+        modules: collections, nori
+    """
+    counts = collections.OrderedDict()
+    for template_index, status_code in zip(diff_store.template_indexes,
+                                           diff_store.statuses):
+        if template_index not in counts:
+            counts[template_index] = collections.OrderedDict()
+        status = render_diff_status(DiffStore.STATUS_VALUES[status_code])
+        counts[template_index][status] = (
+            counts[template_index].get(status, 0) + 1
+        )
+    summary = 'Summary:\n--------\n\n'
+    for template_index in sorted(counts):
+        template = nori.core.cfg['templates'][template_index]
+        summary += (
+            'Template {0} ({1}): {2} diff(s) ({3})\n' .
+            format(template_index, nori.pps(template[T_NAME_KEY]),
+                   sum(counts[template_index].values()),
+                   ', '.join(['{0}: {1}'.format(status, num) for
+                              status, num in
+                              counts[template_index].items()]))
+        )
+    return summary
+
+
+def write_diff_report(stream, max_diffs=None):
+
+    """
+    Write a summary of the diffs found and/or changed to a stream.
+
+    The report is written a section / diff at a time, so it never has to
+    be held in memory as a whole.
+
+    Returns the total number of diffs (including any that were omitted).
+
+    Parameters:
+        stream: a file-like object to write the report to
+        max_diffs: the maximum number of diffs to write, or None for
+                   all of them
+
     Dependencies:
         config settings: action, templates, report_order
-        globals: diff_dict, T_NAME_KEY
+        globals: diff_store, T_NAME_KEY
+        functions: render_diff_status()
         modules: nori
+
     """
+
     if nori.core.cfg['action'] == 'diff':
         diff_report = ' Diff Report '
     elif nori.core.cfg['action'] == 'sync':
         diff_report = ' Diff / Sync Report '
-    diff_report = ('#' * len(diff_report) + '\n' +
-                   diff_report + '\n' +
-                   '#' * len(diff_report) + '\n\n')
-    if nori.core.cfg['report_order'] == 'template':
-        for template_index in diff_dict:
-            template = nori.core.cfg['templates'][template_index]
+    elif nori.core.cfg['action'] == 'plan':
+        diff_report = ' Diff / Sync Plan Report '
+    elif nori.core.cfg['action'] == 'apply':
+        diff_report = ' Sync Plan Application Report '
+    stream.write('#' * len(diff_report) + '\n' +
+                 diff_report + '\n' +
+                 '#' * len(diff_report) + '\n\n')
+
+    num_diffs = len(diff_store)
+    num_written = 0
+    for diff_k in diff_store:
+        if max_diffs is not None and num_written >= max_diffs:
+            break
+        if nori.core.cfg['report_order'] == 'template':
+            template = nori.core.cfg['templates'][diff_k]
             section_header = ('Template {0} ({1}):' .
-                              format(template_index,
+                              format(diff_k,
                                      nori.pps(template[T_NAME_KEY])))
-            section_header += '\n' + ('-' * len(section_header)) + '\n\n'
-            diff_report += section_header
-            for diff_t in diff_dict[template_index]:
-                exists_in_source = diff_t[0]
-                source_row = diff_t[1]
-                exists_in_dest = diff_t[2]
-                dest_row = diff_t[3]
-                has_been_changed = diff_t[4]
-                if exists_in_source:
-                    source_str = nori.pps(source_row[1])
-                elif exists_in_source is None:
-                    source_str = '[no value match in source database]'
-                else:
-                    source_str = '[no key match in source database]'
-                if exists_in_dest:
-                    dest_str = nori.pps(dest_row[1])
-                elif exists_in_dest is None:
-                    dest_str = '[no value match in destination database]'
-                else:
-                    dest_str = '[no key match in destination database]'
-                if has_been_changed is None:
-                    changed_str = 'unchanged'
-                elif not has_been_changed:
-                    changed_str = (
-                        'partially changed - action may be needed!'
-                    )
-                else:
-                    changed_str = 'changed'
-                diff_report += (
-                    'Source: {0}\nDest: {1}\nStatus: {2}\n\n' .
-                    format(source_str, dest_str, changed_str)
-                )
-            diff_report += '\n'
-    elif nori.core.cfg['report_order'] == 'keys':
-        for key_str in diff_dict:
+        elif nori.core.cfg['report_order'] == 'keys':
             section_header = ('Key tuple {0}:' .
-                              format(nori.pps(key_str)))
-            section_header += '\n' + ('-' * len(section_header)) + '\n\n'
-            diff_report += section_header
-            for diff_t in diff_dict[key_str]:
-                template_index = diff_t[0]
-                exists_in_source = diff_t[1]
-                source_row = diff_t[2]
-                exists_in_dest = diff_t[3]
-                dest_row = diff_t[4]
-                has_been_changed = diff_t[5]
-                template = nori.core.cfg['templates'][template_index]
-                if exists_in_source:
+                              format(nori.pps(diff_k)))
+        section_header += '\n' + ('-' * len(section_header)) + '\n\n'
+        stream.write(section_header)
+        for diff_t in diff_store.group(diff_k):
+            if max_diffs is not None and num_written >= max_diffs:
+                break
+            num_written += 1
+            (template_index, exists_in_source, source_row, exists_in_dest,
+               dest_row, has_been_changed) = diff_t
+            template = nori.core.cfg['templates'][template_index]
+            if exists_in_source:
+                if nori.core.cfg['report_order'] == 'template':
+                    source_str = nori.pps(source_row[1])
+                elif nori.core.cfg['report_order'] == 'keys':
                     num_keys = source_row[0]
                     source_data = source_row[1]
                     source_str = nori.pps(source_data[num_keys:])
-                elif exists_in_source is None:
-                    source_str = '[no value match in source database]'
-                else:
-                    source_str = '[no key match in source database]'
-                if exists_in_dest:
+            elif exists_in_source is None:
+                source_str = '[no value match in source database]'
+            else:
+                source_str = '[no key match in source database]'
+            if exists_in_dest:
+                if nori.core.cfg['report_order'] == 'template':
+                    dest_str = nori.pps(dest_row[1])
+                elif nori.core.cfg['report_order'] == 'keys':
                     num_keys = dest_row[0]
                     dest_data = dest_row[1]
                     dest_str = nori.pps(dest_data[num_keys:])
-                elif exists_in_dest is None:
-                    dest_str = '[no value match in destination database]'
-                else:
-                    dest_str = '[no key match in destination database]'
-                if has_been_changed is None:
-                    changed_str = 'unchanged'
-                elif not has_been_changed:
-                    changed_str = (
-                        'partially changed - action may be needed!'
-                    )
-                else:
-                    changed_str = 'changed'
-                diff_report += (
+            elif exists_in_dest is None:
+                dest_str = '[no value match in destination database]'
+            else:
+                dest_str = '[no key match in destination database]'
+            changed_str = render_diff_status(has_been_changed)
+            if nori.core.cfg['report_order'] == 'template':
+                stream.write(
+                    'Source: {0}\nDest: {1}\nStatus: {2}\n\n' .
+                    format(source_str, dest_str, changed_str)
+                )
+            elif nori.core.cfg['report_order'] == 'keys':
+                stream.write(
                     'Template: {0}\nSource: {1}\nDest: {2}\n'
                     'Status: {3}\n\n' .
                     format(template[T_NAME_KEY], source_str, dest_str,
                            changed_str)
                 )
-            diff_report += '\n'
-    return diff_report.strip()
+        stream.write('\n')
+
+    if num_written < num_diffs:
+        stream.write(
+            '[{0} more diff(s) not shown]\n'.format(num_diffs - num_written)
+        )
+    return num_diffs
+
+
+def render_diff_report(max_diffs=None):
+    """
+    Render a summary of the diffs found and/or changed.
+    Returns a string.
+    Parameters:
+        see write_diff_report()
+    Dependencies:
+        functions: write_diff_report()
+        classes: StringIO
+    """
+    stream = StringIO()
+    write_diff_report(stream, max_diffs)
+    return stream.getvalue().strip()
 
 
 def do_diff_report():
+
     """
     Email and log a summary of the diffs found and/or changed.
+
+    If the report_file setting is set, the full report is streamed to
+    that file, and the email / output log get a bounded version with a
+    summary and the file name.  (In the 'count' action, the report is
+    always small, so it's just emailed and logged.)
+
+    If the report_timings setting is true, the per-phase timings are
+    appended (including the time taken to render the report itself),
+    along with the query statistics if the query_stats setting is true.
+
     Dependencies:
-        functions: render_diff_report()
-        modules: nori
+        config settings: action, report_file, report_email_max_diffs,
+                         report_timings, query_stats
+        functions: write_diff_report(), render_diff_report(),
+                   render_diff_summary(), render_count_report(),
+                   metrics.start_phase(), metrics.end_phase(),
+                   metrics.render_timings_report(),
+                   metrics.render_query_stats_report()
+        modules: sys, nori, metrics
+
     """
-    diff_report = render_diff_report()
+
+    metrics.start_phase(None, 'report')
+    if nori.core.cfg['action'] == 'count':
+        diff_report = render_count_report()
+    elif nori.core.cfg['report_file'] is None:
+        diff_report = render_diff_report()
+    else:
+        nori.core.status_logger.info(
+            'Writing the diff report to {0}...' .
+            format(nori.pps(nori.core.cfg['report_file']))
+        )
+        try:
+            with open(nori.core.cfg['report_file'], 'w') as f:
+                write_diff_report(f)
+        except (IOError, OSError) as e:
+            nori.core.email_logger.error(
+                'Error: could not write the diff report to {0}:\n{1}' .
+                format(nori.pps(nori.core.cfg['report_file']), e)
+            )
+            report_ref = '[the full report could not be written]'
+        else:
+            nori.core.status_logger.info('Report written.')
+            report_ref = ('Full report: {0}' .
+                          format(nori.core.cfg['report_file']))
+        diff_report = (
+            render_diff_summary() + '\n' + report_ref + '\n\n\n' +
+            render_diff_report(nori.core.cfg['report_email_max_diffs'])
+        )
+    metrics.end_phase(len(diff_store))
+    if nori.core.cfg['report_timings']:
+        diff_report += '\n\n\n' + metrics.render_timings_report()
+        if nori.core.cfg['query_stats']:
+            diff_report += '\n\n\n' + metrics.render_query_stats_report()
     nori.core.email_loggers['report'].info(
         diff_report + '\n\n\n' + ('#' * 76)
     )
@@ -6788,60 +9153,141 @@ def do_diff_report():
 # the 'reverse' setting
 #
 
-def do_sync(t_index, scope, s_row, d_row, d_db, d_cur, diff_k, diff_i):
+def template_is_selected(template):
+    """
+    Check a template against the template_mode / template_list settings.
+    Returns True (process the template) or False (skip it).
+    Parameters:
+        template: the template entry from the templates setting
+    Dependencies:
+        config settings: template_mode, template_list
+        globals: T_NAME_KEY
+        modules: nori
+    """
+    t_name = template[T_NAME_KEY]
+    if (nori.core.cfg['template_mode'] == 'include' and
+          t_name not in nori.core.cfg['template_list']):
+        return False
+    if (nori.core.cfg['template_mode'] == 'exclude' and
+          t_name in nori.core.cfg['template_list']):
+        return False
+    return True
+
 
+def write_phase_deferred():
     """
-    Actually sync data to the destination database.
+    Check if syncs are deferred until after the diff (see
+    readonly_window).
+    Returns True or False.
+    Dependencies:
+        config settings: action, readonly_window
+        modules: nori
+    """
+    return (nori.core.cfg['action'] == 'sync' and
+            nori.core.cfg['readonly_window'] == 'write')
 
-    Returns a boolean indicating if the global destination callbacks are
-    needed.
 
+def start_snapshot(db_obj, db_cur):
+    """
+    Start a consistent-snapshot (REPEATABLE READ) read transaction.
+    Returns the previous autocommit state, for end_snapshot().
     Parameters:
-        t_index: the index of the relevant template in the templates
-                 setting
-        scope: whether the diff being synced is at the value ('v') level
-               or the key ('k') level
-        s_row: a tuple of (number of keys, transformed source data
-               tuple)
-        d_row: a tuple of (number of keys, transformed destination data
-               tuple)
-        d_db: the connection object for the destination database
-        d_cur: the cursor object for the destination database
-        diff_k: the key of the diff list within diff_dict
-        diff_i: the index of the diff within the list indicated by
-                diff_k
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+    Dependencies:
+        modules: sys, nori
+    """
+    db_ac = db_obj.autocommit(None)
+    db_obj.autocommit(False)
+    for query_str in ['SET SESSION TRANSACTION ISOLATION LEVEL '
+                      'REPEATABLE READ',
+                      'START TRANSACTION WITH CONSISTENT SNAPSHOT']:
+        if not db_execute(db_obj, db_cur, query_str, [], has_results=False):
+            db_obj.rollback()  # ignore errors
+            db_obj.autocommit(db_ac)
+            nori.core.email_logger.error(
+                "Error: can't start consistent-snapshot transaction; "
+                "exiting."
+            )
+            sys.exit(nori.core.exitvals['dbms_execute']['num'])
+    return db_ac
+
 
+def end_snapshot(db_obj, db_cur, db_ac):
+    """
+    End a read transaction started by start_snapshot().
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+        db_ac: the return value of start_snapshot()
     Dependencies:
-        config settings: reverse, source_type, source_query_func,
-                         source_template_change_callbacks, dest_type,
-                         dest_query_func,
-                         dest_template_change_callbacks, templates
-        globals: (some of) T_*
-        functions: key_value_copy(), query_dispatcher(), update_diff(),
-                   (callbacks)
         modules: nori
-
     """
+    db_obj.commit()
+    db_obj.autocommit(db_ac)
 
-    # get settings
-    template = nori.core.cfg['templates'][t_index]
-    t_multiple = template[T_MULTIPLE_KEY]
-    if not nori.core.cfg['reverse']:
-        dest_type = nori.core.cfg['dest_type']
-        dest_func = nori.core.cfg['dest_query_func']
-        dest_args = template[T_D_QUERY_ARGS_KEY][0]
+
+def replication_off(db_obj, db_cur):
+    """
+    Turn off database replication for this session.
+    Returns the previous replication state, for replication_restore().
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+    Dependencies:
+        modules: nori
+    """
+    nori.core.status_logger.info(
+        'Turning off database replication for this session before '
+        'making changes\nfor this template...'
+    )
+    prev_replication = db_obj.replication(db_cur, None)
+    db_obj.replication(db_cur, False)
+    nori.core.status_logger.info('Replication is now off.')
+    return prev_replication
+
+
+def replication_restore(db_obj, db_cur, prev_replication):
+    """
+    Restore database replication for this session.
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+        prev_replication: the return value of replication_off()
+    Dependencies:
+        modules: nori
+    """
+    nori.core.status_logger.info(
+        'Restoring database replication for this session to its '
+        'previous state...'
+    )
+    db_obj.replication(db_cur, prev_replication)
+    nori.core.status_logger.info('Replication has been restored.')
+
+
+def get_sync_op(t_index, s_row, d_row):
+
+    """
+    Work out what needs to be done to sync a diff.
+
+    Returns a tuple of (mode, new_key_cv, new_value_cv); see do_sync().
+
+    Parameters:
+        see do_sync()
+
+    Dependencies:
+        config settings: reverse, templates
+        globals: T_S_QUERY_ARGS_KEY, T_D_QUERY_ARGS_KEY
+        functions: key_value_copy()
+        modules: nori
+
+    """
+
+    template = nori.core.cfg['templates'][t_index]
+    if not nori.core.cfg['reverse']:
         dest_kwargs = template[T_D_QUERY_ARGS_KEY][1]
-        dest_no_repl = template[T_D_NO_REPL_KEY]
-        t_change_cb = template[T_D_CHANGE_CB_KEY]
-        db_change_cb = nori.core.cfg['dest_template_change_callbacks']
     else:
-        dest_type = nori.core.cfg['source_type']
-        dest_func = nori.core.cfg['source_query_func']
-        dest_args = template[T_S_QUERY_ARGS_KEY][0]
         dest_kwargs = template[T_S_QUERY_ARGS_KEY][1]
-        dest_no_repl = template[T_S_NO_REPL_KEY]
-        t_change_cb = template[T_S_CHANGE_CB_KEY]
-        db_change_cb = nori.core.cfg['source_template_change_callbacks']
 
     # what do we need to do?
     if d_row == (None, None):
@@ -6856,41 +9302,127 @@ def do_sync(t_index, scope, s_row, d_row, d_db, d_cur, diff_k, diff_i):
         s_row[1], d_row[1], dest_kwargs['key_cv'], dest_kwargs['value_cv']
     )
 
+    return (mode, new_key_cv, new_value_cv)
+
+
+def do_sync(t_index, scope, s_row, d_row, d_db, d_cur, diff_k, diff_i,
+            sync_op=None, handle_repl=True):
+
+    """
+    Actually sync data to the destination database.
+
+    Returns a boolean indicating if the global destination callbacks are
+    needed.
+
+    Parameters:
+        t_index: the index of the relevant template in the templates
+                 setting
+        scope: whether the diff being synced is at the value ('v') level
+               or the key ('k') level
+        s_row: a tuple of (number of keys, transformed source data
+               tuple)
+        d_row: a tuple of (number of keys, transformed destination data
+               tuple)
+        d_db: the connection object for the destination database
+        d_cur: the cursor object for the destination database
+        diff_k: the key of the diff group within diff_store
+        diff_i: the index of the diff within the group indicated by
+                diff_k
+        sync_op: the (mode, new_key_cv, new_value_cv) tuple returned by
+                 get_sync_op(), if it has already been computed (e.g.,
+                 when applying a sync plan), or None
+        handle_repl: if true, turn replication off and back on around
+                     the changes if the template's don't-replicate flag
+                     is set; if false, the caller is responsible for
+                     this
+
+    Dependencies:
+        config settings: reverse, source_type, source_query_func,
+                         source_template_change_callbacks, dest_type,
+                         dest_query_func,
+                         dest_template_change_callbacks, templates
+        globals: (some of) T_*, template_changes, failed_templates,
+                 metrics.sync_op_counts
+        functions: get_sync_op(), query_dispatcher(), update_diff(),
+                   replication_off(), replication_restore(),
+                   snapshots.mark_dest_snapshot_dirty(), metrics.start_phase(),
+                   metrics.end_phase(), progress.advance_progress(),
+                   (callbacks)
+        classes: LazyFormat
+        modules: collections, nori, metrics, snapshots, progress
+
+    """
+
+    # get settings
+    template = nori.core.cfg['templates'][t_index]
+    t_multiple = template[T_MULTIPLE_KEY]
+    if not nori.core.cfg['reverse']:
+        dest_type = nori.core.cfg['dest_type']
+        dest_func = nori.core.cfg['dest_query_func']
+        dest_args = template[T_D_QUERY_ARGS_KEY][0]
+        dest_kwargs = template[T_D_QUERY_ARGS_KEY][1]
+        dest_no_repl = template[T_D_NO_REPL_KEY]
+        t_change_cb = template[T_D_CHANGE_CB_KEY]
+        db_change_cb = nori.core.cfg['dest_template_change_callbacks']
+    else:
+        dest_type = nori.core.cfg['source_type']
+        dest_func = nori.core.cfg['source_query_func']
+        dest_args = template[T_S_QUERY_ARGS_KEY][0]
+        dest_kwargs = template[T_S_QUERY_ARGS_KEY][1]
+        dest_no_repl = template[T_S_NO_REPL_KEY]
+        t_change_cb = template[T_S_CHANGE_CB_KEY]
+        db_change_cb = nori.core.cfg['source_template_change_callbacks']
+
+    # what do we need to do, and what are the new cv sequences?
+    if sync_op is None:
+        sync_op = get_sync_op(t_index, s_row, d_row)
+    mode, new_key_cv, new_value_cv = sync_op
+
     # turn off replication?
-    if dest_no_repl:
-        nori.core.status_logger.info(
-            'Turning off database replication for this session before '
-            'making changes\nfor this template...'
-        )
-        dest_replication = db_obj.replication(db_cur, None)
-        db_obj.replication(db_cur, False)
-        nori.core.status_logger.info('Replication is now off.')
+    if dest_no_repl and handle_repl:
+        dest_replication = replication_off(d_db, d_cur)
 
     # do the updates / inserts / deletes
     global_callbacks_needed = False
+    snapshots.mark_dest_snapshot_dirty(t_index)
+    metrics.start_phase(t_index, 'sync writes')
     status = query_dispatcher(
         mode, scope, d_db, d_cur, dest_func, dest_args, dest_kwargs,
         new_key_cv, new_value_cv
     )
+    metrics.end_phase(1)
+    progress.advance_progress('sync writes')
+    if t_index not in metrics.sync_op_counts:
+        metrics.sync_op_counts[t_index] = collections.OrderedDict()
+    outcome = ('full' if status is True else
+               'partial' if status is False else 'failed')
+    metrics.sync_op_counts[t_index][(mode, outcome)] = (
+        metrics.sync_op_counts[t_index].get((mode, outcome), 0) + 1
+    )
     if status is not None:
         global_callbacks_needed = True
         update_diff(diff_k, diff_i, status)
+        template_changes.append((mode, scope, s_row, d_row, new_key_cv,
+                                 new_value_cv))
+    if status is not True:
+        failed_templates.add(t_index)
 
     # per-template change callbacks
+    metrics.start_phase(t_index, 'template callbacks')
     for cb_arr, descr in [(db_change_cb, 'database'),
                           (t_change_cb, 'template')]:
         if status is None:
-            nori.core.status_logger.info(
+            nori.core.status_logger.info(LazyFormat(
                 'Skipping {0}-level per-template change callbacks for '
-                'this template.'.format(descr)
-            )
+                'this template.', descr
+            ))
         else:
             num_cbs = len(cb_arr)
             for i, (cb, args, kwargs) in enumerate(cb_arr):
-                nori.core.status_logger.info(
+                nori.core.status_logger.info(LazyFormat(
                     'Calling {0}-level per-template change callback {1} '
-                    'of {2}...'.format(descr, (i + 1), num_cbs)
-                )
+                    'of {2}...', descr, (i + 1), num_cbs
+                ))
                 ret = cb(*args, t_index=t_index, mode=mode, scope=scope,
                          s_row=s_row, d_row=d_row, new_key_cv=new_key_cv,
                          new_value_cv=new_value_cv, d_db=d_db, d_cur=d_cur,
@@ -6898,300 +9430,1029 @@ def do_sync(t_index, scope, s_row, d_row, d_db, d_cur, diff_k, diff_i):
                 nori.core.status_logger.info(
                     'Callback complete.' if ret else 'Callback failed.'
                 )
+    metrics.end_phase(0 if status is None else 1)
 
     # restore replication
-    if dest_no_repl:
-        nori.core.status_logger.info(
-            'Restoring database replication for this session to its '
-            'previous state...'
-        )
-        db_obj.replication(db_cur, dest_replication)
-        nori.core.status_logger.info('Replication has been restored.')
+    if dest_no_repl and handle_repl:
+        replication_restore(d_db, d_cur, dest_replication)
 
     return global_callbacks_needed
 
 
-def do_diff_sync(t_index, s_rows, d_rows, d_db, d_cur):
+def dispatch_batch_callbacks(t_index, d_db, d_cur, handle_repl=True):
 
     """
-    Diff, and if necessary sync, sets of rows from the two databases.
+    Call the per-template batch change callbacks for a template.
 
-    Returns a boolean indicating if the global destination callbacks are
-    needed.
+    Does nothing if the template hasn't made any changes.
 
     Parameters:
         t_index: the index of the relevant template in the templates
                  setting
-        s_rows: a sequence of tuples, each in the format (number of
-                keys, transformed row tuple from the source database's
-                query results)
-        d_rows: a sequence of tuples, each in the format (number of
-                keys, transformed row tuple from the destination
-                database's query results)
         d_db: the connection object for the destination database
         d_cur: the cursor object for the destination database
+        handle_repl: see do_sync()
 
     Dependencies:
-        config settings: action, bidir, templates
-        globals: T_MULTIPLE_KEY
-        functions: log_diff(), do_sync()
-        modules: nori
+        config settings: reverse, source_template_batch_callbacks,
+                         dest_template_batch_callbacks, templates
+        globals: T_S_NO_REPL_KEY, T_S_BATCH_CB_KEY, T_D_NO_REPL_KEY,
+                 T_D_BATCH_CB_KEY, template_changes
+        functions: replication_off(), replication_restore(),
+                   metrics.start_phase(), metrics.end_phase(), (callbacks)
+        modules: nori, metrics
 
     """
 
+    if not template_changes:
+        return
+
     # get settings
     template = nori.core.cfg['templates'][t_index]
-    t_multiple = template[T_MULTIPLE_KEY]
+    if not nori.core.cfg['reverse']:
+        dest_no_repl = template[T_D_NO_REPL_KEY]
+        t_batch_cb = template[T_D_BATCH_CB_KEY]
+        db_batch_cb = nori.core.cfg['dest_template_batch_callbacks']
+    else:
+        dest_no_repl = template[T_S_NO_REPL_KEY]
+        t_batch_cb = template[T_S_BATCH_CB_KEY]
+        db_batch_cb = nori.core.cfg['source_template_batch_callbacks']
 
-    # diff/sync and check for missing rows in the destination DB
-    global_callbacks_needed = False
-    if nori.core.cfg['bidir']:
-        d_found = []
-    for s_row in s_rows:
-        s_found = False
-        s_num_keys = s_row[0]
-        s_data = s_row[1]
-        s_keys = s_data[0:s_num_keys]
-        s_vals = s_data[s_num_keys:]
-        for di, d_row in enumerate(d_rows):
-            d_num_keys = d_row[0]
-            d_data = d_row[1]
-            d_keys = d_data[0:d_num_keys]
-            d_vals = d_data[d_num_keys:]
-            if not t_multiple:
-                if d_keys == s_keys:
-                    s_found = True
-                    if nori.core.cfg['bidir']:
-                        d_found.append(di)
-                    if d_vals != s_vals:
-                        # CASES: single-valued: diff d val, no s val,
-                        #                       no d val
-                        diff_k, diff_i = log_diff(t_index, True, s_row,
-                                                  True, d_row)
-                        if nori.core.cfg['action'] == 'sync':
-                            if do_sync(t_index, 'v', s_row, d_row, d_db,
-                                       d_cur, diff_k, diff_i):
-                                global_callbacks_needed = True
-                    break
-            else:  # multiple-row matching
-                if d_keys == s_keys and d_vals == s_vals:
-                    s_found = True
-                    if nori.core.cfg['bidir']:
-                        d_found.append(di)
-                    break
+    # callers may hold on to the list, so make a new one
+    changes = list(template_changes)
+    del template_changes[:]
 
-        # row not found
-        if not s_found:
-            # CASES: single-valued: no d key
-            #        multiple-valued: [diff d val], no d val, no d key
-            exists_in_dest = None if (t_multiple and d_rows) else False
-            diff_k, diff_i = log_diff(t_index, True, s_row, exists_in_dest,
-                                      None)
-            if nori.core.cfg['action'] == 'sync':
-                scope = 'v' if (t_multiple and d_rows) else 'k'
-                if do_sync(t_index, scope, s_row, (None, None), d_db, d_cur,
-                           diff_k, diff_i):
-                    global_callbacks_needed = True
+    if not (db_batch_cb or t_batch_cb):
+        return
 
-    # check for missing rows in the source DB
-    if nori.core.cfg['bidir']:
-        for di, d_row in enumerate(d_rows):
-            if di not in d_found:
-                # CASES: single-valued: no s key
-                #        multiple-valued: no s val, no s key
-                exists_in_source = (None if (t_multiple and s_rows)
-                                         else False)
-                diff_k, diff_i = log_diff(t_index, exists_in_source, None,
-                                          True, d_row)
-                if nori.core.cfg['action'] == 'sync':
-                    scope = 'v' if (t_multiple and d_rows) else 'k'
-                    if do_sync(t_index, scope, (None, None), d_row, d_db,
-                               d_cur, diff_k, diff_i):
-                        global_callbacks_needed = True
-    return global_callbacks_needed
+    # turn off replication?
+    if dest_no_repl and handle_repl:
+        dest_replication = replication_off(d_db, d_cur)
+
+    metrics.start_phase(t_index, 'template callbacks')
+    for cb_arr, descr in [(db_batch_cb, 'database'),
+                          (t_batch_cb, 'template')]:
+        num_cbs = len(cb_arr)
+        for i, (cb, args, kwargs) in enumerate(cb_arr):
+            nori.core.status_logger.info(
+                'Calling {0}-level per-template batch change callback {1} '
+                'of {2}...'.format(descr, (i + 1), num_cbs)
+            )
+            ret = cb(*args, t_index=t_index, changes=changes, d_db=d_db,
+                     d_cur=d_cur, **kwargs)
+            nori.core.status_logger.info(
+                'Callback complete.' if ret else 'Callback failed.'
+            )
+    metrics.end_phase(len(changes))
 
+    # restore replication
+    if dest_no_repl and handle_repl:
+        replication_restore(d_db, d_cur, dest_replication)
+
+
+def plan_sync(t_index, scope, exists_in_source, s_row, exists_in_dest,
+              d_row, diff_k, diff_i):
 
-def dispatch_post_action_callbacks(atexit, s_db, s_cur, d_db, d_cur):
     """
-    Call the post-action callbacks, either normally or on abnormal exit.
+    Add the changes needed to sync a diff to the sync plan.
+
     Parameters:
-        atexit: True if the function is being called from the registered
-                atexit callback, False otherwise
-        s_db: the source-database connection object to use
-        s_cur: the source-database cursor object to use
-        d_db: the destination-database connection object to use
-        d_cur: the destination-database cursor object to use
+        exists_in_source: see log_diff()
+        exists_in_dest: see log_diff()
+        see do_sync() for the rest
+
     Dependencies:
-        config settings: post_action_callbacks
-        globals: post_action_callbacks
-        functions: (callbacks)
+        globals: sync_plan, sync_plan_diffs
+        functions: get_sync_op()
+        classes: LazyFormat
         modules: nori
+
     """
-    if not atexit:
-        pa = nori.core.cfg['post_action_callbacks']
-    else:
-        pa = post_action_callbacks
-    num_cbs = len(pa)
-    for i, cb_t in enumerate(pa):
-        cb, args, kwargs = cb_t[0:3]  # there might be a 4th
-        nori.core.status_logger.info(
-            'Calling post-action callback {0} of {1}...' .
-            format((i + 1), num_cbs)
-        )
-        ret = cb(*args, s_db=s_db, s_cur=s_cur, d_db=d_db, d_cur=d_cur,
-                 **kwargs)
-        nori.core.status_logger.info(
-            'Callback complete.' if ret else 'Callback failed.'
-        )
-        if (not atexit) and ((cb, args, kwargs) in post_action_callbacks):
-            post_action_callbacks.remove((cb, args, kwargs))
 
+    mode, new_key_cv, new_value_cv = get_sync_op(t_index, s_row, d_row)
+    sync_plan.append((t_index, mode, scope, exists_in_source, s_row,
+                      exists_in_dest, d_row, new_key_cv, new_value_cv))
+    sync_plan_diffs.append((diff_k, diff_i))
+    nori.core.status_logger.info(LazyFormat(
+        'Added {0} to the sync plan.', mode
+    ))
 
-def run_mode_hook():
+
+def dispatch_sync(t_index, scope, exists_in_source, s_row, exists_in_dest,
+                  d_row, d_db, d_cur, diff_k, diff_i):
 
     """
-    Do the actual work.
+    Sync a diff now or add it to the sync plan, depending on the action.
+
+    Does nothing if the action is 'diff'.  If the action is 'sync' but
+    the writes are deferred (see write_phase_deferred()), the diff is
+    added to the sync plan, to be synced after the diff is finished.
+
+    Either way, once the diff's status is known, it is written to the
+    JSON Lines report, if any.
+
+    Returns a boolean indicating if the global destination callbacks are
+    needed.
+
+    Parameters:
+        exists_in_source: see log_diff()
+        exists_in_dest: see log_diff()
+        see do_sync() for the rest
 
     Dependencies:
-        config settings: debug, reverse, bidir, pre_action_callbacks,
-                         post_action_callbacks, source_query_func,
-                         source_global_change_callbacks, dest_query_func,
-                         dest_global_change_callbacks, templates,
-                         template_mode, template_list
-        globals: (some of) T_*, post_action_callbacks, diff_dict, sourcedb,
-                 destdb
-        functions: dispatch_post_action_callbacks(), key_filter(),
-                   do_diff_report(), do_diff_sync(), (functions in
-                   templates), (callback functions)
-        modules: atexit, collections, nori
+        config settings: action
+        functions: write_phase_deferred(), do_sync(), plan_sync(),
+                   write_jsonl_diff()
+        modules: nori
 
     """
 
-    # connect to DBs
-    if not nori.core.cfg['reverse']:
-        s_db = sourcedb
-        d_db = destdb
-    else:
-        s_db = destdb
-        d_db = sourcedb
-    s_db.connect()
-    s_db.autocommit(True)
-    s_cur = s_db.cursor(False)
-    d_db.connect()
-    d_db.autocommit(True)
-    d_cur = d_db.cursor(False)
+    global_callbacks_needed = False
+    if nori.core.cfg['action'] == 'sync' and not write_phase_deferred():
+        global_callbacks_needed = do_sync(t_index, scope, s_row, d_row,
+                                          d_db, d_cur, diff_k, diff_i)
+    elif nori.core.cfg['action'] in ['sync', 'plan']:
+        plan_sync(t_index, scope, exists_in_source, s_row, exists_in_dest,
+                  d_row, diff_k, diff_i)
 
-    # register post-action callbacks
-    pa = nori.core.cfg['post_action_callbacks']
-    if pa and (True in [cb_t[3] for cb_t in pa]):
-        nori.core.status_logger.info(
-            'Registering post-action callbacks.'
-        )
-        for i, (cb, args, kwargs, reg) in enumerate(pa):
-            if not reg:
-                continue
-            post_action_callbacks.append((cb, args, kwargs))
-        atexit.register(dispatch_post_action_callbacks, True, s_db, s_cur,
-                        d_db, d_cur)
+    # deferred syncs are written to the JSON report by execute_sync_ops()
+    if not write_phase_deferred():
+        write_jsonl_diff(diff_k, diff_i)
 
-    # pre-action callbacks
-    pa = nori.core.cfg['pre_action_callbacks']
-    num_cbs = len(pa)
-    for i, (cb, args, kwargs) in enumerate(pa):
-        nori.core.status_logger.info(
-            'Calling pre-action callback {0} of {1}...' .
-            format((i + 1), num_cbs)
-        )
-        ret = cb(*args, s_db=s_db, s_cur=s_cur, d_db=d_db, d_cur=d_cur,
-                 **kwargs)
-        nori.core.status_logger.info(
-            'Callback complete.' if ret else 'Callback failed.'
+    return global_callbacks_needed
+
+
+def write_sync_plan():
+
+    """
+    Write the sync plan to the sync plan file.
+
+    The file contains a pickled dict with the following elements:
+        version: the file format version (SYNC_PLAN_VERSION)
+        reverse: the value of the reverse setting
+        templates: a list of the names of all of the templates, in order
+        ops: the contents of sync_plan
+
+    Dependencies:
+        config settings: reverse, templates, sync_plan_file
+        globals: sync_plan, SYNC_PLAN_VERSION, T_NAME_KEY
+        modules: sys, pickle, nori
+
+    """
+
+    plan = dict(
+        version=SYNC_PLAN_VERSION,
+        reverse=nori.core.cfg['reverse'],
+        templates=[t[T_NAME_KEY] for t in nori.core.cfg['templates']],
+        ops=sync_plan,
+    )
+    nori.core.status_logger.info(
+        'Writing {0} operation(s) to sync plan file {1}...' .
+        format(len(sync_plan), nori.pps(nori.core.cfg['sync_plan_file']))
+    )
+    try:
+        with open(nori.core.cfg['sync_plan_file'], 'wb') as f:
+            pickle.dump(plan, f, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError) as e:
+        nori.core.email_logger.error(
+            'Error: could not write sync plan file {0}:\n{1}\nExiting.' .
+            format(nori.pps(nori.core.cfg['sync_plan_file']), e)
         )
+        sys.exit(nori.core.exitvals['sync_plan']['num'])
+    nori.core.status_logger.info('Sync plan written.')
 
-    # log that we're starting the loop;
-    # especially important in case the loop produces no output
-    nori.core.status_logger.info('Starting template loop.')
 
-    # template loop
-    global_callbacks_needed = False
-    for t_index, template in enumerate(nori.core.cfg['templates']):
-        # get settings
-        t_name = template[T_NAME_KEY]
-        t_multiple = template[T_MULTIPLE_KEY]
-        if not nori.core.cfg['reverse']:
-            source_func = nori.core.cfg['source_query_func']
-            source_args = template[T_S_QUERY_ARGS_KEY][0]
-            source_kwargs = template[T_S_QUERY_ARGS_KEY][1]
-            to_dest_func = template[T_TO_D_FUNC_KEY]
-            dest_func = nori.core.cfg['dest_query_func']
-            dest_args = template[T_D_QUERY_ARGS_KEY][0]
-            dest_kwargs = template[T_D_QUERY_ARGS_KEY][1]
-            to_source_func = template[T_TO_S_FUNC_KEY]
+def read_sync_plan():
+
+    """
+    Read and check the sync plan file.
+
+    Returns the list of operations in the plan (see sync_plan).
+
+    Dependencies:
+        config settings: reverse, templates, sync_plan_file
+        globals: SYNC_PLAN_VERSION, T_NAME_KEY
+        modules: sys, pickle, nori
+
+    """
+
+    plan_file = nori.core.cfg['sync_plan_file']
+    nori.core.status_logger.info(
+        'Reading sync plan file {0}...'.format(nori.pps(plan_file))
+    )
+    try:
+        with open(plan_file, 'rb') as f:
+            plan = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as e:
+        nori.core.email_logger.error(
+            'Error: could not read sync plan file {0}:\n{1}\nExiting.' .
+            format(nori.pps(plan_file), e)
+        )
+        sys.exit(nori.core.exitvals['sync_plan']['num'])
+
+    # sanity checks
+    err = None
+    if (not isinstance(plan, dict) or
+          plan.get('version') != SYNC_PLAN_VERSION):
+        err = 'unknown file format'
+    elif plan['reverse'] != nori.core.cfg['reverse']:
+        err = 'the reverse setting has changed'
+    elif (plan['templates'] !=
+            [t[T_NAME_KEY] for t in nori.core.cfg['templates']]):
+        err = 'the templates setting has changed'
+    if err:
+        nori.core.email_logger.error(
+            'Error: sync plan file {0} can not be applied\n'
+            '({1}); exiting.'.format(nori.pps(plan_file), err)
+        )
+        sys.exit(nori.core.exitvals['sync_plan']['num'])
+
+    nori.core.status_logger.info(
+        'Sync plan contains {0} operation(s).'.format(len(plan['ops']))
+    )
+    return plan['ops']
+
+
+def verify_sync_op(t_index, mode, scope, s_row, d_row, new_key_cv, d_db,
+                   d_cur):
+
+    """
+    Re-read the destination rows affected by a deferred change.
+
+    This is used to make sure that the destination database hasn't
+    changed (in a way that affects the change) since the diff was done;
+    see readonly_window.
+
+    Returns True if the change is still valid, False otherwise.
+
+    Parameters:
+        mode: the mode returned by get_sync_op()
+        new_key_cv: the key cv sequence returned by get_sync_op()
+        see do_sync() for the rest
+
+    Dependencies:
+        config settings: reverse, dest_query_func, source_query_func,
+                         templates
+        globals: (some of) T_*
+        functions: key_filter(), (functions in templates)
+        modules: nori
+
+    """
+
+    # get settings
+    template = nori.core.cfg['templates'][t_index]
+    t_multiple = template[T_MULTIPLE_KEY]
+    if not nori.core.cfg['reverse']:
+        dest_func = nori.core.cfg['dest_query_func']
+        dest_args = template[T_D_QUERY_ARGS_KEY][0]
+        dest_kwargs = template[T_D_QUERY_ARGS_KEY][1]
+        to_source_func = template[T_TO_S_FUNC_KEY]
+    else:
+        dest_func = nori.core.cfg['source_query_func']
+        dest_args = template[T_S_QUERY_ARGS_KEY][0]
+        dest_kwargs = template[T_S_QUERY_ARGS_KEY][1]
+        to_source_func = template[T_TO_D_FUNC_KEY]
+
+    # re-read the rows for these keys only
+    verify_kwargs = dict(dest_kwargs)
+    verify_kwargs['key_cv'] = new_key_cv
+    d_rows_raw = dest_func(*dest_args, db_obj=d_db, db_cur=d_cur,
+                           mode='read', scope=None, **verify_kwargs)
+    if d_rows_raw is None:
+        return False
+    d_data_list = []
+    for d_row_raw in d_rows_raw:
+        if to_source_func:
+            d_num_keys, d_data = to_source_func(template, d_row_raw)
         else:
-            source_func = nori.core.cfg['dest_query_func']
-            source_args = template[T_D_QUERY_ARGS_KEY][0]
-            source_kwargs = template[T_D_QUERY_ARGS_KEY][1]
-            to_dest_func = template[T_TO_S_FUNC_KEY]
-            dest_func = nori.core.cfg['source_query_func']
-            dest_args = template[T_S_QUERY_ARGS_KEY][0]
-            dest_kwargs = template[T_S_QUERY_ARGS_KEY][1]
-            to_source_func = template[T_TO_D_FUNC_KEY]
-
-        # filter by template
-        if (nori.cfg['template_mode'] == 'include' and
-              t_name not in nori.cfg['template_list']):
+            d_num_keys = len(dest_kwargs['key_cv'])
+            d_data = d_row_raw
+        if not key_filter(t_index, d_num_keys, d_data):
             continue
-        elif (nori.cfg['template_mode'] == 'exclude' and
-              t_name in nori.cfg['template_list']):
+        d_data_list.append(tuple(d_data))
+
+    # compare with what the diff found
+    if mode == 'insert':
+        if scope == 'k' or not t_multiple:
+            return not d_data_list
+        return tuple(s_row[1]) not in d_data_list
+    # update / delete
+    return tuple(d_row[1]) in d_data_list
+
+
+def execute_sync_ops(ops, d_db, d_cur, diff_locs=None, verify=False):
+
+    """
+    Make the changes in a list of sync plan operations.
+
+    The operations are grouped by template (in template order) and,
+    within each template, run in the order deletes, updates, inserts
+    (so that, e.g., a multiple-valued field with a limited number of
+    values has room for the new values).  Within each of those groups,
+    the original order is preserved.  Replication is turned off (if
+    requested by the template) once per template, rather than once per
+    operation.
+
+    Returns a boolean indicating if the global destination callbacks are
+    needed.
+
+    Parameters:
+        ops: a list of operations in the format used by sync_plan
+        d_db: the connection object for the destination database
+        d_cur: the cursor object for the destination database
+        diff_locs: a list of (diff_k, diff_i) tuples parallel to ops
+                   (see sync_plan_diffs), or None to log the diffs
+                   before syncing them
+        verify: if true, call verify_sync_op() before each change, and
+                skip the change (with a warning) if it fails
+
+    Dependencies:
+        config settings: reverse, templates
+        globals: (some of) T_*, failed_templates
+        functions: template_is_selected(), log_diff(), verify_sync_op(),
+                   do_sync(), write_jsonl_diff(),
+                   snapshots.update_dest_snapshot(),
+                   dispatch_batch_callbacks(), replication_off(),
+                   replication_restore(), progress.start_progress(),
+                   progress.finish_progress()
+        modules: itertools, nori, snapshots, progress
+
+    """
+
+    mode_order = {'delete': 0, 'update': 1, 'insert': 2}
+    op_indexes = sorted(range(len(ops)),
+                        key=lambda i: (ops[i][0], mode_order[ops[i][1]]))
+
+    global_callbacks_needed = False
+    for t_index, t_op_indexes in itertools.groupby(
+            op_indexes, lambda i: ops[i][0]):
+        template = nori.core.cfg['templates'][t_index]
+        if not template_is_selected(template):
             continue
+        t_op_indexes = list(t_op_indexes)
+        if not nori.core.cfg['reverse']:
+            dest_no_repl = template[T_D_NO_REPL_KEY]
+        else:
+            dest_no_repl = template[T_S_NO_REPL_KEY]
 
-        # log template start
         nori.core.status_logger.info(
-            'Processing template {0}...'.format(nori.pps(t_name))
+            'Applying {0} sync operation(s) for template {1}...' .
+            format(len(t_op_indexes), nori.pps(template[T_NAME_KEY]))
+        )
+        if dest_no_repl:
+            dest_replication = replication_off(d_db, d_cur)
+        progress.start_progress(t_index, 'sync writes', len(t_op_indexes),
+                                'operations')
+        for i in t_op_indexes:
+            (t_index, mode, scope, exists_in_source, s_row, exists_in_dest,
+               d_row, new_key_cv, new_value_cv) = ops[i]
+            if diff_locs is None:
+                diff_k, diff_i = log_diff(t_index, exists_in_source, s_row,
+                                          exists_in_dest, d_row)
+            else:
+                diff_k, diff_i = diff_locs[i]
+            if verify and not verify_sync_op(t_index, mode, scope, s_row,
+                                             d_row, new_key_cv, d_db,
+                                             d_cur):
+                nori.core.email_logger.error(
+                    'Warning: the destination data for template {0}, '
+                    'keys {1}\nchanged after the diff; skipping {2}.' .
+                    format(nori.pps(template[T_NAME_KEY]),
+                           nori.pps([cv[2] for cv in new_key_cv]), mode)
+                )
+                failed_templates.add(t_index)
+                write_jsonl_diff(diff_k, diff_i)
+                continue
+            if do_sync(t_index, scope, s_row, d_row, d_db, d_cur, diff_k,
+                       diff_i, (mode, new_key_cv, new_value_cv), False):
+                global_callbacks_needed = True
+            write_jsonl_diff(diff_k, diff_i)
+        progress.finish_progress('sync writes')
+        snapshots.update_dest_snapshot(t_index, template_changes,
+                                       t_index in failed_templates)
+        dispatch_batch_callbacks(t_index, d_db, d_cur, False)
+        if dest_no_repl:
+            replication_restore(d_db, d_cur, dest_replication)
+        nori.core.status_logger.info(
+            'Template {0} finished.'.format(nori.pps(template[T_NAME_KEY]))
         )
 
-        # get the source data
-        s_rows_raw = source_func(*source_args, db_obj=s_db, db_cur=s_cur,
-                                 mode='read', scope=None, **source_kwargs)
-        if s_rows_raw is None:
-            # shouldn't actually happen; errors will cause the script to
-            # exit before this, as currently written
-            break
+    return global_callbacks_needed
 
-        # s_rows is a list of tuples in the format (num_keys, data), where
-        # the data is a raw row (a tuple) from source_func())
-        s_rows = []
-        for s_row_raw in s_rows_raw:
-            # apply transform
-            if to_dest_func:
-                s_num_keys, s_row = to_dest_func(template, s_row_raw)
-            else:
-                s_num_keys = len(source_kwargs['key_cv'])
-                s_row = s_row_raw
 
-            # filter by keys
-            if not key_filter(t_index, s_num_keys, s_row):
-                continue
+def apply_sync_plan(d_db, d_cur):
+    """
+    Make the changes listed in the sync plan file.
+    Returns a boolean indicating if the global destination callbacks are
+    needed.
+    Parameters:
+        see execute_sync_ops()
+    Dependencies:
+        functions: read_sync_plan(), execute_sync_ops()
+    """
+    return execute_sync_ops(read_sync_plan(), d_db, d_cur)
 
-            # add to the list
-            s_rows.append((s_num_keys, s_row))
-        nori.core.status_logger.debug(
-            'Transformed and filtered source rows:\n' +
-            nori.core.pps(s_rows)
+
+def group_rows_by_keys(rows):
+    """
+    Group rows by their key columns (for multiple-valued templates).
+    Returns an OrderedDict of key tuples and lists of rows, in the order
+    in which the keys first appear.
+    Parameters:
+        rows: a sequence of tuples, each in the format (number of keys,
+              transformed row tuple)
+    Dependencies:
+        modules: collections
+    """
+    row_groups = collections.OrderedDict()
+    for row in rows:
+        keys = row[1][0:row[0]]
+        if keys not in row_groups:
+            row_groups[keys] = []
+        row_groups[keys].append(row)
+    return row_groups
+
+
+def do_diff_sync(t_index, s_rows, d_rows, d_db, d_cur):
+
+    """
+    Diff, and if necessary sync, sets of rows from the two databases.
+
+    Returns a boolean indicating if the global destination callbacks are
+    needed.
+
+    Parameters:
+        t_index: the index of the relevant template in the templates
+                 setting
+        s_rows: a sequence of tuples, each in the format (number of
+                keys, transformed row tuple from the source database's
+                query results)
+        d_rows: a sequence of tuples, each in the format (number of
+                keys, transformed row tuple from the destination
+                database's query results)
+        d_db: the connection object for the destination database
+        d_cur: the cursor object for the destination database
+
+    Dependencies:
+        config settings: bidir, templates
+        globals: T_MULTIPLE_KEY
+        functions: log_diff(), dispatch_sync(), checkpoints.checkpoint_key(),
+                   progress.advance_progress()
+        modules: nori, checkpoints, progress
+
+    """
+
+    # get settings
+    template = nori.core.cfg['templates'][t_index]
+    t_multiple = template[T_MULTIPLE_KEY]
+
+    # diff/sync and check for missing rows in the destination DB
+    global_callbacks_needed = False
+    if nori.core.cfg['bidir']:
+        d_found = []
+    for s_row in s_rows:
+        progress.advance_progress('diff')
+        s_found = False
+        s_num_keys = s_row[0]
+        s_data = s_row[1]
+        s_keys = s_data[0:s_num_keys]
+        s_vals = s_data[s_num_keys:]
+        for di, d_row in enumerate(d_rows):
+            d_num_keys = d_row[0]
+            d_data = d_row[1]
+            d_keys = d_data[0:d_num_keys]
+            d_vals = d_data[d_num_keys:]
+            if not t_multiple:
+                if d_keys == s_keys:
+                    s_found = True
+                    if nori.core.cfg['bidir']:
+                        d_found.append(di)
+                    if d_vals != s_vals:
+                        # CASES: single-valued: diff d val, no s val,
+                        #                       no d val
+                        diff_k, diff_i = log_diff(t_index, True, s_row,
+                                                  True, d_row)
+                        if dispatch_sync(t_index, 'v', True, s_row, True,
+                                         d_row, d_db, d_cur, diff_k,
+                                         diff_i):
+                            global_callbacks_needed = True
+                    break
+            else:  # multiple-row matching
+                if d_keys == s_keys and d_vals == s_vals:
+                    s_found = True
+                    if nori.core.cfg['bidir']:
+                        d_found.append(di)
+                    break
+
+        # row not found
+        if not s_found:
+            # CASES: single-valued: no d key
+            #        multiple-valued: [diff d val], no d val, no d key
+            exists_in_dest = None if (t_multiple and d_rows) else False
+            diff_k, diff_i = log_diff(t_index, True, s_row, exists_in_dest,
+                                      None)
+            scope = 'v' if (t_multiple and d_rows) else 'k'
+            if dispatch_sync(t_index, scope, True, s_row, exists_in_dest,
+                             (None, None), d_db, d_cur, diff_k, diff_i):
+                global_callbacks_needed = True
+
+        # multiple-valued templates are checkpointed by key group, in
+        # process_template()
+        if not t_multiple:
+            checkpoints.checkpoint_key(t_index, s_keys, template_changes,
+                                       drupal_touched_entities)
+
+    # check for missing rows in the source DB
+    if nori.core.cfg['bidir']:
+        for di, d_row in enumerate(d_rows):
+            if di not in d_found:
+                # CASES: single-valued: no s key
+                #        multiple-valued: no s val, no s key
+                exists_in_source = (None if (t_multiple and s_rows)
+                                         else False)
+                diff_k, diff_i = log_diff(t_index, exists_in_source, None,
+                                          True, d_row)
+                scope = 'v' if (t_multiple and d_rows) else 'k'
+                if dispatch_sync(t_index, scope, exists_in_source,
+                                 (None, None), True, d_row, d_db, d_cur,
+                                 diff_k, diff_i):
+                    global_callbacks_needed = True
+    return global_callbacks_needed
+
+
+def dispatch_post_action_callbacks(atexit, s_db, s_cur, d_db, d_cur):
+    """
+    Call the post-action callbacks, either normally or on abnormal exit.
+    Parameters:
+        atexit: True if the function is being called from the registered
+                atexit callback, False otherwise
+        s_db: the source-database connection object to use
+        s_cur: the source-database cursor object to use
+        d_db: the destination-database connection object to use
+        d_cur: the destination-database cursor object to use
+    Dependencies:
+        config settings: post_action_callbacks
+        globals: post_action_callbacks
+        functions: (callbacks)
+        modules: nori
+    """
+    if not atexit:
+        pa = nori.core.cfg['post_action_callbacks']
+    else:
+        pa = post_action_callbacks
+    num_cbs = len(pa)
+    for i, cb_t in enumerate(pa):
+        cb, args, kwargs = cb_t[0:3]  # there might be a 4th
+        nori.core.status_logger.info(
+            'Calling post-action callback {0} of {1}...' .
+            format((i + 1), num_cbs)
+        )
+        ret = cb(*args, s_db=s_db, s_cur=s_cur, d_db=d_db, d_cur=d_cur,
+                 **kwargs)
+        nori.core.status_logger.info(
+            'Callback complete.' if ret else 'Callback failed.'
+        )
+        if (not atexit) and ((cb, args, kwargs) in post_action_callbacks):
+            post_action_callbacks.remove((cb, args, kwargs))
+
+
+def read_incremental_state():
+
+    """
+    Read the incremental high-water marks from the state file.
+
+    A missing file is treated as empty (i.e., all templates will be
+    processed in full).
+
+    Dependencies:
+        config settings: incremental_state_file
+        globals: incremental_state
+        modules: os, sys, json, nori
+
+    """
+
+    global incremental_state
+
+    try:
+        with open(nori.core.cfg['incremental_state_file']) as f:
+            incremental_state = json.load(f)
+    except (IOError, OSError) as e:
+        if not os.path.exists(nori.core.cfg['incremental_state_file']):
+            nori.core.status_logger.info(
+                'No incremental state file found; templates will be '
+                'processed in full.'
+            )
+            incremental_state = {}
+            return
+        nori.core.email_logger.error(
+            'Error: could not read incremental state file {0}:\n{1}\n'
+            'Exiting.'.format(
+                nori.pps(nori.core.cfg['incremental_state_file']), e
+            )
+        )
+        sys.exit(nori.core.exitvals['startup']['num'])
+    except ValueError as e:
+        nori.core.email_logger.error(
+            'Error: invalid incremental state file {0}:\n{1}\n'
+            'Exiting.'.format(
+                nori.pps(nori.core.cfg['incremental_state_file']), e
+            )
         )
+        sys.exit(nori.core.exitvals['startup']['num'])
 
-        # get the destination data
-        d_rows_raw = dest_func(*dest_args, db_obj=d_db, db_cur=d_cur,
-                               mode='read', scope=None, **dest_kwargs)
+
+def write_incremental_state():
+
+    """
+    Write the incremental high-water marks to the state file.
+
+    The file is replaced atomically, so an interrupted write can't lose
+    the previous high-water marks.
+
+    Returns True on success, False on failure.
+
+    Dependencies:
+        config settings: incremental_state_file
+        globals: incremental_state
+        modules: os, json, nori
+
+    """
+
+    state_file = nori.core.cfg['incremental_state_file']
+    temp_file = state_file + '.tmp'
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(incremental_state, f, indent=4, sort_keys=True)
+        os.rename(temp_file, state_file)
+    except (IOError, OSError) as e:
+        nori.core.email_logger.error(
+            'Warning: could not write incremental state file {0}:\n{1}' .
+            format(nori.pps(state_file), e)
+        )
+        return False
+    return True
+
+
+def get_incremental_hwm(t_index):
+
+    """
+    Get the high-water mark for a template in an incremental run.
+
+    Returns a timestamp string, or None if the template should be
+    processed in full (it has no high-water mark yet, or it's due for a
+    full run; see incremental_max_age).
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+
+    Dependencies:
+        config settings: reverse, templates, incremental_max_age
+        globals: incremental_state, T_NAME_KEY
+        modules: time, nori
+
+    """
+
+    direction = 'reverse' if nori.core.cfg['reverse'] else 'forward'
+    template = nori.core.cfg['templates'][t_index]
+    hwm = incremental_state.get(direction, {}).get(template[T_NAME_KEY])
+    max_age = nori.core.cfg['incremental_max_age']
+    if hwm is None or max_age is None:
+        return hwm
+    last_full = (incremental_state.get('full_runs', {}).get(direction, {}).
+                 get(template[T_NAME_KEY]))
+    if last_full is None or time.time() - last_full > max_age:
+        nori.core.status_logger.info(
+            'Template {0} is due for a full run.' .
+            format(nori.pps(template[T_NAME_KEY]))
+        )
+        return None
+    return hwm
+
+
+def commit_incremental_state(t_indexes):
+
+    """
+    Advance the high-water marks for templates that have been synced.
+
+    Templates with failed syncs (see failed_templates) are left alone,
+    so their changes will be retried on the next run.  For templates
+    that were processed in full, the time of the full run is recorded
+    as well (see incremental_max_age).
+
+    Parameters:
+        t_indexes: a sequence of template indexes whose changes have all
+                   been made
+
+    Dependencies:
+        config settings: action, reverse, templates
+        globals: incremental_state, incremental_pending, failed_templates,
+                 T_NAME_KEY
+        functions: write_incremental_state()
+        modules: nori
+
+    """
+
+    if nori.core.cfg['action'] != 'sync':
+        return
+    direction = 'reverse' if nori.core.cfg['reverse'] else 'forward'
+    changed = False
+    for t_index in t_indexes:
+        if t_index not in incremental_pending:
+            continue
+        new_hwm, full_time = incremental_pending.pop(t_index)
+        template = nori.core.cfg['templates'][t_index]
+        if t_index in failed_templates:
+            nori.core.status_logger.info(
+                'Not advancing the high-water mark for template {0}, due '
+                'to failed changes.'.format(nori.pps(template[T_NAME_KEY]))
+            )
+            continue
+        if direction not in incremental_state:
+            incremental_state[direction] = {}
+        incremental_state[direction][template[T_NAME_KEY]] = new_hwm
+        if full_time is not None:
+            if 'full_runs' not in incremental_state:
+                incremental_state['full_runs'] = {}
+            full_runs = incremental_state['full_runs']
+            if direction not in full_runs:
+                full_runs[direction] = {}
+            full_runs[direction][template[T_NAME_KEY]] = full_time
+        changed = True
+    if changed:
+        write_incremental_state()
+
+
+def get_db_time(db_obj, db_cur):
+    """
+    Get the current time from a database server.
+    Returns a timestamp string, or None on error.
+    Parameters:
+        db_obj: the database connection object to use
+        db_cur: the database cursor object to use
+    Dependencies:
+        modules: nori
+    """
+    if not db_execute(db_obj, db_cur, 'SELECT NOW()', has_results=True):
+        return None
+    ret = db_fetchall(db_obj, db_cur)
+    if not ret[0] or not ret[1]:
+        return None
+    return str(ret[1][0][0])
+
+
+def restrict_to_changed(kwargs, changed_column, since):
+    """
+    Add a change-timestamp condition to query-function kwargs.
+    Returns a new kwargs dict.
+    Parameters:
+        kwargs: the template's query-function kwargs
+        changed_column: the change-timestamp column
+        since: the high-water mark
+    """
+    kwargs = dict(kwargs)
+    cond_str = '{0} >= %s'.format(changed_column)
+    if kwargs.get('where_str'):
+        cond_str = '(' + kwargs['where_str'] + ') AND (' + cond_str + ')'
+    kwargs['where_str'] = cond_str
+    kwargs['where_args'] = list(kwargs.get('where_args', [])) + [since]
+    return kwargs
+
+
+def restrict_to_keys(kwargs, keys):
+    """
+    Restrict the first key column in query-function kwargs to some values.
+    Returns a new kwargs dict.
+    Parameters:
+        kwargs: the template's query-function kwargs
+        keys: a sequence of values for the first key column
+    Dependencies:
+        classes: KeyValues
+    """
+    kwargs = dict(kwargs)
+    key_cv = kwargs['key_cv']
+    kwargs['key_cv'] = ([(key_cv[0][0], key_cv[0][1], KeyValues(keys))] +
+                        list(key_cv[1:]))
+    kwargs['value_cv'] = list(kwargs['value_cv'])
+    return kwargs
+
+
+def process_template(t_index, s_db, s_cur, d_db, d_cur):
+
+    """
+    Read, diff, and (if necessary) sync the data for a single template.
+
+    In an incremental run (see the incremental setting), only the
+    source rows changed since the template's high-water mark are read,
+    and the destination read is restricted to their keys; the new
+    high-water mark is recorded in incremental_pending (see
+    commit_incremental_state()).
+
+    If there is a current destination snapshot (see dest_snapshot_file),
+    it is used instead of reading the destination database.
+
+    When resuming an interrupted run (see resume_point), the rows
+    already synced are skipped; progress is recorded with
+    checkpoints.checkpoint_key().
+
+    The reads use the databases' read replicas, if there are any (see
+    pools.get_read_db()); the changes use the primary connections.
+
+    Each phase is timed (see metrics.start_phase()), and its progress is logged
+    as it goes (see progress.start_progress()).
+
+    Returns a boolean indicating if the global destination callbacks are
+    needed, or None if the template loop should be stopped.
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+        s_db: the source-database connection object to use
+        s_cur: the source-database cursor object to use
+        d_db: the destination-database connection object to use
+        d_cur: the destination-database cursor object to use
+
+    Dependencies:
+        config settings: debug, reverse, bidir, source_query_func,
+                         dest_query_func, templates, incremental
+        globals: (some of) T_*, incremental_pending, snapshots.dest_snapshot,
+                 checkpoints.resume_point, template_changes,
+                 INCREMENTAL_MAX_KEYS
+        functions: key_filter(), group_rows_by_keys(), do_diff_sync(),
+                   dispatch_batch_callbacks(), get_db_time(),
+                   get_incremental_hwm(), restrict_to_changed(),
+                   restrict_to_keys(), snapshots.load_dest_snapshot(),
+                   snapshots.save_dest_snapshot(),
+                   snapshots.update_dest_snapshot(),
+                   checkpoints.skip_done_rows(), checkpoints.checkpoint_key(),
+                   pools.get_read_db(), metrics.start_phase(),
+                   metrics.end_phase(), progress.start_progress(),
+                   progress.advance_progress(), progress.finish_progress(),
+                   (functions in templates)
+        classes: LazyPps, LazyFormat
+        modules: collections, nori, snapshots, checkpoints, pools, metrics,
+                 progress
+
+    """
+
+    # get settings
+    template = nori.core.cfg['templates'][t_index]
+    t_name = template[T_NAME_KEY]
+    t_multiple = template[T_MULTIPLE_KEY]
+    if not nori.core.cfg['reverse']:
+        source_func = nori.core.cfg['source_query_func']
+        source_args = template[T_S_QUERY_ARGS_KEY][0]
+        source_kwargs = template[T_S_QUERY_ARGS_KEY][1]
+        to_dest_func = template[T_TO_D_FUNC_KEY]
+        dest_func = nori.core.cfg['dest_query_func']
+        dest_args = template[T_D_QUERY_ARGS_KEY][0]
+        dest_kwargs = template[T_D_QUERY_ARGS_KEY][1]
+        to_source_func = template[T_TO_S_FUNC_KEY]
+        changed_column = template[T_S_CHANGED_KEY]
+    else:
+        source_func = nori.core.cfg['dest_query_func']
+        source_args = template[T_D_QUERY_ARGS_KEY][0]
+        source_kwargs = template[T_D_QUERY_ARGS_KEY][1]
+        to_dest_func = template[T_TO_S_FUNC_KEY]
+        dest_func = nori.core.cfg['source_query_func']
+        dest_args = template[T_S_QUERY_ARGS_KEY][0]
+        dest_kwargs = template[T_S_QUERY_ARGS_KEY][1]
+        to_source_func = template[T_TO_D_FUNC_KEY]
+        changed_column = template[T_D_CHANGED_KEY]
+
+    # log template start
+    nori.core.status_logger.info(
+        'Processing template {0}...'.format(nori.pps(t_name))
+    )
+
+    # the connections to read from (replicas, if possible)
+    s_read_db, s_read_cur = pools.get_read_db(
+        s_db, s_cur, cv_seq=source_kwargs['key_cv'] + source_kwargs['value_cv']
+    )
+    d_read_db, d_read_cur = pools.get_read_db(
+        d_db, d_cur, cv_seq=dest_kwargs['key_cv'] + dest_kwargs['value_cv']
+    )
+
+    # incremental run?  (get the new high-water mark first, so changes
+    # made during the read will be picked up next time)
+    metrics.start_phase(t_index, 'source read')
+    progress.start_progress(t_index, 'source read')
+    since = None
+    if nori.core.cfg['incremental'] and changed_column is not None:
+        new_hwm = get_db_time(s_read_db, s_read_cur)
+        if new_hwm is None:
+            progress.finish_progress('source read')
+            metrics.end_phase()
+            return None
+        since = get_incremental_hwm(t_index)
+        incremental_pending[t_index] = (
+            new_hwm, time.time() if since is None else None
+        )
+        if since is not None:
+            nori.core.status_logger.info(
+                'Reading source rows changed since {0}.'.format(since)
+            )
+            source_kwargs = restrict_to_changed(source_kwargs,
+                                                changed_column, since)
+
+    # get the source data
+    s_rows_raw = source_func(*source_args, db_obj=s_read_db,
+                             db_cur=s_read_cur, mode='read', scope=None,
+                             **source_kwargs)
+    if s_rows_raw is None:
+        # shouldn't actually happen; errors will cause the script to
+        # exit before this, as currently written
+        progress.finish_progress('source read')
+        metrics.end_phase()
+        return None
+    progress.finish_progress('source read')
+    metrics.end_phase(len(s_rows_raw))
+
+    # s_rows is a list of tuples in the format (num_keys, data), where
+    # the data is a raw row (a tuple) from source_func())
+    metrics.start_phase(t_index, 'source transform/filter')
+    progress.start_progress(t_index, 'source transform/filter',
+                            len(s_rows_raw))
+    s_rows = []
+    for s_row_raw in s_rows_raw:
+        progress.advance_progress('source transform/filter')
+
+        # apply transform
+        if to_dest_func:
+            s_num_keys, s_row = to_dest_func(template, s_row_raw)
+        else:
+            s_num_keys = len(source_kwargs['key_cv'])
+            s_row = s_row_raw
+
+        # filter by keys
+        if not key_filter(t_index, s_num_keys, s_row):
+            continue
+
+        # add to the list
+        s_rows.append((s_num_keys, s_row))
+    progress.finish_progress('source transform/filter')
+    metrics.end_phase(len(s_rows))
+    nori.core.status_logger.debug(LazyFormat(
+        'Transformed and filtered source rows:\n{0}', LazyPps(s_rows)
+    ))
+
+    # resuming an interrupted run in the middle of this template?
+    done_keys = None
+    if (checkpoints.resume_point is not None and
+          checkpoints.resume_point[0] == t_index):
+        s_rows, done_keys = checkpoints.skip_done_rows(
+            s_rows, checkpoints.resume_point[1]
+        )
+        # the changes made before the interruption still need the batch
+        # change callbacks
+        template_changes[0:0] = checkpoints.resume_point[2]
+        checkpoints.resume_point = None
+
+    # in an incremental run, only the changed keys are needed from the
+    # destination (used as an ordered set); the read itself is only
+    # restricted if there is no destination snapshot to fill
+    changed_keys = None
+    if since is not None:
+        changed_keys = collections.OrderedDict()
+        for s_row in s_rows:
+            changed_keys[s_row[1][0]] = True
+        if (snapshots.dest_snapshot is None and changed_keys and
+              len(changed_keys) <= INCREMENTAL_MAX_KEYS and
+              len(dest_kwargs['key_cv'][0]) == 2):
+            dest_kwargs = restrict_to_keys(dest_kwargs, list(changed_keys))
+
+    # get the destination data, from the snapshot if there's a current
+    # one; d_rows_all is a list of tuples in the format (num_keys, data),
+    # where the data is a raw row (a tuple) from dest_func(), after the
+    # transform
+    metrics.start_phase(t_index, 'dest read')
+    progress.start_progress(t_index, 'dest read')
+    d_rows_all = None
+    if snapshots.dest_snapshot is not None:
+        d_rows_all = snapshots.load_dest_snapshot(t_index)
+    if d_rows_all is None:
+        if (snapshots.dest_snapshot is None and changed_keys is not None and
+              not changed_keys):
+            d_rows_raw = []
+        else:
+            d_rows_raw = dest_func(*dest_args, db_obj=d_read_db,
+                                   db_cur=d_read_cur, mode='read',
+                                   scope=None, **dest_kwargs)
         if d_rows_raw is None:
             # shouldn't actually happen; errors will cause the
             # script to exit before this, as currently written
-            break
-
-        # d_rows is a list of tuples in the format (num_keys, data), where
-        # the data is a raw row (a tuple) from dest_func())
-        d_rows = []
+            progress.finish_progress('dest read')
+            metrics.end_phase()
+            return None
+    progress.finish_progress('dest read')
+    metrics.end_phase(len(d_rows_raw if d_rows_all is None else d_rows_all))
+
+    metrics.start_phase(t_index, 'dest transform/filter')
+    if d_rows_all is None:
+        progress.start_progress(t_index, 'dest transform/filter',
+                                len(d_rows_raw))
+        d_rows_all = []
         for d_row_raw in d_rows_raw:
+            progress.advance_progress('dest transform/filter')
+
             # apply transform
             if to_source_func:
                 d_num_keys, d_row = to_source_func(template, d_row_raw)
@@ -7199,71 +10460,260 @@ def run_mode_hook():
                 d_num_keys = len(dest_kwargs['key_cv'])
                 d_row = d_row_raw
 
-            # filter by keys
-            if not key_filter(t_index, d_num_keys, d_row):
-                continue
-
             # add to the list
-            d_rows.append((d_num_keys, d_row))
-        nori.core.status_logger.debug(
-            'Transformed and filtered destination rows:\n' +
-            nori.core.pps(d_rows)
-        )
+            d_rows_all.append((d_num_keys, d_row))
+        progress.finish_progress('dest transform/filter')
 
-        # dispatch the actual diff(s)/sync(s)
-        if not t_multiple:
-            if do_diff_sync(t_index, s_rows, d_rows, d_db, d_cur):
-                global_callbacks_needed = True
-        else:
-            # group by keys
-            s_row_groups = collections.OrderedDict()
-            for s_row in s_rows:
-                s_num_keys = s_row[0]
-                s_data = s_row[1]
-                if s_data[0:s_num_keys] not in s_row_groups:
-                    s_row_groups[s_data[0:s_num_keys]] = []
-                s_row_groups[s_data[0:s_num_keys]].append(s_row)
-            d_row_groups = collections.OrderedDict()
-            for d_row in d_rows:
-                d_num_keys = d_row[0]
-                d_data = d_row[1]
-                if d_data[0:d_num_keys] not in d_row_groups:
-                    d_row_groups[d_data[0:d_num_keys]] = []
-                d_row_groups[d_data[0:d_num_keys]].append(d_row)
-
-            # dispatch by group
-            d_keys_found = []
-            for s_keys in s_row_groups:
-                if s_keys in d_row_groups:
-                    d_keys_found.append(s_keys)
-                    if do_diff_sync(t_index, s_row_groups[s_keys],
-                                    d_row_groups[s_keys], d_db, d_cur):
-                        global_callbacks_needed = True
-                else:
+        if snapshots.dest_snapshot is not None:
+            snapshots.save_dest_snapshot(t_index, d_rows_all)
+
+    # d_rows is the same, but filtered
+    d_rows = []
+    for d_row in d_rows_all:
+        # filter by keys
+        if not key_filter(t_index, d_row[0], d_row[1]):
+            continue
+        if changed_keys is not None and d_row[1][0] not in changed_keys:
+            continue
+        if done_keys and d_row[1][0:d_row[0]] in done_keys:
+            continue
+
+        # add to the list
+        d_rows.append(d_row)
+    metrics.end_phase(len(d_rows))
+    nori.core.status_logger.debug(LazyFormat(
+        'Transformed and filtered destination rows:\n{0}', LazyPps(d_rows)
+    ))
+
+    # dispatch the actual diff(s)/sync(s)
+    metrics.start_phase(t_index, 'diff')
+    progress.start_progress(t_index, 'diff', len(s_rows))
+    progress.start_progress(t_index, 'sync writes', unit='operations')
+    global_callbacks_needed = False
+    if not t_multiple:
+        if do_diff_sync(t_index, s_rows, d_rows, d_db, d_cur):
+            global_callbacks_needed = True
+    else:
+        # group by keys
+        s_row_groups = group_rows_by_keys(s_rows)
+        d_row_groups = group_rows_by_keys(d_rows)
+
+        # dispatch by group
+        d_keys_found = []
+        for s_keys in s_row_groups:
+            if s_keys in d_row_groups:
+                d_keys_found.append(s_keys)
+                if do_diff_sync(t_index, s_row_groups[s_keys],
+                                d_row_groups[s_keys], d_db, d_cur):
+                    global_callbacks_needed = True
+            else:
+                # not even a key match
+                if do_diff_sync(t_index, s_row_groups[s_keys], [], d_db,
+                                d_cur):
+                    global_callbacks_needed = True
+            checkpoints.checkpoint_key(t_index, s_keys, template_changes,
+                                       drupal_touched_entities)
+        if nori.core.cfg['bidir']:
+            for d_keys in d_row_groups:
+                if d_keys not in d_keys_found:
                     # not even a key match
-                    if do_diff_sync(t_index, s_row_groups[s_keys], [], d_db,
-                                    d_cur):
+                    if do_diff_sync(t_index, [], d_row_groups[d_keys],
+                                    d_db, d_cur):
                         global_callbacks_needed = True
-            if nori.core.cfg['bidir']:
-                for d_keys in d_row_groups:
-                    if d_keys not in d_keys_found:
-                        # not even a key match
-                        if do_diff_sync(t_index, [], d_row_groups[d_keys],
-                                        d_db, d_cur):
-                            global_callbacks_needed = True
+    progress.finish_progress('sync writes')
+    progress.finish_progress('diff')
+    metrics.end_phase(len(s_rows) + len(d_rows))
+
+    # batch change callbacks (first, update the snapshot with the changes)
+    snapshots.update_dest_snapshot(t_index, template_changes,
+                                   t_index in failed_templates)
+    dispatch_batch_callbacks(t_index, d_db, d_cur)
+
+    # log template finish
+    nori.core.status_logger.info(
+        'Template {0} finished.'.format(nori.pps(t_name))
+    )
+
+    return global_callbacks_needed
+
 
-        # log template finish
+def run_cycle(s_db, s_cur, d_db, d_cur, register_atexit=True):
+
+    """
+    Do a single diff / sync run (or sync plan application).
+
+    Parameters:
+        s_db: the source-database connection object to use
+        s_cur: the source-database cursor object to use
+        d_db: the destination-database connection object to use
+        d_cur: the destination-database cursor object to use
+        register_atexit: if true, register the post-action callbacks
+                         to be called on abnormal exit; if false, the
+                         caller is responsible for this (see
+                         run_daemon())
+
+    Dependencies:
+        config settings: action, reverse, readonly_window,
+                         pre_action_callbacks, post_action_callbacks,
+                         source_global_change_callbacks,
+                         dest_global_change_callbacks, templates,
+                         diff_memory_limit, diff_spill_dir, report_format,
+                         incremental
+        globals: post_action_callbacks, diff_store, metrics.diff_counts,
+                 sync_plan, sync_plan_diffs, incremental_pending,
+                 checkpoints.checkpoint, metrics.run_start_time,
+                 metrics.monotonic, T_NAME_KEY
+        functions: dispatch_post_action_callbacks(), template_is_selected(),
+                   process_template(), write_phase_deferred(),
+                   start_snapshot(), end_snapshot(), pools.get_read_db(),
+                   write_phase_drupal_readonly(), execute_sync_ops(),
+                   apply_sync_plan(), write_sync_plan(),
+                   read_incremental_state(), commit_incremental_state(),
+                   snapshots.open_dest_snapshot(),
+                   snapshots.close_dest_snapshot(),
+                   checkpoints.start_checkpoint(),
+                   checkpoints.checkpoint_template(),
+                   checkpoints.resumed_changes_made(),
+                   checkpoints.finish_checkpoint(), open_jsonl_report(),
+                   close_jsonl_report(), do_diff_report(),
+                   metrics.start_phase(), metrics.end_phase(),
+                   metrics.write_metrics_file(),
+                   metrics.write_prometheus_file(),
+                   metrics.close_slow_query_log(),
+                   progress.close_progress_file(), profiling.profile_section(),
+                   metrics.start_memory_tracking(),
+                   metrics.stop_memory_tracking(), (callback functions)
+        classes: DiffStore
+        modules: atexit, nori, metrics, checkpoints, pools, snapshots,
+                 progress, profiling
+
+    """
+
+    global diff_store
+
+    metrics.run_start_time = metrics.monotonic()
+    metrics.start_memory_tracking()
+
+    # set up the diff storage and the streaming report
+    diff_store = DiffStore(nori.core.cfg['diff_memory_limit'],
+                           nori.core.cfg['diff_spill_dir'])
+    open_jsonl_report()
+
+    # get the incremental high-water marks and the destination snapshot
+    if nori.core.cfg['incremental']:
+        read_incremental_state()
+    snapshots.open_dest_snapshot()
+
+    # set up checkpoints / resume
+    checkpoints.start_checkpoint(drupal_touched_entities)
+
+    # register post-action callbacks
+    pa = nori.core.cfg['post_action_callbacks']
+    if pa and (True in [cb_t[3] for cb_t in pa]):
         nori.core.status_logger.info(
-            'Template {0} finished.'.format(nori.pps(t_name))
+            'Registering post-action callbacks.'
         )
+        for i, (cb, args, kwargs, reg) in enumerate(pa):
+            if not reg:
+                continue
+            post_action_callbacks.append((cb, args, kwargs))
+        if register_atexit:
+            atexit.register(dispatch_post_action_callbacks, True, s_db,
+                            s_cur, d_db, d_cur)
+
+    # pre-action callbacks
+    pa = nori.core.cfg['pre_action_callbacks']
+    num_cbs = len(pa)
+    metrics.start_phase(None, 'pre-action callbacks')
+    with profiling.profile_section(phase='pre-action'):
+        for i, (cb, args, kwargs) in enumerate(pa):
+            nori.core.status_logger.info(
+                'Calling pre-action callback {0} of {1}...' .
+                format((i + 1), num_cbs)
+            )
+            ret = cb(*args, s_db=s_db, s_cur=s_cur, d_db=d_db, d_cur=d_cur,
+                     **kwargs)
+            nori.core.status_logger.info(
+                'Callback complete.' if ret else 'Callback failed.'
+            )
+    metrics.end_phase(num_cbs)
+
+    global_callbacks_needed = False
+    loop_stopped = False
+    if nori.core.cfg['action'] == 'apply':
+        # apply a previously-generated sync plan instead of diffing
+        global_callbacks_needed = apply_sync_plan(d_db, d_cur)
+    else:
+        # read and diff inside consistent snapshots, and make the
+        # changes afterwards?
+        deferred = write_phase_deferred()
+        if deferred:
+            nori.core.status_logger.info(
+                'Starting consistent-snapshot read transactions...'
+            )
+            s_read_db, s_read_cur = pools.get_read_db(s_db, s_cur)
+            d_read_db, d_read_cur = pools.get_read_db(d_db, d_cur)
+            s_db_ac = start_snapshot(s_read_db, s_read_cur)
+            d_db_ac = start_snapshot(d_read_db, d_read_cur)
+            nori.core.status_logger.info('Transactions started.')
+
+        # log that we're starting the loop;
+        # especially important in case the loop produces no output
+        nori.core.status_logger.info('Starting template loop.')
+
+        # template loop (if resuming, the interrupted run's changes
+        # still need the global callbacks)
+        if checkpoints.resumed_changes_made():
+            global_callbacks_needed = True
+        for t_index, template in enumerate(nori.core.cfg['templates']):
+            # filter by template
+            if not template_is_selected(template):
+                continue
+
+            # already done before an interruption?
+            if (checkpoints.checkpoint is not None and
+                  t_index in checkpoints.checkpoint['done']):
+                nori.core.status_logger.info(
+                    'Skipping template {0} (already done).' .
+                    format(nori.pps(template[T_NAME_KEY]))
+                )
+                continue
 
-        #
-        # end of template loop
-        #
+            with profiling.profile_section(t_index):
+                ret = process_template(t_index, s_db, s_cur, d_db, d_cur)
+            if ret is None:
+                loop_stopped = True
+                break
+            if ret:
+                global_callbacks_needed = True
+            if not deferred:
+                commit_incremental_state([t_index])
+            checkpoints.checkpoint_template(t_index, ret, template_changes,
+                                            drupal_touched_entities)
+
+        # log that we've finished the loop;
+        # especially important in case the loop produces no output
+        nori.core.status_logger.info('Template loop complete.')
+
+        # deferred write phase
+        if deferred:
+            end_snapshot(d_read_db, d_read_cur, d_db_ac)
+            end_snapshot(s_read_db, s_read_cur, s_db_ac)
+            nori.core.status_logger.info(
+                'Read transactions finished; starting write phase with '
+                '{0} change(s).'.format(len(sync_plan))
+            )
+            if sync_plan:
+                write_phase_drupal_readonly(s_db, s_cur, d_db, d_cur)
+                if execute_sync_ops(sync_plan, d_db, d_cur, sync_plan_diffs,
+                                    True):
+                    global_callbacks_needed = True
+            nori.core.status_logger.info('Write phase complete.')
+            commit_incremental_state(list(incremental_pending))
 
-    # log that we've finished the loop;
-    # especially important in case the loop produces no output
-    nori.core.status_logger.info('Template loop complete.')
+    # save the sync plan
+    if nori.core.cfg['action'] == 'plan':
+        write_sync_plan()
 
     # global change callbacks
     if global_callbacks_needed:
@@ -7272,6 +10722,7 @@ def run_mode_hook():
         else:
             gccb = nori.core.cfg['source_global_change_callbacks']
         num_cbs = len(gccb)
+        metrics.start_phase(None, 'global callbacks')
         for i, (cb, args, kwargs) in enumerate(gccb):
             nori.core.status_logger.info(
                 'Calling global change callback {0} of {1}...' .
@@ -7281,19 +10732,226 @@ def run_mode_hook():
             nori.core.status_logger.info(
                 'Callback complete.' if ret else 'Callback failed.'
             )
+        metrics.end_phase(num_cbs)
+
+    # the run is complete; the checkpoint is only removed now, so the
+    # global callbacks are retried if they are interrupted
+    if not loop_stopped:
+        checkpoints.finish_checkpoint()
 
     # post-action callbacks
-    dispatch_post_action_callbacks(False, s_db, s_cur, d_db, d_cur)
+    metrics.start_phase(None, 'post-action callbacks')
+    with profiling.profile_section(phase='post-action'):
+        dispatch_post_action_callbacks(False, s_db, s_cur, d_db, d_cur)
+    metrics.end_phase(len(post_action_callbacks))
 
     # email/log report
-    if diff_dict:
+    close_jsonl_report()
+    if ((diff_store or metrics.diff_counts) and
+          nori.core.cfg['report_format'] in ['text', 'both']):
         do_diff_report()
+    diff_store.close()
+    snapshots.close_dest_snapshot()
+    metrics.close_slow_query_log()
+    progress.close_progress_file()
+    metrics.write_metrics_file()
+    metrics.write_prometheus_file()
+    metrics.stop_memory_tracking()
 
-    # close DB connections
-    d_db.close_cursor(d_cur)
-    d_db.close()
-    s_db.close_cursor(s_cur)
-    s_db.close()
+
+def reset_run_state():
+
+    """
+    Reset the per-run global state, so another run can be done in the
+    same process (see run_daemon()).
+
+    This also cleans up after a run that was aborted partway through.
+
+    Dependencies:
+        globals: post_action_callbacks, s_drupal_readonly, d_drupal_readonly,
+                 drupal_touched_entities, drupal_updated_keys, diff_store,
+                 metrics.diff_counts, diff_samples, metrics.sync_op_counts,
+                 sync_plan, sync_plan_diffs, template_changes,
+                 incremental_pending, failed_templates,
+                 snapshots.dest_snapshot_dirty, checkpoints.checkpoint,
+                 checkpoints.resume_point, pools.written_dbs,
+                 metrics.phase_timings, metrics.phase_stack,
+                 metrics.phase_memory, metrics.run_start_time,
+                 metrics.query_stats, metrics.last_query_stats,
+                 metrics.statement_counts, progress.progress_counters
+        functions: close_jsonl_report(), snapshots.close_dest_snapshot(),
+                   metrics.close_slow_query_log(),
+                   progress.close_progress_file(),
+                   metrics.stop_memory_tracking(), clear_drupal_lookup_cache()
+        modules: metrics, snapshots, checkpoints, pools, progress
+
+    """
+
+    global s_drupal_readonly, d_drupal_readonly
+
+    del post_action_callbacks[:]
+    s_drupal_readonly = None
+    d_drupal_readonly = None
+    drupal_touched_entities.clear()
+    drupal_updated_keys.clear()
+    if diff_store is not None:
+        diff_store.close()
+    metrics.diff_counts.clear()
+    diff_samples.clear()
+    metrics.sync_op_counts.clear()
+    del sync_plan[:]
+    del sync_plan_diffs[:]
+    del template_changes[:]
+    incremental_pending.clear()
+    failed_templates.clear()
+    snapshots.dest_snapshot_dirty.clear()
+    pools.written_dbs.clear()
+    metrics.phase_timings.clear()
+    del metrics.phase_stack[:]
+    metrics.phase_memory.clear()
+    progress.progress_counters.clear()
+    metrics.run_start_time = None
+    metrics.query_stats.clear()
+    metrics.last_query_stats = None
+    metrics.statement_counts.clear()
+    checkpoints.checkpoint = None
+    checkpoints.resume_point = None
+    close_jsonl_report()
+    snapshots.close_dest_snapshot()
+    metrics.close_slow_query_log()
+    progress.close_progress_file()
+    metrics.stop_memory_tracking()
+    clear_drupal_lookup_cache()
+
+
+def run_mode_hook():
+    """
+    Do the actual work.
+    Dependencies:
+        functions: pools.connect_dbs(), run_cycle(), pools.close_db_pools(),
+                   dbtrace.close_db_trace()
+        modules: pools, dbtrace
+    """
+    s_db, s_cur, d_db, d_cur = pools.connect_dbs()
+    run_cycle(s_db, s_cur, d_db, d_cur)
+    pools.close_db_pools()
+    dbtrace.close_db_trace()
+
+
+def daemon_signal_handler(signum, frame):
+    """
+    Handle signals in daemon mode.
+    The signal is acted on between runs; see run_daemon().
+    Parameters:
+        see the signal module
+    Dependencies:
+        globals: daemon_signal
+        modules: signal, nori
+    """
+    global daemon_signal
+    daemon_signal = 'reload' if signum == signal.SIGHUP else 'stop'
+    nori.core.status_logger.info(
+        'Received signal {0}; will {1} after the current run.' .
+        format(signum, daemon_signal)
+    )
+
+
+def daemon_atexit():
+    """
+    Call the post-action callbacks on abnormal exit in daemon mode.
+    Dependencies:
+        globals: daemon_dbs
+        functions: dispatch_post_action_callbacks()
+    """
+    if daemon_dbs is not None:
+        dispatch_post_action_callbacks(True, *daemon_dbs)
+
+
+def run_daemon():
+
+    """
+    Script mode to do diff / sync runs repeatedly.
+
+    The database connections (and any SSH tunnels) are kept open in
+    their pools between runs (see DBPool); the rest of the per-run
+    state, including the Drupal lookup cache, is reset after each run
+    (see reset_run_state()).  Runs start every daemon_interval seconds;
+    if a run fails, the connections are reset, and the next run is
+    delayed by an exponential backoff instead (see daemon_retry_delay
+    and daemon_max_backoff).
+
+    SIGHUP causes the script to re-execute itself after the current run,
+    which reloads the configuration (including the templates); SIGTERM
+    causes it to exit after the current run.
+
+    Dependencies:
+        config settings: daemon_interval, daemon_retry_delay,
+                         daemon_max_backoff
+        globals: daemon_signal, daemon_dbs
+        functions: daemon_signal_handler(), daemon_atexit(),
+                   pools.connect_dbs(), run_cycle(), pools.release_dbs(),
+                   pools.close_db_pools(), reset_run_state(),
+                   dispatch_post_action_callbacks()
+        modules: sys, os, atexit, signal, time, nori, pools
+
+    """
+
+    global daemon_dbs
+
+    signal.signal(signal.SIGHUP, daemon_signal_handler)
+    signal.signal(signal.SIGTERM, daemon_signal_handler)
+    atexit.register(daemon_atexit)
+
+    num_failures = 0
+    while True:
+        cycle_start = time.time()
+        nori.core.status_logger.info('Starting daemon run.')
+        try:
+            if daemon_dbs is None:
+                daemon_dbs = pools.connect_dbs()
+            run_cycle(*daemon_dbs, register_atexit=False)
+        except (Exception, SystemExit) as e:
+            num_failures += 1
+            nori.core.email_logger.error(
+                'Warning: daemon run failed ({0}); resetting the database '
+                'connections.'.format(nori.pps(e))
+            )
+            if daemon_dbs is not None:
+                try:
+                    dispatch_post_action_callbacks(True, *daemon_dbs)
+                    pools.close_db_pools()
+                except (Exception, SystemExit):
+                    pass
+                daemon_dbs = None
+        else:
+            num_failures = 0
+            nori.core.status_logger.info('Daemon run complete.')
+            # keep the connections open, but health-check them before
+            # the next run
+            pools.release_dbs(*daemon_dbs)
+            daemon_dbs = None
+        reset_run_state()
+
+        # wait for the next run
+        if not num_failures:
+            wake_time = cycle_start + nori.core.cfg['daemon_interval']
+        else:
+            wake_time = time.time() + min(
+                (nori.core.cfg['daemon_retry_delay'] *
+                 2 ** (num_failures - 1)),
+                nori.core.cfg['daemon_max_backoff']
+            )
+        while daemon_signal is None and time.time() < wake_time:
+            time.sleep(max(0, min(1, wake_time - time.time())))
+
+        # handle signals
+        if daemon_signal is not None:
+            pools.close_db_pools()
+            if daemon_signal == 'stop':
+                nori.core.status_logger.info('Daemon exiting.')
+                return
+            nori.core.status_logger.info('Daemon reloading.')
+            os.execv(sys.executable, [sys.executable] + sys.argv)
 
 
 ########################################################################
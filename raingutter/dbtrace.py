@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+
+
+"""
+This is the database tracing (record / replay) module for the raingutter
+database diff and sync tool; see __main__.py for license and usage
+information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import atexit
+import collections
+import copy
+import time
+import gzip
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from . import metrics
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# constants
+############
+
+# the format version of database trace files; see write_db_trace()
+DB_TRACE_VERSION = 1
+
+
+############
+# run state
+############
+
+# the open database trace file stream, when recording, and the trace
+# contents (a DBTrace object), when replaying; see the db_trace_mode
+# setting
+db_trace_stream = None
+
+db_trace = None
+
+
+########################################################################
+#                               CLASSES
+########################################################################
+
+#####################################
+# database tracing (record / replay)
+#####################################
+
+class RecordingDB(object):
+
+    """
+    A wrapper around a nori DBMS object that records its calls to the
+    database trace file (see the db_trace_mode setting and
+    write_db_trace()).
+
+    Only the calls whose results come from the database are recorded;
+    everything else is passed straight through.  Each wrapper (i.e.,
+    each connection, as copies are made for the connection pools) has
+    its own connection number in the trace, so the results of
+    interleaved queries can be told apart.
+
+    """
+
+    # the last connection number used
+    last_conn = 0
+
+    def __init__(self, db_obj, name):
+        """
+        Populate the instance variables.
+        Parameters:
+            db_obj: the nori DBMS object to wrap
+            name: the name of the database (e.g., 'sourcedb')
+        """
+        self.db_obj = db_obj
+        self.name = name
+        RecordingDB.last_conn += 1
+        self.conn = RecordingDB.last_conn
+
+    def __copy__(self):
+        """
+        Copy the wrapped object as well (see DBPool).
+        """
+        return RecordingDB(copy.copy(self.db_obj), self.name)
+
+    def __getattr__(self, attr):
+        """
+        Pass everything else through.
+        """
+        return getattr(self.db_obj, attr)
+
+    def _record(self, method, args, ret, start):
+        """
+        Record a call and its result.
+        Returns ret.
+        """
+        write_db_trace((self.name, self.conn, method, args, ret,
+                        metrics.monotonic() - start))
+        return ret
+
+    def execute(self, db_cur, query_str, query_args=None,
+                has_results=False):
+        """
+        Execute and record a query (see nori's DBMS.execute()).
+        """
+        start = metrics.monotonic()
+        ret = self.db_obj.execute(db_cur, query_str, query_args,
+                                  has_results=has_results)
+        return self._record('execute', (query_str, query_args), ret, start)
+
+    def fetchall(self, db_cur):
+        """
+        Fetch and record the results of a query.
+        """
+        start = metrics.monotonic()
+        ret = self.db_obj.fetchall(db_cur)
+        return self._record('fetchall', (), ret, start)
+
+    def fetchmany(self, db_cur, size):
+        """
+        Fetch and record a batch of the results of a query (see
+        core.db_fetchmany()); the batch is fetched from the DB-API cursor
+        directly.
+        """
+        start = metrics.monotonic()
+        try:
+            ret = (True, list(db_cur.fetchmany(size)))
+        except Exception as e:
+            nori.core.email_logger.error(
+                'Error: could not fetch the query results: {0}'.format(e)
+            )
+            ret = (False, None)
+        return self._record('fetchmany', (size, ), ret, start)
+
+    def get_last_id(self, db_cur):
+        """
+        Get and record the last auto-increment ID.
+        """
+        start = metrics.monotonic()
+        ret = self.db_obj.get_last_id(db_cur)
+        return self._record('get_last_id', (), ret, start)
+
+    def get_table_list(self, db_cur):
+        """
+        Get and record the list of tables.
+        """
+        start = metrics.monotonic()
+        ret = self.db_obj.get_table_list(db_cur)
+        return self._record('get_table_list', (), ret, start)
+
+    def replication(self, db_cur, state):
+        """
+        Get or set (and record) the replication state.
+        """
+        start = metrics.monotonic()
+        ret = self.db_obj.replication(db_cur, state)
+        return self._record('replication', (state, ), ret, start)
+
+
+class DBTrace(object):
+
+    """
+    The contents of a database trace file, indexed for replay.
+
+    Each recorded query is stored with the result of the fetchall() that
+    followed it (on the same connection), if any; the batches from
+    fetchmany() calls are joined into a single result.  Queries are matched
+    by SQL and arguments if possible, otherwise by SQL alone; other
+    calls are matched by method and arguments.  Either way, each
+    recorded result is served once, in the recorded order.
+
+    """
+
+    def __init__(self):
+        """
+        Populate the instance variables.
+        """
+        # lists of [served, ret, fetchall_ret, seconds], keyed by
+        # (name, query, repr(args)), and by (name, query)
+        self.queries = {}
+        self.queries_any_args = {}
+        # lists of [served, ret, seconds], keyed by
+        # (name, method, repr(args))
+        self.calls = {}
+        # the last query entry for each (name, connection number)
+        self.last_query = {}
+
+    @staticmethod
+    def _query_key(query_str):
+        """
+        Normalize a query string (or sequence of strings) for lookups.
+        """
+        if not isinstance(query_str, nori.core.STRING_TYPES):
+            query_str = ' '.join(query_str)
+        return query_str.strip()
+
+    def add(self, record):
+        """
+        Add a record from the trace file.
+        Parameters:
+            record: a tuple of (name, connection number, method,
+                    arguments, return value, seconds)
+        """
+        name, conn, method, args, ret, seconds = record
+        if method == 'execute':
+            entry = [False, ret, None, seconds]
+            query = self._query_key(args[0])
+            for index, key in [
+                    (self.queries, (name, query, repr(args[1]))),
+                    (self.queries_any_args, (name, query))]:
+                if key not in index:
+                    index[key] = collections.deque()
+                index[key].append(entry)
+            self.last_query[(name, conn)] = entry
+        elif method == 'fetchall':
+            entry = self.last_query.get((name, conn))
+            if entry is not None:
+                entry[2] = ret
+                entry[3] += seconds
+        elif method == 'fetchmany':
+            entry = self.last_query.get((name, conn))
+            if entry is not None:
+                if entry[2] is None or not entry[2][0] or not ret[0]:
+                    entry[2] = (ret[0], list(ret[1] or []))
+                else:
+                    entry[2][1].extend(ret[1])
+                entry[3] += seconds
+        else:
+            key = (name, method, repr(args))
+            if key not in self.calls:
+                self.calls[key] = collections.deque()
+            self.calls[key].append([False, ret, seconds])
+
+    @staticmethod
+    def _next(queue):
+        """
+        Get (and mark as served) the next unserved entry in a queue.
+        Returns the entry, or None.
+        """
+        while queue:
+            entry = queue.popleft()
+            if not entry[0]:
+                entry[0] = True
+                return entry
+        return None
+
+    def next_query(self, name, query_str, query_args):
+        """
+        Get the recorded results of a query.
+        Returns a list of [served, ret, fetchall_ret, seconds], or None
+        if there is no matching query left.
+        """
+        query = self._query_key(query_str)
+        entry = self._next(
+            self.queries.get((name, query, repr(query_args)), [])
+        )
+        if entry is None:
+            entry = self._next(self.queries_any_args.get((name, query),
+                                                         []))
+        return entry
+
+    def next_call(self, name, method, args):
+        """
+        Get the recorded result of a call other than a query.
+        Returns a list of [served, ret, seconds], or None if there is no
+        matching call left.
+        """
+        return self._next(self.calls.get((name, method, repr(args)), []))
+
+
+class ReplayDB(object):
+
+    """
+    A stand-in for a nori DBMS object that serves results from a
+    database trace (see DBTrace) instead of connecting to a database.
+
+    Each call sleeps for the recorded time, or for the db_replay_latency
+    setting if it isn't None.
+
+    """
+
+    def __init__(self, name, trace):
+        """
+        Populate the instance variables.
+        Parameters:
+            name: the name of the database (e.g., 'sourcedb')
+            trace: the DBTrace object to serve results from
+        """
+        self.name = name
+        self.trace = trace
+        self.ac = True
+        self.fetch_ret = None
+
+    def __copy__(self):
+        """
+        Make a new connection using the same trace (see DBPool).
+        """
+        return ReplayDB(self.name, self.trace)
+
+    def _missing(self, what):
+        """
+        Exit because a call wasn't in the trace.
+        Dependencies:
+            modules: sys, nori
+        """
+        nori.core.email_logger.error(
+            'Error: no recorded result for {0} on {1} in the database '
+            'trace file; exiting.'.format(what, self.name)
+        )
+        sys.exit(nori.core.exitvals['db_trace']['num'])
+
+    def _sleep(self, seconds):
+        """
+        Simulate the latency of a call.
+        Dependencies:
+            config settings: db_replay_latency
+            modules: time, nori
+        """
+        if nori.core.cfg['db_replay_latency'] is not None:
+            seconds = nori.core.cfg['db_replay_latency']
+        if seconds > 0:
+            time.sleep(seconds)
+
+    #
+    # connection and transaction handling: there's nothing to do, except
+    # keep track of the autocommit state
+    #
+
+    def connect(self):
+        return True
+
+    def close(self):
+        return True
+
+    def cursor(self, *args, **kwargs):
+        return object()
+
+    def close_cursor(self, db_cur):
+        return True
+
+    def autocommit(self, ac):
+        if ac is None:
+            return self.ac
+        self.ac = ac
+        return True
+
+    def commit(self):
+        return True
+
+    def rollback(self):
+        return True
+
+    #
+    # recorded calls
+    #
+
+    def execute(self, db_cur, query_str, query_args=None,
+                has_results=False):
+        """
+        Replay a query (see nori's DBMS.execute()).
+        """
+        entry = self.trace.next_query(self.name, query_str, query_args)
+        if entry is None:
+            self._missing('query {0} (args {1})' .
+                          format(nori.pps(query_str), nori.pps(query_args)))
+        self._sleep(entry[3])
+        self.fetch_ret = entry[2]
+        return entry[1]
+
+    def fetchall(self, db_cur):
+        """
+        Replay the results of the last query.
+        """
+        if self.fetch_ret is None:
+            self._missing('fetchall()')
+        ret = self.fetch_ret
+        self.fetch_ret = None
+        return ret
+
+    def fetchmany(self, db_cur, size):
+        """
+        Replay the next batch of the results of the last query.
+        """
+        if self.fetch_ret is None:
+            self._missing('fetchmany()')
+        if not self.fetch_ret[0]:
+            ret = self.fetch_ret
+            self.fetch_ret = None
+            return ret
+        rows = self.fetch_ret[1] or []
+        self.fetch_ret = (True, rows[size:])
+        return (True, rows[0:size])
+
+    def _call(self, method, args):
+        """
+        Replay any other call.
+        """
+        entry = self.trace.next_call(self.name, method, args)
+        if entry is None:
+            self._missing(method + '()')
+        self._sleep(entry[2])
+        return entry[1]
+
+    def get_last_id(self, db_cur):
+        return self._call('get_last_id', ())
+
+    def get_table_list(self, db_cur):
+        return self._call('get_table_list', ())
+
+    def replication(self, db_cur, state):
+        return self._call('replication', (state, ))
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+##############
+# trace files
+##############
+
+def write_db_trace(record):
+
+    """
+    Write a record to the database trace file, opening it if necessary.
+
+    The file is a gzip-compressed series of pickles: first a dict with
+    the element version (DB_TRACE_VERSION), then the records, each a
+    tuple of (database name, connection number, method, arguments,
+    return value, seconds); see RecordingDB.
+
+    Parameters:
+        record: the record tuple
+
+    Dependencies:
+        config settings: db_trace_file
+        globals: db_trace_stream, DB_TRACE_VERSION
+        functions: close_db_trace()
+        modules: sys, atexit, gzip, pickle, nori
+
+    """
+
+    global db_trace_stream
+
+    try:
+        if db_trace_stream is None:
+            db_trace_stream = gzip.open(nori.core.cfg['db_trace_file'],
+                                        'wb')
+            atexit.register(close_db_trace)
+            pickle.dump(dict(version=DB_TRACE_VERSION), db_trace_stream,
+                        pickle.HIGHEST_PROTOCOL)
+        pickle.dump(record, db_trace_stream, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        nori.core.email_logger.error(
+            'Error: could not write to the database trace file {0}:\n{1}\n'
+            'Exiting.'.format(nori.pps(nori.core.cfg['db_trace_file']), e)
+        )
+        sys.exit(nori.core.exitvals['db_trace']['num'])
+
+
+def close_db_trace():
+    """
+    Close the database trace file stream, if it's open.
+    Dependencies:
+        globals: db_trace_stream
+    """
+    global db_trace_stream
+    if db_trace_stream is not None:
+        db_trace_stream.close()
+        db_trace_stream = None
+
+
+def read_db_trace():
+
+    """
+    Read the database trace file for replay, if it hasn't been read yet.
+
+    Returns a DBTrace object.
+
+    A trace that ends early (e.g., because the recording run was
+    interrupted) is used as far as it goes.
+
+    Dependencies:
+        config settings: db_trace_file
+        globals: db_trace, DB_TRACE_VERSION
+        classes: DBTrace
+        modules: sys, gzip, pickle, nori
+
+    """
+
+    global db_trace
+
+    if db_trace is not None:
+        return db_trace
+    trace_file = nori.core.cfg['db_trace_file']
+    nori.core.status_logger.info(
+        'Reading database trace file {0}...'.format(nori.pps(trace_file))
+    )
+    trace = DBTrace()
+    num_records = 0
+    try:
+        with gzip.open(trace_file, 'rb') as f:
+            header = pickle.load(f)
+            if (not isinstance(header, dict) or
+                  header.get('version') != DB_TRACE_VERSION):
+                nori.core.email_logger.error(
+                    'Error: database trace file {0} has an unknown '
+                    'format; exiting.'.format(nori.pps(trace_file))
+                )
+                sys.exit(nori.core.exitvals['db_trace']['num'])
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                trace.add(record)
+                num_records += 1
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as e:
+        if not num_records:
+            nori.core.email_logger.error(
+                'Error: could not read database trace file {0}:\n{1}\n'
+                'Exiting.'.format(nori.pps(trace_file), e)
+            )
+            sys.exit(nori.core.exitvals['db_trace']['num'])
+        nori.core.email_logger.error(
+            'Warning: database trace file {0} is truncated ({1});\n'
+            'using the first {2} record(s).' .
+            format(nori.pps(trace_file), e, num_records)
+        )
+    nori.core.status_logger.info(
+        'Database trace read ({0} record(s)).'.format(num_records)
+    )
+    db_trace = trace
+    return db_trace
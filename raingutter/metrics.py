@@ -0,0 +1,813 @@
+#!/usr/bin/env python
+
+
+"""
+This is the run metrics module for the raingutter database diff and sync
+tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import os
+import collections
+import time
+import json
+
+try:
+    import resource
+except ImportError:  # not Unix
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from .template_keys import *
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# constants
+############
+
+# the phases timed by start_phase() / end_phase(), in report order
+TIMING_PHASES = [
+    'pre-action callbacks',
+    'source read',
+    'source transform/filter',
+    'dest read',
+    'dest transform/filter',
+    'diff',
+    'sync writes',
+    'template callbacks',
+    'global callbacks',
+    'post-action callbacks',
+    'report',
+]
+
+# the clock used for timing (monotonic where available, i.e., Python
+# 3.3+; otherwise, the wall clock)
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+############
+# run state
+############
+
+# For each template index, an OrderedDict of diff category names (see
+# core.render_diff_category()) and counts.  This is kept for every
+# action, for the run's metrics (see get_run_metrics()); in the 'count'
+# action, where no diffs are kept, it's also the basis of the report
+# (see core.render_count_report()).
+diff_counts = collections.OrderedDict()
+
+# for each template index, an OrderedDict of (sync mode, outcome) tuples
+# and counts, where the outcome is 'full', 'partial', or 'failed' (see
+# core.do_sync())
+sync_op_counts = collections.OrderedDict()
+
+# The per-phase timings for the current run (see start_phase()): an
+# OrderedDict keyed by template index, or None for the phases outside
+# the template loop; the values are dictionaries of phase names (see
+# TIMING_PHASES) and lists of [seconds, rows, calls].  The seconds
+# don't include time spent in nested phases (e.g., sync writes within
+# the diff phase).
+phase_timings = collections.OrderedDict()
+
+# the phases currently being timed, innermost last; each entry is a list
+# of [template index, phase name, start time, time in nested phases,
+# peak traced memory in nested phases]
+phase_stack = []
+
+# The per-phase memory use for the current run, if the memory_stats
+# setting is true (see end_phase()): an OrderedDict keyed like
+# phase_timings; the values are dictionaries of phase names and lists of
+# [peak RSS, peak traced memory, top allocation sites], where the sizes
+# are in bytes and the sites are lists of (file:line, bytes, blocks)
+# tuples from the end of the phase with the largest traced peak (empty
+# for nested phases).
+phase_memory = collections.OrderedDict()
+
+# the start time of the current run (from monotonic())
+run_start_time = None
+
+# The database query statistics for the current run (see
+# core.db_execute()), if the query_stats setting is true: an OrderedDict
+# keyed by tuples of (template index, Drupal chain type, function name),
+# where the template index is None outside the template loop and the
+# chain type (see core.get_drupal_chain_type()) is None outside
+# core.drupal_db_query(); the values are lists of [statements, seconds,
+# rows fetched, bytes fetched].
+query_stats = collections.OrderedDict()
+
+# the statistics entry for the last statement executed, for
+# core.db_fetchall()
+last_query_stats = None
+
+# the number of database statements executed in the current run (see
+# core.db_execute()), kept regardless of the query_stats setting; the
+# keys are template indexes (None outside the template loop)
+statement_counts = collections.OrderedDict()
+
+# the Drupal chain type of the current call to core.drupal_db_query(), if
+# any; also reset at the start and end of each timed phase (see
+# start_phase())
+query_chain_type = None
+
+# the open slow-query log stream, if any; see log_slow_query()
+slow_query_stream = None
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+################
+# phase timings
+################
+
+def start_phase(t_index, phase):
+    """
+    Start timing a phase of the run (see phase_timings).
+    Phases can be nested; end them with end_phase().
+    Parameters:
+        t_index: the index of the template in the templates setting, or
+                 None for phases outside the template loop
+        phase: the name of the phase (see TIMING_PHASES)
+    Dependencies:
+        globals: phase_stack, query_chain_type, monotonic
+        modules: tracemalloc
+    """
+    global query_chain_type
+    query_chain_type = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        # fold the peak so far into the enclosing phase before
+        # starting a new measurement
+        if phase_stack:
+            phase_stack[-1][4] = max(phase_stack[-1][4],
+                                     tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+            tracemalloc.reset_peak()
+    phase_stack.append([t_index, phase, monotonic(), 0.0, 0])
+
+
+def end_phase(rows=None):
+
+    """
+    Finish timing the innermost phase started by start_phase().
+
+    The time spent in the phase (not counting nested phases) is added to
+    phase_timings, along with the number of rows handled; if the
+    memory_stats setting is true, the memory use is recorded in
+    phase_memory.
+
+    Parameters:
+        rows: the number of rows (or other items) handled, or None
+
+    Dependencies:
+        config settings: memory_stats
+        globals: phase_timings, phase_stack, query_chain_type, monotonic
+        functions: record_phase_memory()
+        modules: nori
+
+    """
+
+    global query_chain_type
+
+    query_chain_type = None
+    t_index, phase, start, nested, nested_peak = phase_stack.pop()
+    elapsed = monotonic() - start
+    if phase_stack:
+        phase_stack[-1][3] += elapsed
+    if nori.core.cfg['memory_stats']:
+        peak = record_phase_memory(t_index, phase, nested_peak,
+                                   not phase_stack)
+        if phase_stack:
+            phase_stack[-1][4] = max(phase_stack[-1][4], peak)
+    if t_index not in phase_timings:
+        phase_timings[t_index] = {}
+    if phase not in phase_timings[t_index]:
+        phase_timings[t_index][phase] = [0.0, 0, 0]
+    timing = phase_timings[t_index][phase]
+    timing[0] += elapsed - nested
+    if rows is not None:
+        timing[1] += rows
+    timing[2] += 1
+
+
+#########
+# memory
+#########
+
+def start_memory_tracking():
+    """
+    Start tracing memory allocations, if the memory_stats setting is
+    true (see end_phase()).
+    Dependencies:
+        config settings: memory_stats
+        modules: tracemalloc, nori
+    """
+    if not nori.core.cfg['memory_stats']:
+        return
+    if tracemalloc is None:
+        nori.core.email_logger.error(
+            "Warning: the tracemalloc module isn't available (it requires "
+            'Python 3.4+);\nonly the peak RSS will be recorded.'
+        )
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_memory_tracking():
+    """
+    Stop tracing memory allocations (see start_memory_tracking()).
+    Dependencies:
+        modules: tracemalloc
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of the process so far.
+    Returns the size in bytes, or None if it isn't available.
+    Dependencies:
+        modules: sys, resource
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, KiB elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def record_phase_memory(t_index, phase, nested_peak, outermost):
+
+    """
+    Record the memory use at the end of a phase in phase_memory.
+
+    Snapshots of the traced allocations are expensive, so the top
+    allocation sites are only recorded for outermost phases; nested
+    phases (such as the per-row sync writes) only record the peaks.
+
+    Returns the peak traced memory during the phase, including nested
+    phases (0 if allocations aren't being traced).
+
+    Parameters:
+        t_index, phase: see start_phase()
+        nested_peak: the peak traced memory in nested phases
+        outermost: True if the phase isn't nested inside another one
+
+    Dependencies:
+        config settings: memory_top_sites
+        globals: phase_memory
+        functions: get_peak_rss()
+        modules: tracemalloc, nori
+
+    """
+
+    peak = 0
+    sites = []
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        peak = max(tracemalloc.get_traced_memory()[1], nested_peak)
+    if (outermost and tracemalloc is not None and
+          tracemalloc.is_tracing()):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        for stat in snapshot.statistics('lineno')[
+                :nori.core.cfg['memory_top_sites']]:
+            frame = stat.traceback[0]
+            sites.append(('{0}:{1}'.format(frame.filename, frame.lineno),
+                          stat.size, stat.count))
+    if t_index not in phase_memory:
+        phase_memory[t_index] = {}
+    memory = phase_memory[t_index].get(phase)
+    if memory is None or peak >= memory[1]:
+        phase_memory[t_index][phase] = [get_peak_rss(), peak, sites]
+    else:
+        memory[0] = get_peak_rss()
+    return peak
+
+
+###################
+# query statistics
+###################
+
+def estimate_rows_bytes(rows):
+    """
+    Estimate the size of a set of query results, as text.
+    Returns an integer.
+    Parameters:
+        rows: a sequence of row tuples
+    Dependencies:
+        modules: nori
+    """
+    total = 0
+    for row in rows:
+        for value in row:
+            if value is None:
+                continue
+            if isinstance(value, nori.core.STRING_TYPES + (bytes,
+                                                           bytearray)):
+                total += len(value)
+            else:
+                total += len(str(value))
+    return total
+
+
+def log_slow_query(elapsed, t_index, func_name, query_str, query_args):
+
+    """
+    Append a slow query to the slow-query log, opening it if necessary.
+
+    Parameters:
+        elapsed: the time the query took, in seconds
+        t_index: the index of the current template in the templates
+                 setting, or None
+        func_name: the name of the function that ran the query
+        query_str: the query string (or sequence of strings)
+        query_args: the query arguments, or None
+
+    Dependencies:
+        config settings: slow_query_log_file, templates
+        globals: slow_query_stream, query_chain_type, T_NAME_KEY
+        modules: time, nori
+
+    """
+
+    global slow_query_stream
+
+    if slow_query_stream is None:
+        try:
+            slow_query_stream = open(nori.core.cfg['slow_query_log_file'],
+                                     'a')
+        except (IOError, OSError) as e:
+            nori.core.email_logger.error(
+                'Warning: could not open the slow-query log {0}; '
+                'slow queries\nwill not be logged:\n{1}' .
+                format(nori.pps(nori.core.cfg['slow_query_log_file']), e)
+            )
+            nori.core.cfg['slow_query_log_file'] = None
+            return
+    if not isinstance(query_str, nori.core.STRING_TYPES):
+        query_str = ' '.join(query_str)
+    context = func_name + '()'
+    if query_chain_type is not None:
+        context = '[{0}] {1}'.format(query_chain_type, context)
+    if t_index is not None:
+        context = ('template {0} ({1}), {2}' .
+                   format(t_index, nori.pps(
+                       nori.core.cfg['templates'][t_index][T_NAME_KEY]
+                   ), context))
+    slow_query_stream.write(
+        '# {0}  {1:.3f}s  {2}\n{3};\n# args: {4}\n\n' .
+        format(time.strftime('%Y-%m-%d %H:%M:%S'), elapsed, context,
+               query_str.strip(), nori.pps(query_args))
+    )
+    slow_query_stream.flush()
+
+
+def close_slow_query_log():
+    """
+    Close the slow-query log stream, if it's open.
+    Dependencies:
+        globals: slow_query_stream
+    """
+    global slow_query_stream
+    if slow_query_stream is not None:
+        slow_query_stream.close()
+        slow_query_stream = None
+
+
+#################
+# metrics output
+#################
+
+def get_run_metrics():
+
+    """
+    Collect the metrics for the current run.
+
+    Returns an OrderedDict with the elements:
+        total_seconds: the time since the start of the run
+        peak_rss: the peak resident set size of the process, in bytes
+                  (None if it isn't available)
+        templates: a list of OrderedDicts, one per template processed,
+                   with the elements index, name, phases (see below),
+                   diffs (an OrderedDict of diff categories and counts;
+                   see core.render_diff_category()), sync_ops (a list of
+                   OrderedDicts with the elements mode, outcome, and
+                   count; see sync_op_counts), and statements (the
+                   number of database statements executed)
+        run: the phases outside the template loop
+        run_statements: the number of database statements executed
+                        outside the template loop
+        queries: (only if the query_stats setting is true) a list of
+                 OrderedDicts, one per entry in query_stats, with the
+                 elements template_index, template_name, chain_type,
+                 function, statements, seconds, rows, and bytes
+    where the phases are OrderedDicts of phase names (see TIMING_PHASES)
+    and OrderedDicts with the elements seconds, rows, calls, and (only if
+    the memory_stats setting is true) memory; the memory is an
+    OrderedDict with the elements peak_rss, traced_peak (both in bytes),
+    and top_sites (a list of OrderedDicts with the elements site, bytes,
+    and blocks).
+
+    Dependencies:
+        config settings: templates, query_stats, memory_stats
+        globals: phase_timings, phase_memory, run_start_time,
+                 query_stats, statement_counts, diff_counts,
+                 sync_op_counts,
+                 monotonic, TIMING_PHASES, T_NAME_KEY
+        functions: get_peak_rss()
+        modules: collections, nori
+
+    """
+
+    def render_phases(t_index):
+        timings = phase_timings.get(t_index, {})
+        phases = collections.OrderedDict()
+        for phase in TIMING_PHASES:
+            if phase not in timings:
+                continue
+            seconds, rows, calls = timings[phase]
+            phases[phase] = collections.OrderedDict([
+                ('seconds', round(seconds, 6)),
+                ('rows', rows),
+                ('calls', calls),
+            ])
+            if not nori.core.cfg['memory_stats']:
+                continue
+            memory = phase_memory.get(t_index, {}).get(phase)
+            if memory is None:
+                continue
+            phases[phase]['memory'] = collections.OrderedDict([
+                ('peak_rss', memory[0]),
+                ('traced_peak', memory[1]),
+                ('top_sites', [
+                    collections.OrderedDict([
+                        ('site', site), ('bytes', size), ('blocks', count),
+                    ])
+                    for site, size, count in memory[2]
+                ]),
+            ])
+        return phases
+
+    metrics = collections.OrderedDict()
+    metrics['total_seconds'] = (
+        round(monotonic() - run_start_time, 6)
+        if run_start_time is not None else None
+    )
+    metrics['peak_rss'] = get_peak_rss()
+    metrics['templates'] = []
+    for t_index in phase_timings:
+        if t_index is None:
+            continue
+        template = nori.core.cfg['templates'][t_index]
+        metrics['templates'].append(collections.OrderedDict([
+            ('index', t_index),
+            ('name', template[T_NAME_KEY]),
+            ('phases', render_phases(t_index)),
+            ('diffs', collections.OrderedDict(
+                diff_counts.get(t_index, {})
+            )),
+            ('sync_ops', [
+                collections.OrderedDict([
+                    ('mode', mode), ('outcome', outcome), ('count', count),
+                ])
+                for (mode, outcome), count
+                in sync_op_counts.get(t_index, {}).items()
+            ]),
+            ('statements', statement_counts.get(t_index, 0)),
+        ]))
+    metrics['run'] = render_phases(None)
+    metrics['run_statements'] = statement_counts.get(None, 0)
+    if nori.core.cfg['query_stats']:
+        metrics['queries'] = []
+        for (t_index, chain_type, func_name), stats in query_stats.items():
+            metrics['queries'].append(collections.OrderedDict([
+                ('template_index', t_index),
+                ('template_name',
+                 nori.core.cfg['templates'][t_index][T_NAME_KEY]
+                 if t_index is not None else None),
+                ('chain_type', chain_type),
+                ('function', func_name),
+                ('statements', stats[0]),
+                ('seconds', round(stats[1], 6)),
+                ('rows', stats[2]),
+                ('bytes', stats[3]),
+            ]))
+    return metrics
+
+
+def format_bytes(size):
+    """
+    Format a size in bytes for the timings report.
+    Returns a string, e.g. '12.3 MiB', or 'n/a' if size is None.
+    """
+    if size is None:
+        return 'n/a'
+    for unit in ['B', 'KiB', 'MiB']:
+        if abs(size) < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024
+    return '{0:.1f} GiB'.format(size)
+
+
+def render_memory_report(memory):
+    """
+    Render the memory use of a phase for the timings report.
+    Returns a string.
+    Parameters:
+        memory: the memory element of a phase (see get_run_metrics())
+    Dependencies:
+        functions: format_bytes()
+    """
+    report = ('        memory: peak RSS {0}, peak traced {1}\n' .
+              format(format_bytes(memory['peak_rss']),
+                     format_bytes(memory['traced_peak'])))
+    for site in memory['top_sites']:
+        report += ('            {0:>10}  {1:>7} block(s)  {2}\n' .
+                   format(format_bytes(site['bytes']), site['blocks'],
+                          site['site']))
+    return report
+
+
+def render_timings_report():
+
+    """
+    Render the per-phase timings for the current run.
+
+    Returns a string.
+
+    Dependencies:
+        functions: get_run_metrics(), render_memory_report()
+        modules: nori
+
+    """
+
+    metrics = get_run_metrics()
+    sections = [('Template {0} ({1}):' .
+                 format(t_metrics['index'], nori.pps(t_metrics['name'])),
+                 t_metrics['phases'])
+                for t_metrics in metrics['templates']]
+    sections.append(('Outside the template loop:', metrics['run']))
+    report = 'Timings:\n--------\n\n'
+    for header, phases in sections:
+        if not phases:
+            continue
+        report += header + '\n'
+        for phase, timing in phases.items():
+            report += (
+                '    {0:<24} {1:>10.3f}s  {2:>9} row(s)  {3:>7} call(s)\n' .
+                format(phase + ':', timing['seconds'], timing['rows'],
+                       timing['calls'])
+            )
+            if 'memory' in timing:
+                report += render_memory_report(timing['memory'])
+        report += '\n'
+    if metrics['total_seconds'] is not None:
+        report += 'Total: {0:.3f}s\n'.format(metrics['total_seconds'])
+    return report.strip()
+
+
+def render_query_stats_report():
+
+    """
+    Render the database query statistics for the current run.
+
+    Returns a string.
+
+    Dependencies:
+        config settings: templates
+        globals: query_stats, T_NAME_KEY
+        modules: nori
+
+    """
+
+    # group by template (stable, so the order within each is kept)
+    stats_keys = sorted(query_stats,
+                        key=lambda k: (k[0] is not None, k[0] or 0))
+    report = 'Database queries:\n-----------------\n\n'
+    prev_t_index = False
+    for t_index, chain_type, func_name in stats_keys:
+        if t_index != prev_t_index:
+            if prev_t_index is not False:
+                report += '\n'
+            if t_index is None:
+                report += 'Outside the template loop:\n'
+            else:
+                report += (
+                    'Template {0} ({1}):\n' .
+                    format(t_index, nori.pps(
+                        nori.core.cfg['templates'][t_index][T_NAME_KEY]
+                    ))
+                )
+            prev_t_index = t_index
+        stats = query_stats[(t_index, chain_type, func_name)]
+        label = func_name + '()'
+        if chain_type is not None:
+            label += ' [{0}]'.format(chain_type)
+        report += (
+            '    {0}: {1} statement(s), {2:.3f}s, {3} row(s), {4} byte(s)\n' .
+            format(label, *stats)
+        )
+    return report.strip()
+
+
+def write_metrics_file():
+
+    """
+    Write the run's metrics to the metrics file, if there is one.
+
+    Dependencies:
+        config settings: metrics_file
+        functions: get_run_metrics()
+        modules: json, nori
+
+    """
+
+    if nori.core.cfg['metrics_file'] is None:
+        return
+    try:
+        with open(nori.core.cfg['metrics_file'], 'w') as f:
+            json.dump(get_run_metrics(), f, indent=2)
+            f.write('\n')
+    except (IOError, OSError) as e:
+        nori.core.email_logger.error(
+            'Warning: could not write the metrics file {0}:\n{1}' .
+            format(nori.pps(nori.core.cfg['metrics_file']), e)
+        )
+
+
+def render_prometheus_metrics(metrics):
+
+    """
+    Render the run's metrics in the Prometheus text exposition format.
+
+    The values describe the last run, so all of the metrics are gauges.
+    Per-template series are labelled with the template index as well as
+    the name, because template names aren't necessarily unique.
+
+    Returns a string.
+
+    Parameters:
+        metrics: the run's metrics (see get_run_metrics())
+
+    Dependencies:
+        config settings: templates
+        globals: T_NAME_KEY
+        modules: collections, time, nori
+
+    """
+
+    def escape(value):
+        return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    # metric name -> [help text, list of (labels, value) tuples]
+    families = collections.OrderedDict([
+        ('raingutter_last_run_timestamp_seconds',
+         ['Time the last run finished, in seconds since the epoch.',
+          [((), round(time.time(), 3))]]),
+        ('raingutter_run_duration_seconds',
+         ['Duration of the last run.', []]),
+        ('raingutter_peak_rss_bytes',
+         ['Peak resident set size of the last run.', []]),
+        ('raingutter_template_duration_seconds',
+         ['Time spent processing each template.', []]),
+        ('raingutter_template_peak_traced_bytes',
+         ['Peak memory traced by tracemalloc for each template.', []]),
+        ('raingutter_rows_read',
+         ['Rows read for each template, by side.', []]),
+        ('raingutter_diffs',
+         ['Diffs found for each template, by category.', []]),
+        ('raingutter_sync_operations',
+         ['Sync operations for each template, by mode and outcome.', []]),
+        ('raingutter_db_statements',
+         ['Database statements executed, by template (empty labels for '
+          'statements outside the template loop).', []]),
+    ])
+    if metrics['total_seconds'] is not None:
+        families['raingutter_run_duration_seconds'][1].append(
+            ((), metrics['total_seconds'])
+        )
+    if metrics['peak_rss'] is not None:
+        families['raingutter_peak_rss_bytes'][1].append(
+            ((), metrics['peak_rss'])
+        )
+    for t_metrics in metrics['templates']:
+        t_labels = (('template_index', t_metrics['index']),
+                    ('template', t_metrics['name']))
+        phases = t_metrics['phases']
+        families['raingutter_template_duration_seconds'][1].append(
+            (t_labels,
+             round(sum([p['seconds'] for p in phases.values()]), 6))
+        )
+        traced = [p['memory']['traced_peak'] for p in phases.values()
+                  if 'memory' in p]
+        if traced:
+            families['raingutter_template_peak_traced_bytes'][1].append(
+                (t_labels, max(traced))
+            )
+        for side in ['source', 'dest']:
+            if side + ' read' in phases:
+                families['raingutter_rows_read'][1].append(
+                    (t_labels + (('side', side), ),
+                     phases[side + ' read']['rows'])
+                )
+        for category, count in t_metrics['diffs'].items():
+            families['raingutter_diffs'][1].append(
+                (t_labels + (('category', category), ), count)
+            )
+        for sync_op in t_metrics['sync_ops']:
+            families['raingutter_sync_operations'][1].append(
+                (t_labels + (('mode', sync_op['mode']),
+                             ('outcome', sync_op['outcome'])),
+                 sync_op['count'])
+            )
+        families['raingutter_db_statements'][1].append(
+            (t_labels, t_metrics['statements'])
+        )
+    families['raingutter_db_statements'][1].append(
+        ((('template_index', ''), ('template', '')),
+         metrics['run_statements'])
+    )
+
+    lines = []
+    for name, (help_text, samples) in families.items():
+        if not samples:
+            continue
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} gauge'.format(name))
+        for labels, value in samples:
+            label_str = ','.join(['{0}="{1}"'.format(k, escape(v))
+                                  for k, v in labels])
+            lines.append('{0}{1} {2}' .
+                         format(name, '{' + label_str + '}' if labels
+                                else '', value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_file():
+
+    """
+    Write the run's metrics to the Prometheus file, if there is one.
+
+    The file is written under a temporary name and then renamed, so the
+    textfile collector never sees a partial file.
+
+    Dependencies:
+        config settings: prometheus_file
+        functions: get_run_metrics(), render_prometheus_metrics()
+        modules: os, nori
+
+    """
+
+    prom_file = nori.core.cfg['prometheus_file']
+    if prom_file is None:
+        return
+    # the collector only reads files ending in .prom
+    temp_file = prom_file + '.{0}.tmp'.format(os.getpid())
+    try:
+        with open(temp_file, 'w') as f:
+            f.write(render_prometheus_metrics(get_run_metrics()))
+        os.rename(temp_file, prom_file)
+    except (IOError, OSError) as e:
+        nori.core.email_logger.error(
+            'Warning: could not write the Prometheus metrics file {0}:\n'
+            '{1}'.format(nori.pps(prom_file), e)
+        )
@@ -40,6 +40,7 @@ import nori
 # this package
 ###############
 from . import core
+from . import pools
 
 
 ########################################################################
@@ -102,6 +103,49 @@ those settings for more information.
 templates = []
 
 
+############################ latest hardware ###########################
+
+# OCS keeps old hardware rows when a server is re-inventoried under a new
+# ID; only the latest one for each TAG is used.  The mapping is
+# materialized once per run, in a temporary table on the OCS connections
+# (see materialize_latest_hardware()), and the templates join against it.
+# The same ID can be the latest for more than one TAG (if a hardware row
+# has several accountinfo rows), so the IDs are made distinct and the
+# index isn't unique.
+LATEST_HARDWARE_TABLE = 'raingutter_latest_hardware'
+
+LATEST_HARDWARE_QUERIES = [
+    'DROP TEMPORARY TABLE IF EXISTS {0}'.format(LATEST_HARDWARE_TABLE),
+    (
+'''
+CREATE TEMPORARY TABLE {0} (INDEX (HARDWARE_ID))
+SELECT DISTINCT max(hardware.ID) AS HARDWARE_ID
+FROM hardware
+LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
+GROUP BY accountinfo.TAG
+'''.format(LATEST_HARDWARE_TABLE)
+    ),
+]
+
+
+def latest_hardware_tables(joins):
+    """
+    Build the tables string for a template, limited to the latest
+    hardware row for each TAG.
+    Returns a string.
+    Parameters:
+        joins: the template's own JOIN clauses, as a string
+    Dependencies:
+        globals: LATEST_HARDWARE_TABLE
+    """
+    return (
+        'hardware\n'
+        'INNER JOIN {0} ON {0}.HARDWARE_ID = hardware.ID\n'
+        'INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID\n'
+        .format(LATEST_HARDWARE_TABLE) + joins
+    )
+
+
 ##################### single-valued direct fields ######################
 
 def os_strings(osname, osversion):
@@ -154,10 +198,8 @@ def single_direct_to_drupal(template, row):
 templates.append(dict(
     name='single-valued direct fields',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-LEFT JOIN bios ON bios.HARDWARE_ID = hardware.ID
+        tables=latest_hardware_tables(
+'''LEFT JOIN bios ON bios.HARDWARE_ID = hardware.ID
 LEFT JOIN memories ON memories.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
@@ -184,12 +226,7 @@ LEFT JOIN memories ON memories.HARDWARE_ID = hardware.ID'''
             ('FLOOR((hardware.SWAP / 1024) * 1000) / 1000', 'decimal',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND (memories.TYPE <> 'FLASH' OR memories.TYPE IS NULL)
+"""(memories.TYPE <> 'FLASH' OR memories.TYPE IS NULL)
 AND ((memories.CAPACITY <> '0' AND memories.CAPACITY <> 'No')
      OR memories.CAPACITY IS NULL)"""
         ),
@@ -197,6 +234,7 @@ AND ((memories.CAPACITY <> '0' AND memories.CAPACITY <> 'No')
         more_str='GROUP BY hardware.ID ORDER BY accountinfo.TAG',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=single_direct_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -223,10 +261,8 @@ AND ((memories.CAPACITY <> '0' AND memories.CAPACITY <> 'No')
 templates.append(dict(
     name='default gateway',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-LEFT JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''LEFT JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -236,12 +272,7 @@ LEFT JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
             ('MIN(INET_ATON(networks.IPGATEWAY))', 'ip',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT MAX(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND networks.IPGATEWAY IS NOT NULL
+"""networks.IPGATEWAY IS NOT NULL
 AND networks.IPGATEWAY <> ''
 AND networks.IPGATEWAY <> '0.0.0.0'"""
         ),
@@ -249,6 +280,7 @@ AND networks.IPGATEWAY <> '0.0.0.0'"""
         more_str='GROUP BY hardware.ID ORDER BY accountinfo.TAG',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     dest_query_args=([], dict(
         key_cv=[
             (('node', 'server', 'title'), 'string',),
@@ -287,10 +319,8 @@ def dimms_to_drupal(template, row):
 templates.append(dict(
     name='DIMMs',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN memories ON memories.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''INNER JOIN memories ON memories.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -307,12 +337,7 @@ INNER JOIN memories ON memories.HARDWARE_ID = hardware.ID'''
             ('memories.SERIALNUMBER', 'string',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND (memories.TYPE <> 'FLASH' OR memories.TYPE IS NULL)
+"""(memories.TYPE <> 'FLASH' OR memories.TYPE IS NULL)
 AND ((memories.CAPACITY <> '0' AND memories.CAPACITY <> 'No')
      OR memories.CAPACITY IS NULL)"""
         ),
@@ -320,6 +345,7 @@ AND ((memories.CAPACITY <> '0' AND memories.CAPACITY <> 'No')
         more_str='ORDER BY accountinfo.TAG, memories.NUMSLOTS',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=dimms_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -361,10 +387,8 @@ def volumes_to_drupal(template, row):
 templates.append(dict(
     name='volumes',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN drives ON drives.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''INNER JOIN drives ON drives.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -377,12 +401,7 @@ INNER JOIN drives ON drives.HARDWARE_ID = hardware.ID'''
             ('FLOOR(drives.TOTAL / 1024)', 'integer',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND drives.FILESYSTEM <> 'nfs'
+"""drives.FILESYSTEM <> 'nfs'
 AND drives.FILESYSTEM <> 'NFS'
 AND drives.FILESYSTEM <> 'smb'
 AND drives.FILESYSTEM <> 'SMB'"""
@@ -391,6 +410,7 @@ AND drives.FILESYSTEM <> 'SMB'"""
         more_str='ORDER BY accountinfo.TAG',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=volumes_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -433,10 +453,8 @@ def nfs_to_drupal(template, row):
 templates.append(dict(
     name='NFS mounts',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN drives ON drives.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''INNER JOIN drives ON drives.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -447,17 +465,13 @@ INNER JOIN drives ON drives.HARDWARE_ID = hardware.ID'''
             ('drives.VOLUMN', 'string',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND (drives.FILESYSTEM = 'nfs' OR drives.FILESYSTEM = 'NFS')"""
+"""(drives.FILESYSTEM = 'nfs' OR drives.FILESYSTEM = 'NFS')"""
         ),
         where_args=[],
         more_str='ORDER BY accountinfo.TAG',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=nfs_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -495,10 +509,8 @@ def ports_to_drupal(template, row):
 templates.append(dict(
     name='ports: main',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -508,17 +520,12 @@ INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
             ('networks.STATUS', 'string',),
             ('networks.MACADDR', 'string',),
         ],
-        where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)"""
-        ),
+        where_str=None,
         where_args=[],
         more_str='ORDER BY accountinfo.TAG, networks.DESCRIPTION',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=ports_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -557,10 +564,8 @@ templates.append(dict(
     name='ports: IPs',
     multiple_values=True,
     source_query_args=([], dict(
-        tables=(
-"""hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID"""
+        tables=latest_hardware_tables(
+'''INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -571,12 +576,7 @@ INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID"""
             ('INET_ATON(networks.IPADDRESS)', 'ip',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND networks.IPADDRESS IS NOT NULL
+"""networks.IPADDRESS IS NOT NULL
 AND networks.IPADDRESS <> ''
 AND networks.IPADDRESS <> '0.0.0.0'"""
         ),
@@ -584,6 +584,7 @@ AND networks.IPADDRESS <> '0.0.0.0'"""
         more_str='ORDER BY accountinfo.TAG, networks.DESCRIPTION',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=ips_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -603,10 +604,8 @@ templates.append(dict(
     name='IP view',
     multiple_values=True,
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -616,12 +615,7 @@ INNER JOIN networks ON networks.HARDWARE_ID = hardware.ID'''
             ('INET_ATON(networks.IPADDRESS)', 'integer',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND networks.IPADDRESS IS NOT NULL
+"""networks.IPADDRESS IS NOT NULL
 AND networks.IPADDRESS <> ''
 AND networks.IPADDRESS <> '0.0.0.0'"""
         ),
@@ -629,6 +623,7 @@ AND networks.IPADDRESS <> '0.0.0.0'"""
         more_str='ORDER BY accountinfo.TAG, networks.DESCRIPTION',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     dest_query_args=([], dict(
         key_cv=[
             (('node', 'server', 'title'), 'string',),
@@ -698,10 +693,8 @@ def software_to_drupal(template, row):
 templates.append(dict(
     name='software versions',
     source_query_args=([], dict(
-        tables=(
-'''hardware
-INNER JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-INNER JOIN softwares ON softwares.HARDWARE_ID = hardware.ID'''
+        tables=latest_hardware_tables(
+'''INNER JOIN softwares ON softwares.HARDWARE_ID = hardware.ID'''
         ),
         key_cv=[
             ('accountinfo.TAG', 'string',),
@@ -712,17 +705,13 @@ INNER JOIN softwares ON softwares.HARDWARE_ID = hardware.ID'''
             ('softwares.COMMENTS', 'string',),
         ],
         where_str=(
-"""hardware.ID IN
-    (SELECT max(hardware.ID)
-     FROM hardware
-     LEFT JOIN accountinfo ON accountinfo.HARDWARE_ID = hardware.ID
-     GROUP BY accountinfo.TAG)
-AND ({0})""".format(namelist_str)
+"""({0})""".format(namelist_str)
         ),
         where_args=namelist,
         more_str='ORDER BY accountinfo.TAG, softwares.NAME',
         more_args=[],
     )),
+    source_changed_column='hardware.LASTDATE',
     to_dest_func=software_to_drupal,
     dest_query_args=([], dict(
         key_cv=[
@@ -765,10 +754,21 @@ def process_config_hook():
     Do last-minute initializations based on config settings.
     Immediately added to the necessary hook after being defined.
     Dependencies:
-        config_settings: only_server_list, pre_action_callbacks
-        functions: only_server_list()
-        modules: nori
+        config_settings: only_server_list, pre_action_callbacks,
+                         templates
+        globals: LATEST_HARDWARE_TABLE
+        functions: only_server_list(), materialize_latest_hardware()
+        modules: nori, core
     """
+    # the latest-hardware table has to exist before anything else reads
+    # from OCS
+    for template in nori.core.cfg['templates']:
+        t_kwargs = template[core.T_S_QUERY_ARGS_KEY][1]
+        if LATEST_HARDWARE_TABLE in str(t_kwargs.get('tables')):
+            nori.core.cfg['pre_action_callbacks'].insert(
+                0, (materialize_latest_hardware, [], {})
+            )
+            break
     if nori.core.cfg['only_server_list']:
         nori.core.cfg['pre_action_callbacks'].append(
             (only_server_list, [],
@@ -778,6 +778,52 @@ def process_config_hook():
 nori.core.process_config_hooks.append(process_config_hook)
 
 
+def materialize_latest_hardware(s_db, s_cur, d_db, d_cur):
+
+    """
+    Create the temporary table of the latest hardware ID for each TAG.
+
+    The table is created on the OCS database's primary connection, and
+    on its read replica connection, if there is one (temporary tables
+    only exist within the connection that created them).  Any existing
+    copy from a previous run is replaced.
+
+    If the table can't be created, exits with an error; every template
+    reads from it, so there would be nothing to process.  (In daemon
+    mode, this fails the current run, which is retried later.)
+
+    Parameters:
+        see the pre_action_callbacks setting
+
+    Dependencies:
+        config settings: reverse
+        globals: LATEST_HARDWARE_QUERIES
+        functions: pools.get_read_db(), core.db_execute()
+        modules: sys, nori
+
+    """
+
+    # OCS is the source database, before 'reverse' is applied
+    if nori.core.cfg['reverse']:
+        ocs_db, ocs_cur = d_db, d_cur
+    else:
+        ocs_db, ocs_cur = s_db, s_cur
+    connections = [(ocs_db, ocs_cur)]
+    read_db, read_cur = pools.get_read_db(ocs_db, ocs_cur, consistent=False)
+    if read_db is not ocs_db:
+        connections.append((read_db, read_cur))
+
+    for db_obj, db_cur in connections:
+        for query_str in LATEST_HARDWARE_QUERIES:
+            if not core.db_execute(db_obj, db_cur, query_str.strip()):
+                nori.core.email_logger.error(
+                    'Error: could not create the latest-hardware table '
+                    'in the OCS database; exiting.'
+                )
+                sys.exit(nori.core.exitvals['dbms_execute']['num'])
+    return True
+
+
 def get_server_list(db_obj, db_cur, db_type):
 
     """
@@ -812,9 +858,10 @@ ORDER BY title
         )
 
     # execute the query
-    if not db_obj.execute(db_cur, query_str.strip(), has_results=True):
+    if not core.db_execute(db_obj, db_cur, query_str.strip(),
+                           has_results=True):
         return None
-    ret = db_obj.fetchall(db_cur)
+    ret = core.db_fetchall(db_obj, db_cur)
     if not ret[0]:
         return None
 
@@ -835,12 +882,14 @@ def only_server_list(s_db, s_cur, d_db, d_cur, which_db='source'):
     Dependencies:
         config settings: reverse, source_type, dest_type, key_mode,
                          key_list
-        functions: get_server_list()
+        functions: get_server_list(), pools.get_read_db()
         modules: collections, nori
 
     """
 
-    # un-reverse source and dest
+    # un-reverse source and dest (using the read replicas, if any)
+    s_db, s_cur = pools.get_read_db(s_db, s_cur)
+    d_db, d_cur = pools.get_read_db(d_db, d_cur)
     if nori.core.cfg['reverse']:
         real_s_db = d_db
         real_s_cur = d_cur
@@ -918,8 +967,9 @@ def server_list_diff():
 
     Dependencies:
         config settings: source_type, dest_type
-        functions: get_server_list()
-        modules: sys, collections, nori, core
+        functions: get_server_list(), pools.get_read_db_pool(),
+                   pools.close_db_pools()
+        modules: sys, collections, nori, pools
 
     """
 
@@ -933,14 +983,8 @@ def server_list_diff():
     nori.logging_init_output()
 
     # connect to DBs
-    sourcedb = core.sourcedb
-    sourcedb.connect()
-    sourcedb.autocommit(True)
-    sourcecur = sourcedb.cursor(False)
-    destdb = core.destdb
-    destdb.connect()
-    destdb.autocommit(True)
-    destcur = destdb.cursor(False)
+    sourcedb, sourcecur = pools.get_read_db_pool('sourcedb').checkout()
+    destdb, destcur = pools.get_read_db_pool('destdb').checkout()
 
     # get lists
     server_list_s = get_server_list(sourcedb, sourcecur,
@@ -1037,10 +1081,7 @@ def server_list_diff():
     nori.core.output_logger.info('\n\n' + server_diffs + '\n\n')
 
     # close DB connections
-    destdb.close_cursor(destcur)
-    destdb.close()
-    sourcedb.close_cursor(sourcecur)
-    sourcedb.close()
+    pools.close_db_pools()
 
 
 ########################################################################
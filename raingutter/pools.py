@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+
+"""
+This is the database connection pool module for the raingutter database
+diff and sync tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import copy
+import contextlib
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from . import dbtrace
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# resources
+############
+
+sourcedb = nori.MySQL('sourcedb')
+
+destdb = nori.MySQL('destdb')
+
+# optional read replicas of the databases above; see the sourcedb_replica
+# and destdb_replica settings
+sourcedb_replica = nori.MySQL('sourcedb_replica')
+
+destdb_replica = nori.MySQL('destdb_replica')
+
+# connection pools for the databases above; see get_db_pool()
+db_pools = {}
+
+
+############
+# run state
+############
+
+# For read-replica routing: the replica connections to use for reads,
+# as tuples of (db_obj, db_cur), keyed by id() of the primary connection
+# objects; see connect_dbs() and get_read_db().
+read_dbs = {}
+
+# The fields written to during the current run, for read-replica
+# routing: sets of field identifiers (see cv_idents()), keyed by id() of
+# the primary connection objects; see core.query_dispatcher() and
+# get_read_db().
+written_dbs = {}
+
+
+########################################################################
+#                               CLASSES
+########################################################################
+
+############################
+# database connection pools
+############################
+
+class DBPool(object):
+
+    """
+    A pool of connections to a database.
+
+    The first connection uses the supplied nori DBMS object itself (so it
+    can still be used directly, as before); the others use copies of it,
+    made before it is connected, so they have the same settings.  Each
+    connection has its own cursor.  The number of connections is taken
+    from a config setting (by default, <name>_pool_size) when the pool is
+    first used.
+
+    Connections are opened when they're first checked out.  After that,
+    they're health-checked on each checkout, and reopened if necessary.
+    Idle connections are in autocommit mode; the autocommit state is set
+    on checkout and restored on checkin (with a rollback of anything
+    left uncommitted).
+
+    """
+
+    def __init__(self, db_obj, name, size_setting=None):
+        """
+        Populate the instance variables.
+        Parameters:
+            db_obj: the nori DBMS object to base the connections on
+            name: the name of the database (e.g., 'sourcedb'), for
+                  settings and messages
+            size_setting: the name of the pool-size config setting, if
+                          not <name>_pool_size
+        """
+        self.db_obj = db_obj
+        self.name = name
+        self.size_setting = (size_setting if size_setting is not None
+                             else name + '_pool_size')
+        self.db_objs = None
+        self.cursors = {}
+        self.free = []
+
+    def _init_slots(self):
+        """
+        Create the DBMS objects for the connections, if necessary.
+        Dependencies:
+            modules: copy, nori
+        """
+        if self.db_objs is not None:
+            return
+        self.db_objs = [self.db_obj]
+        for i in range(nori.core.cfg[self.size_setting] - 1):
+            self.db_objs.append(copy.copy(self.db_obj))
+        self.free = list(reversed(range(len(self.db_objs))))
+
+    def _connect(self, i):
+        """
+        Open connection number i.
+        """
+        db_obj = self.db_objs[i]
+        db_obj.connect()
+        db_obj.autocommit(True)
+        self.cursors[i] = db_obj.cursor(False)
+
+    def _disconnect(self, i):
+        """
+        Close connection number i, ignoring errors (it may be dead).
+        """
+        if i not in self.cursors:
+            return
+        db_obj = self.db_objs[i]
+        try:
+            db_obj.close_cursor(self.cursors[i])
+            db_obj.close()
+        except (Exception, SystemExit):
+            pass
+        del self.cursors[i]
+
+    def _healthy(self, i):
+        """
+        Check if connection number i is still usable.
+        Returns True or False.
+        """
+        db_obj = self.db_objs[i]
+        db_cur = self.cursors[i]
+        try:
+            if not db_obj.execute(db_cur, 'SELECT 1', has_results=True):
+                return False
+            return bool(db_obj.fetchall(db_cur)[0])
+        except (Exception, SystemExit):
+            return False
+
+    def checkout(self, autocommit=True):
+
+        """
+        Get a connection from the pool.
+
+        Returns a tuple of (db_obj, db_cur).
+
+        Parameters:
+            autocommit: the autocommit state to put the connection in
+
+        Dependencies:
+            modules: sys, nori
+
+        """
+
+        self._init_slots()
+        if not self.free:
+            nori.core.email_logger.error(
+                'Internal Error: no free connections in the pool for {0} '
+                '(see {1}); exiting.'.format(self.name, self.size_setting)
+            )
+            sys.exit(nori.core.exitvals['internal']['num'])
+        i = self.free.pop()
+        if i not in self.cursors:
+            self._connect(i)
+        elif not self._healthy(i):
+            nori.core.status_logger.info(
+                'Database connection {0} for {1} failed its health check; '
+                'reconnecting.'.format(i, self.name)
+            )
+            self._disconnect(i)
+            self._connect(i)
+        self.db_objs[i].autocommit(autocommit)
+        return (self.db_objs[i], self.cursors[i])
+
+    def checkin(self, db_obj, db_cur):
+        """
+        Return a connection to the pool.
+        Parameters:
+            db_obj, db_cur: as returned by checkout()
+        """
+        if self.db_objs is None:
+            return
+        for i, pool_db_obj in enumerate(self.db_objs):
+            if (pool_db_obj is db_obj and i in self.cursors and
+                  i not in self.free):
+                if not db_obj.autocommit(None):
+                    db_obj.rollback()
+                    db_obj.autocommit(True)
+                self.free.append(i)
+                return
+
+    @contextlib.contextmanager
+    def connection(self, autocommit=True):
+        """
+        Context manager for checking a connection out and back in.
+        Yields a tuple of (db_obj, db_cur).
+        Parameters:
+            see checkout()
+        """
+        db_obj, db_cur = self.checkout(autocommit)
+        try:
+            yield (db_obj, db_cur)
+        finally:
+            self.checkin(db_obj, db_cur)
+
+    def close(self):
+        """
+        Close all of the connections (checked out or not).
+        """
+        for i in list(self.cursors):
+            self._disconnect(i)
+        if self.db_objs is not None:
+            self.free = list(reversed(range(len(self.db_objs))))
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+###################
+# connection pools
+###################
+
+def get_db_pool(db_name):
+    """
+    Get the connection pool for one of the databases, creating it if
+    necessary.
+    When recording or replaying database traffic (see the db_trace_mode
+    setting), the pool uses RecordingDB / ReplayDB objects.
+    Returns a DBPool object.
+    Parameters:
+        db_name: 'sourcedb' or 'destdb' (before applying the value of
+                 the 'reverse' setting), or either one with '_replica'
+                 appended
+    Dependencies:
+        config settings: db_trace_mode
+        globals: db_pools, sourcedb, destdb, sourcedb_replica,
+                 destdb_replica
+        functions: dbtrace.read_db_trace()
+        classes: DBPool, dbtrace.RecordingDB, dbtrace.ReplayDB
+        modules: nori, dbtrace
+    """
+    if db_name not in db_pools:
+        db_obj = {'sourcedb': sourcedb, 'destdb': destdb,
+                  'sourcedb_replica': sourcedb_replica,
+                  'destdb_replica': destdb_replica}[db_name]
+        if nori.core.cfg['db_trace_mode'] == 'record':
+            db_obj = dbtrace.RecordingDB(db_obj, db_name)
+        elif nori.core.cfg['db_trace_mode'] == 'replay':
+            db_obj = dbtrace.ReplayDB(db_name, dbtrace.read_db_trace())
+        # replicas use the same pool size as their primaries
+        db_pools[db_name] = DBPool(
+            db_obj, db_name, db_name.split('_')[0] + '_pool_size'
+        )
+    return db_pools[db_name]
+
+
+def get_read_db_pool(db_name):
+    """
+    Get the connection pool to use for reads from one of the databases:
+    its replica's, if there is one, otherwise its own.
+    Returns a DBPool object.
+    Parameters:
+        db_name: 'sourcedb' or 'destdb' (before applying the value of
+                 the 'reverse' setting)
+    Dependencies:
+        config settings: sourcedb_replica, destdb_replica
+        functions: get_db_pool()
+        modules: nori
+    """
+    if nori.core.cfg[db_name + '_replica']:
+        return get_db_pool(db_name + '_replica')
+    return get_db_pool(db_name)
+
+
+def connect_dbs():
+
+    """
+    Connect to the databases.
+
+    Returns a tuple of (s_db, s_cur, d_db, d_cur): the connection and
+    cursor objects for the source and destination databases, after
+    applying the value of the 'reverse' setting.
+
+    The connections are checked out of the connection pools (see
+    DBPool); other connections can be checked out of the same pools
+    while these are in use, if the pool sizes allow.
+
+    If the databases have read replicas (see the sourcedb_replica and
+    destdb_replica settings), connections to them are also checked out,
+    and recorded in read_dbs for get_read_db().  In incremental runs,
+    the source database's replica isn't used, because replication lag
+    could make the incremental reads skip changes permanently.
+
+    Dependencies:
+        config settings: reverse, incremental, sourcedb_replica,
+                         destdb_replica
+        globals: read_dbs
+        functions: get_db_pool()
+        modules: nori
+
+    """
+
+    if not nori.core.cfg['reverse']:
+        s_name, d_name = 'sourcedb', 'destdb'
+    else:
+        s_name, d_name = 'destdb', 'sourcedb'
+    s_db, s_cur = get_db_pool(s_name).checkout()
+    d_db, d_cur = get_db_pool(d_name).checkout()
+    for db_name, db_obj in [(s_name, s_db), (d_name, d_db)]:
+        if not nori.core.cfg[db_name + '_replica']:
+            continue
+        if db_obj is s_db and nori.core.cfg['incremental']:
+            nori.core.status_logger.info(
+                'Incremental run; reading from the source database '
+                'primary, not the replica.'
+            )
+            continue
+        read_dbs[id(db_obj)] = get_db_pool(db_name + '_replica').checkout()
+    return (s_db, s_cur, d_db, d_cur)
+
+
+def release_dbs(s_db, s_cur, d_db, d_cur):
+    """
+    Return the database connections from connect_dbs() (including any
+    read-replica connections) to their pools, without closing them.
+    Parameters:
+        see the return value of connect_dbs()
+    Dependencies:
+        globals: read_dbs
+        functions: get_db_pool()
+    """
+    conns = [(s_db, s_cur), (d_db, d_cur)] + list(read_dbs.values())
+    read_dbs.clear()
+    for db_name in ['sourcedb', 'destdb', 'sourcedb_replica',
+                    'destdb_replica']:
+        for db_obj, db_cur in conns:
+            get_db_pool(db_name).checkin(db_obj, db_cur)
+
+
+def close_db_pools():
+    """
+    Close all of the pooled database connections (including those from
+    connect_dbs()).
+    Dependencies:
+        globals: read_dbs
+        functions: get_db_pool()
+    """
+    read_dbs.clear()
+    for db_name in ['destdb_replica', 'sourcedb_replica', 'destdb',
+                    'sourcedb']:
+        get_db_pool(db_name).close()
+
+
+################
+# read replicas
+################
+
+def get_read_db(db_obj, db_cur, consistent=True, cv_seq=None):
+    """
+    Get the connection to use for a read from a database.
+    This is the database's read replica (see connect_dbs()), if there is
+    one, unless consistent is true and the fields being read have
+    already been written to during this run (see core.query_dispatcher()),
+    so the read has to see the changes.
+    Returns a tuple of (db_obj, db_cur).
+    Parameters:
+        db_obj: the primary database connection object
+        db_cur: the primary database cursor object
+        consistent: if true, the read needs to see this run's changes
+        cv_seq: the key_cv + value_cv sequence of the read, or None if
+                it isn't known (in which case any write counts)
+    Dependencies:
+        globals: read_dbs, written_dbs
+        functions: cv_idents()
+    """
+    if id(db_obj) not in read_dbs:
+        return (db_obj, db_cur)
+    written = written_dbs.get(id(db_obj))
+    if consistent and written:
+        if cv_seq is None or written & cv_idents(cv_seq):
+            return (db_obj, db_cur)
+    return read_dbs[id(db_obj)]
+
+
+def cv_idents(cv_seq):
+    """
+    Get the identifiers of the fields in a key_cv / value_cv sequence,
+    for read-replica routing (see get_read_db()).
+    Returns a set of strings.
+    """
+    return set([repr(cv[0]) for cv in cv_seq])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+
+"""
+This is the profiling module for the raingutter database diff and sync
+tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import os
+import collections
+import contextlib
+import re
+import threading
+import cProfile
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from .template_keys import *
+
+
+########################################################################
+#                               CLASSES
+########################################################################
+
+############
+# profiling
+############
+
+class StackSampler(object):
+
+    """
+    Sample a thread's call stack at intervals, from a background thread,
+    and count the collapsed stacks (outermost frame first, separated by
+    semicolons).
+
+    """
+
+    def __init__(self, interval, thread_id=None):
+        """
+        Parameters:
+            interval: the time between samples, in seconds
+            thread_id: the ident of the thread to sample; defaults to
+                       the current thread
+        Dependencies:
+            modules: collections, threading
+        """
+        self.interval = interval
+        self.thread_id = (thread_id if thread_id is not None
+                          else threading.current_thread().ident)
+        self.counts = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, and wait for the sampling thread to finish.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        """
+        Take samples until stopped (runs in the sampling thread).
+        Dependencies:
+            modules: sys, os
+        """
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno
+                ))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, stream):
+        """
+        Write the collapsed stacks and their counts, one per line.
+        Parameters:
+            stream: a file-like object to write to
+        """
+        for stack, count in sorted(self.counts.items()):
+            stream.write('{0} {1}\n'.format(stack, count))
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+############
+# profiling
+############
+
+def get_profile_name(t_index=None, phase=None):
+    """
+    Get the base file name for a profile.
+    Returns 'pre-action' / 'post-action' for those phases, or
+    'template-NN-NAME' for a template (with unsafe characters replaced).
+    Parameters:
+        t_index: the index of the template, or None
+        phase: 'pre-action' or 'post-action' if t_index is None
+    Dependencies:
+        config settings: templates
+        globals: T_NAME_KEY
+        modules: re, nori
+    """
+    if t_index is None:
+        return phase
+    t_name = nori.core.cfg['templates'][t_index][T_NAME_KEY]
+    return re.sub(r'[^A-Za-z0-9._-]+', '_',
+                  'template-{0:02d}-{1}'.format(t_index, t_name))
+
+
+@contextlib.contextmanager
+def profile_section(t_index=None, phase=None):
+
+    """
+    Context manager for profiling part of the run (see the profile
+    setting); does nothing if profiling is off.
+
+    Parameters:
+        see get_profile_name()
+
+    Dependencies:
+        config settings: profile, profile_sample_interval
+        functions: write_profile()
+        classes: StackSampler
+        modules: cProfile, nori
+
+    """
+
+    if not nori.core.cfg['profile']:
+        yield
+        return
+    sampler = None
+    if nori.core.cfg['profile_sample_interval']:
+        sampler = StackSampler(nori.core.cfg['profile_sample_interval'])
+        sampler.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        write_profile(get_profile_name(t_index, phase), profiler, sampler)
+
+
+def write_profile(name, profiler, sampler):
+
+    """
+    Write the profiles for part of the run to the profile directory.
+
+    Parameters:
+        name: the base file name (see get_profile_name())
+        profiler: the cProfile.Profile object
+        sampler: the StackSampler object, or None
+
+    Dependencies:
+        config settings: profile_dir
+        modules: os, nori
+
+    """
+
+    base = os.path.join(nori.core.cfg['profile_dir'], name)
+    try:
+        if not os.path.isdir(nori.core.cfg['profile_dir']):
+            os.makedirs(nori.core.cfg['profile_dir'])
+        profiler.dump_stats(base + '.pstats')
+        if sampler is not None:
+            with open(base + '.folded', 'w') as f:
+                sampler.write(f)
+    except (IOError, OSError) as e:
+        nori.core.email_logger.error(
+            'Warning: could not write the profile {0}:\n{1}' .
+            format(nori.pps(base), e)
+        )
+        return
+    nori.core.status_logger.info(
+        'Profile written to {0}.*'.format(nori.pps(base))
+    )
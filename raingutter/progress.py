@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+
+"""
+This is the progress reporting module for the raingutter database diff
+and sync tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import collections
+import time
+import json
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from .template_keys import *
+from . import metrics
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# run state
+############
+
+# The progress counters for the phases currently in progress (see
+# start_progress()): a dictionary of phase names and lists of
+# [template index, unit, total, estimated, done, start time, last event
+# time, events emitted].
+progress_counters = {}
+
+# The item counts from the last time each phase of each template
+# finished, for estimating the totals of phases whose totals are unknown
+# (see finish_progress()): a dictionary keyed by tuples of (template
+# name, phase).  This is kept between runs in daemon mode.
+progress_estimates = {}
+
+# the open progress file stream, if any; see write_progress_event()
+progress_stream = None
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+###########
+# progress
+###########
+
+def read_progress_phase():
+    """
+    Get the read phase currently being timed, for counting its progress.
+    Returns 'source read', 'dest read', or None.
+    Dependencies:
+        globals: metrics.phase_stack
+        modules: metrics
+    """
+    if (metrics.phase_stack and
+          metrics.phase_stack[-1][1] in ('source read', 'dest read')):
+        return metrics.phase_stack[-1][1]
+    return None
+
+
+def start_progress(t_index, phase, total=None, unit='rows'):
+
+    """
+    Start counting the progress of a phase of a template.
+
+    Progress messages are then emitted by advance_progress() at most
+    every progress_interval seconds; end the count with
+    finish_progress().  Does nothing if progress_interval is None.
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+        phase: the name of the phase (see TIMING_PHASES)
+        total: the total number of items to be handled, or None if it
+               isn't known (in which case the count from the last time
+               the phase finished is used as an estimate, if there is
+               one)
+        unit: the name of the items being counted, for the messages
+
+    Dependencies:
+        config settings: progress_interval, templates
+        globals: progress_counters, progress_estimates, metrics.monotonic,
+                 T_NAME_KEY
+        modules: nori, metrics
+
+    """
+
+    if nori.core.cfg['progress_interval'] is None:
+        return
+    estimated = False
+    if total is None:
+        t_name = nori.core.cfg['templates'][t_index][T_NAME_KEY]
+        total = progress_estimates.get((t_name, phase))
+        estimated = total is not None
+    now = metrics.monotonic()
+    progress_counters[phase] = [t_index, unit, total, estimated, 0, now,
+                                now, 0]
+
+
+def advance_progress(phase, count=1):
+    """
+    Add to the progress count of a phase, emitting a message if it's due.
+    Does nothing if the phase isn't being counted (see start_progress()).
+    Parameters:
+        phase: the name of the phase
+        count: the number of items handled since the last call
+    Dependencies:
+        config settings: progress_interval
+        globals: progress_counters, metrics.monotonic
+        functions: emit_progress()
+        modules: nori, metrics
+    """
+    counter = progress_counters.get(phase)
+    if counter is None:
+        return
+    counter[4] += count
+    now = metrics.monotonic()
+    if now - counter[6] >= nori.core.cfg['progress_interval']:
+        counter[6] = now
+        emit_progress(phase, counter, now, False)
+
+
+def finish_progress(phase):
+    """
+    Stop counting the progress of a phase.
+    If any progress messages were emitted for the phase, a final one is
+    emitted.  The count is kept as the estimated total for next time.
+    Parameters:
+        phase: the name of the phase
+    Dependencies:
+        config settings: templates
+        globals: progress_counters, progress_estimates, metrics.monotonic,
+                 T_NAME_KEY
+        functions: emit_progress()
+        modules: nori, metrics
+    """
+    counter = progress_counters.pop(phase, None)
+    if counter is None:
+        return
+    t_name = nori.core.cfg['templates'][counter[0]][T_NAME_KEY]
+    progress_estimates[(t_name, phase)] = counter[4]
+    if counter[7]:
+        emit_progress(phase, counter, metrics.monotonic(), True)
+
+
+def format_eta(seconds):
+    """
+    Format a number of seconds as H:MM:SS.
+    Returns a string, or '?' if seconds is None.
+    """
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02}:{2:02}'.format(hours, minutes, seconds)
+
+
+def emit_progress(phase, counter, now, final):
+
+    """
+    Log a progress message, and write it to the progress file (if any).
+
+    Parameters:
+        phase: the name of the phase
+        counter: the phase's entry in progress_counters
+        now: the current time (from metrics.monotonic())
+        final: True if the phase has finished
+
+    Dependencies:
+        config settings: progress_file, templates
+        globals: T_NAME_KEY
+        functions: format_eta(), write_progress_event()
+        modules: collections, time, nori
+
+    """
+
+    t_index, unit, total, estimated, done, start = counter[0:6]
+    counter[7] += 1
+    elapsed = now - start
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if final:
+        eta = 0.0
+    elif total is not None and rate > 0 and done <= total:
+        eta = (total - done) / rate
+    t_name = nori.core.cfg['templates'][t_index][T_NAME_KEY]
+
+    if total is not None and total > 0:
+        done_str = ('{0} of {1}{2} {3} ({4:.1f}%)' .
+                    format(done, '~' if estimated else '', total, unit,
+                           min(done / total, 1.0) * 100))
+    else:
+        done_str = '{0} {1}'.format(done, unit)
+    nori.core.status_logger.info(
+        'Template {0}, {1}: {2}, {3:.1f} {4}/s, {5}' .
+        format(nori.pps(t_name), phase, done_str, rate, unit,
+               'done in {0}'.format(format_eta(elapsed)) if final
+               else 'ETA {0}'.format(format_eta(eta)))
+    )
+
+    if nori.core.cfg['progress_file'] is not None:
+        write_progress_event(collections.OrderedDict([
+            ('time', round(time.time(), 3)),
+            ('template_index', t_index),
+            ('template_name', t_name),
+            ('phase', phase),
+            ('unit', unit),
+            ('done', done),
+            ('total', total),
+            ('estimated', estimated),
+            ('rate', round(rate, 3)),
+            ('eta', None if eta is None else round(eta, 3)),
+            ('elapsed', round(elapsed, 3)),
+            ('final', final),
+        ]))
+
+
+def write_progress_event(event):
+    """
+    Append an event to the progress file, opening it if necessary.
+    Parameters:
+        event: an OrderedDict (see emit_progress())
+    Dependencies:
+        config settings: progress_file
+        globals: progress_stream
+        modules: json, nori
+    """
+    global progress_stream
+    if progress_stream is None:
+        try:
+            progress_stream = open(nori.core.cfg['progress_file'], 'a')
+        except (IOError, OSError) as e:
+            nori.core.email_logger.error(
+                'Warning: could not open the progress file {0}; progress '
+                'events\nwill not be written:\n{1}' .
+                format(nori.pps(nori.core.cfg['progress_file']), e)
+            )
+            nori.core.cfg['progress_file'] = None
+            return
+    progress_stream.write(json.dumps(event) + '\n')
+    progress_stream.flush()
+
+
+def close_progress_file():
+    """
+    Close the progress file stream, if it's open.
+    Dependencies:
+        globals: progress_stream
+    """
+    global progress_stream
+    if progress_stream is not None:
+        progress_stream.close()
+        progress_stream = None
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+
+"""
+This is the destination snapshot module for the raingutter database diff
+and sync tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+import sys
+import collections
+import time
+import shelve
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+#########
+# add-on
+#########
+
+import nori
+
+
+###############
+# this package
+###############
+
+from .template_keys import *
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# constants
+############
+
+# the format version of destination snapshot entries; see
+# save_dest_snapshot()
+DEST_SNAPSHOT_VERSION = 1
+
+
+############
+# run state
+############
+
+# the open destination snapshot store (a shelf), if any; see
+# open_dest_snapshot()
+dest_snapshot = None
+
+# the indexes of templates whose destination snapshot entries have been
+# marked dirty during this run (see mark_dest_snapshot_dirty())
+dest_snapshot_dirty = set()
+
+
+########################################################################
+#                              FUNCTIONS
+########################################################################
+
+#######################
+# destination snapshot
+#######################
+
+def open_dest_snapshot():
+    """
+    Open the destination snapshot store, if requested.
+    Dependencies:
+        config settings: dest_snapshot_file
+        globals: dest_snapshot
+        modules: sys, shelve, nori
+    """
+    global dest_snapshot
+    if nori.core.cfg['dest_snapshot_file'] is None:
+        return
+    try:
+        dest_snapshot = shelve.open(nori.core.cfg['dest_snapshot_file'],
+                                    protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        nori.core.email_logger.error(
+            'Error: could not open destination snapshot file {0}:\n{1}\n'
+            'Exiting.'.format(nori.pps(nori.core.cfg['dest_snapshot_file']),
+                              e)
+        )
+        sys.exit(nori.core.exitvals['startup']['num'])
+
+
+def close_dest_snapshot():
+    """
+    Close the destination snapshot store, if it's open.
+    Dependencies:
+        globals: dest_snapshot
+    """
+    global dest_snapshot
+    if dest_snapshot is not None:
+        dest_snapshot.close()
+    dest_snapshot = None
+
+
+def get_dest_snapshot_key(t_index):
+    """
+    Get the key of a template's entry in the destination snapshot store.
+    Returns a string.
+    Parameters:
+        t_index: the index of the template in the templates setting
+    Dependencies:
+        config settings: reverse, templates
+        globals: T_NAME_KEY
+        modules: nori
+    """
+    direction = 'reverse' if nori.core.cfg['reverse'] else 'forward'
+    template = nori.core.cfg['templates'][t_index]
+    return str('{0}:{1}'.format(direction, template[T_NAME_KEY]))
+
+
+def get_dest_snapshot_cv(t_index):
+    """
+    Get a representation of a template's destination cv sequences.
+    This is stored with each snapshot entry, so entries from before a
+    template was changed aren't used.
+    Returns a string.
+    Parameters:
+        t_index: the index of the template in the templates setting
+    Dependencies:
+        config settings: reverse, templates
+        globals: T_S_QUERY_ARGS_KEY, T_D_QUERY_ARGS_KEY
+        modules: nori
+    """
+    template = nori.core.cfg['templates'][t_index]
+    if not nori.core.cfg['reverse']:
+        dest_kwargs = template[T_D_QUERY_ARGS_KEY][1]
+    else:
+        dest_kwargs = template[T_S_QUERY_ARGS_KEY][1]
+    return repr((dest_kwargs['key_cv'], dest_kwargs['value_cv']))
+
+
+def load_dest_snapshot(t_index):
+
+    """
+    Get a template's destination rows from the snapshot store.
+
+    Returns a list of (num_keys, row) tuples (transformed, but not
+    filtered by keys), or None if there is no usable entry (including if
+    it's due for verification, see dest_snapshot_max_age, or if an
+    earlier run stopped partway through the template's changes, see
+    mark_dest_snapshot_dirty()).
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+
+    Dependencies:
+        config settings: dest_snapshot_max_age
+        globals: dest_snapshot, DEST_SNAPSHOT_VERSION
+        functions: get_dest_snapshot_key(), get_dest_snapshot_cv()
+        modules: time, nori
+
+    """
+
+    entry = dest_snapshot.get(get_dest_snapshot_key(t_index))
+    if (entry is None or
+          entry['version'] != DEST_SNAPSHOT_VERSION or
+          entry['cv'] != get_dest_snapshot_cv(t_index) or
+          entry.get('dirty')):
+        nori.core.status_logger.info(
+            'No usable destination snapshot; reading the destination '
+            'database.'
+        )
+        return None
+    max_age = nori.core.cfg['dest_snapshot_max_age']
+    if max_age is not None and time.time() - entry['read_time'] > max_age:
+        nori.core.status_logger.info(
+            'Destination snapshot is due for verification; reading the '
+            'destination database.'
+        )
+        return None
+    nori.core.status_logger.info(
+        'Using the destination snapshot ({0} row(s)).' .
+        format(len(entry['rows']))
+    )
+    return entry['rows']
+
+
+def save_dest_snapshot(t_index, rows):
+
+    """
+    Replace a template's destination snapshot with freshly-read rows.
+
+    If there was a clean entry already, it is compared with the new
+    rows, and a warning is logged if they differ (i.e., if something
+    else has changed the destination database).
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+        rows: a list of (num_keys, row) tuples, as read from the
+              destination database and transformed
+
+    Dependencies:
+        config settings: templates
+        globals: dest_snapshot, DEST_SNAPSHOT_VERSION, T_NAME_KEY
+        functions: get_dest_snapshot_key(), get_dest_snapshot_cv()
+        modules: time, nori
+
+    """
+
+    key = get_dest_snapshot_key(t_index)
+    cv = get_dest_snapshot_cv(t_index)
+    old_entry = dest_snapshot.get(key)
+    if (old_entry is not None and
+          old_entry['version'] == DEST_SNAPSHOT_VERSION and
+          old_entry['cv'] == cv and not old_entry.get('dirty')):
+        try:
+            num_differing = len(set(old_entry['rows']) ^ set(rows))
+        except TypeError:
+            # unhashable values; fall back to a simple comparison
+            num_differing = 0 if old_entry['rows'] == rows else 1
+        if num_differing:
+            template = nori.core.cfg['templates'][t_index]
+            nori.core.email_logger.error(
+                'Warning: the destination snapshot for template {0} was '
+                'out of date\n({1} row(s) differed); has something else '
+                'changed the destination database?' .
+                format(nori.pps(template[T_NAME_KEY]), num_differing)
+            )
+    dest_snapshot[key] = dict(version=DEST_SNAPSHOT_VERSION, cv=cv,
+                              read_time=time.time(), rows=rows)
+
+
+def mark_dest_snapshot_dirty(t_index):
+
+    """
+    Mark a template's destination snapshot entry as dirty, before the
+    first change is made for the template.
+
+    The mark is written to disk immediately, so if the run stops before
+    update_dest_snapshot() has applied the template's changes to the
+    entry (and cleared the mark), the next run re-reads the destination
+    database instead of replaying changes that were already made.
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+
+    Dependencies:
+        globals: dest_snapshot, dest_snapshot_dirty
+        functions: get_dest_snapshot_key()
+
+    """
+
+    if dest_snapshot is None or t_index in dest_snapshot_dirty:
+        return
+    dest_snapshot_dirty.add(t_index)
+    key = get_dest_snapshot_key(t_index)
+    entry = dest_snapshot.get(key)
+    if entry is None:
+        return
+    entry['dirty'] = True
+    dest_snapshot[key] = entry
+    dest_snapshot.sync()
+
+
+def update_dest_snapshot(t_index, changes, failed):
+
+    """
+    Apply the changes made for a template to its destination snapshot.
+
+    Must be called only once all of the template's changes have been
+    made; this clears the entry's dirty mark (see
+    mark_dest_snapshot_dirty()).  If any change for the template has
+    failed, the entry is discarded instead.
+
+    Parameters:
+        t_index: the index of the template in the templates setting
+        changes: the changes made for the template, in the format of
+                 core.template_changes
+        failed: whether any change for the template has failed
+
+    Dependencies:
+        config settings: templates
+        globals: dest_snapshot, dest_snapshot_dirty, T_MULTIPLE_KEY
+        functions: get_dest_snapshot_key()
+        modules: collections, nori
+
+    """
+
+    if dest_snapshot is None:
+        return
+    dest_snapshot_dirty.discard(t_index)
+    key = get_dest_snapshot_key(t_index)
+    if key not in dest_snapshot:
+        return
+    if failed:
+        nori.core.status_logger.info(
+            'Discarding the destination snapshot, due to failed changes.'
+        )
+        del dest_snapshot[key]
+        dest_snapshot.sync()
+        return
+    if not changes:
+        if dest_snapshot[key].get('dirty'):
+            entry = dest_snapshot[key]
+            del entry['dirty']
+            dest_snapshot[key] = entry
+            dest_snapshot.sync()
+        return
+
+    # index the rows by keys, or by the whole row for multiple-valued
+    # templates
+    t_multiple = nori.core.cfg['templates'][t_index][T_MULTIPLE_KEY]
+    entry = dest_snapshot[key]
+    rows = collections.OrderedDict()
+    for row in entry['rows']:
+        rows[row[1] if t_multiple else row[1][0:row[0]]] = row
+
+    # after a change, the destination row matches the source row
+    for change in changes:
+        mode, scope, s_row, d_row = change[0:4]
+        if mode in ['update', 'delete']:
+            rows.pop(d_row[1] if t_multiple else d_row[1][0:d_row[0]],
+                     None)
+        if mode in ['update', 'insert']:
+            rows[s_row[1] if t_multiple else s_row[1][0:s_row[0]]] = s_row
+
+    entry['rows'] = list(rows.values())
+    entry.pop('dirty', None)
+    dest_snapshot[key] = entry
+    dest_snapshot.sync()
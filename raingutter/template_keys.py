@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+
+"""
+This is the template element names module for the raingutter database
+diff and sync tool; see __main__.py for license and usage information.
+"""
+
+
+########################################################################
+#                               IMPORTS
+########################################################################
+
+#########
+# system
+#########
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+from pprint import pprint as pp  # for debugging
+
+
+########################################################################
+#                              VARIABLES
+########################################################################
+
+############
+# constants
+############
+
+# template elements (see the 'templates' setting)
+T_NAME_KEY = 'name'
+T_MULTIPLE_KEY = 'multiple_values'
+T_S_QUERY_ARGS_KEY = 'source_query_args'
+T_TO_D_FUNC_KEY = 'to_dest_func'
+T_S_NO_REPL_KEY = 'source_no_replicate'
+T_S_CHANGE_CB_KEY = 'source_change_callbacks'
+T_D_QUERY_ARGS_KEY = 'dest_query_args'
+T_TO_S_FUNC_KEY = 'to_source_func'
+T_D_NO_REPL_KEY = 'dest_no_replicate'
+T_D_CHANGE_CB_KEY = 'dest_change_callbacks'
+T_KEY_MODE_KEY = 'key_mode'
+T_KEY_LIST_KEY = 'key_list'
+T_S_BATCH_CB_KEY = 'source_batch_callbacks'
+T_D_BATCH_CB_KEY = 'dest_batch_callbacks'
+T_S_CHANGED_KEY = 'source_changed_column'
+T_D_CHANGED_KEY = 'dest_changed_column'
+T_KEYS = [
+    T_NAME_KEY,
+    T_MULTIPLE_KEY,
+    T_S_QUERY_ARGS_KEY,
+    T_TO_D_FUNC_KEY,
+    T_S_NO_REPL_KEY,
+    T_S_CHANGE_CB_KEY,
+    T_D_QUERY_ARGS_KEY,
+    T_TO_S_FUNC_KEY,
+    T_D_NO_REPL_KEY,
+    T_D_CHANGE_CB_KEY,
+    T_KEY_MODE_KEY,
+    T_KEY_LIST_KEY,
+    T_S_BATCH_CB_KEY,
+    T_D_BATCH_CB_KEY,
+    T_S_CHANGED_KEY,
+    T_D_CHANGED_KEY,
+]
@@ -0,0 +1,33 @@
+"""
+Shared fixtures for the raingutter tests.
+
+The tests need nori; they're skipped if it isn't installed.
+
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import pytest
+
+
+@pytest.fixture
+def cfg():
+    """
+    Fill in the config settings with their defaults, as nori does when
+    processing a config file, and reset the run state afterwards.
+    Yields the config dict, for overriding settings.
+    """
+    nori = pytest.importorskip('nori')
+    from raingutter import core
+    saved = dict(nori.core.cfg)
+    nori.core.cfg.clear()
+    for name, setting in nori.core.config_settings.items():
+        if 'default' in setting:
+            nori.core.cfg[name] = setting['default']
+    yield nori.core.cfg
+    core.reset_run_state()
+    nori.core.cfg.clear()
+    nori.core.cfg.update(saved)
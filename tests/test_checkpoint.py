@@ -0,0 +1,102 @@
+"""
+Tests for checkpointing and resuming interrupted runs.
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+
+import pytest
+
+nori = pytest.importorskip('nori')
+
+from raingutter import core
+from raingutter import checkpoints
+
+
+@pytest.fixture
+def ckpt_cfg(cfg, tmp_path):
+    cfg.update(
+        checkpoint_file=str(tmp_path / 'checkpoint'),
+        checkpoint_interval=0,
+        action='sync',
+        readonly_window='full',
+        reverse=False,
+        resume=False,
+        templates=[{core.T_NAME_KEY: 'first'},
+                   {core.T_NAME_KEY: 'second'}],
+    )
+    yield cfg
+    interrupt()
+
+
+# the state passed to the checkpoint functions (standing in for
+# core.template_changes and core.drupal_touched_entities)
+changes = []
+touched = {}
+
+
+def interrupt():
+    """
+    Throw away the in-memory state, as if the process had died.
+    """
+    checkpoints.checkpoint = None
+    checkpoints.resume_point = None
+    del changes[:]
+    touched.clear()
+
+
+def rows(*keys):
+    return [(1, (key, 'value ' + key)) for key in keys]
+
+
+def test_resume_in_middle_of_template(ckpt_cfg):
+    change = ('update', 'v', rows('b')[0], rows('b')[0], [], [])
+
+    # the first run finishes one template and part of the next
+    checkpoints.start_checkpoint(touched)
+    checkpoints.checkpoint_template(0, False, changes, touched)
+    changes.append(change)
+    touched[('node', 5)] = True
+    checkpoints.checkpoint_key(1, ('b',), changes, touched)
+    checkpoints.checkpoint_key(1, ('d',), changes, touched)
+    assert os.path.exists(ckpt_cfg['checkpoint_file'])
+    interrupt()
+
+    # the resumed run picks up where it left off
+    ckpt_cfg['resume'] = True
+    checkpoints.start_checkpoint(touched)
+    assert checkpoints.checkpoint['done'] == [0]
+    assert checkpoints.resume_point == (1, set([('b',), ('d',)]), [change])
+    assert list(touched) == [('node', 5)]
+    assert checkpoints.resumed_changes_made()
+
+    # 'a' was added to the source after the interruption, and sorts
+    # before the checkpointed keys; 'd' has been removed
+    remaining, skipped = checkpoints.skip_done_rows(
+        rows('a', 'b', 'c', 'e'), checkpoints.resume_point[1]
+    )
+    assert remaining == rows('a', 'c', 'e')
+    assert skipped == set([('b',)])
+
+
+def test_finished_run_removes_checkpoint(ckpt_cfg):
+    checkpoints.start_checkpoint(touched)
+    checkpoints.checkpoint_template(0, True, changes, touched)
+    checkpoints.checkpoint_template(1, False, changes, touched)
+    assert os.path.exists(ckpt_cfg['checkpoint_file'])
+    checkpoints.finish_checkpoint()
+    assert not os.path.exists(ckpt_cfg['checkpoint_file'])
+
+
+def test_incompatible_checkpoint_is_rejected(ckpt_cfg):
+    checkpoints.start_checkpoint(touched)
+    checkpoints.checkpoint_key(0, ('a',), changes, touched)
+    interrupt()
+    ckpt_cfg['resume'] = True
+    ckpt_cfg['templates'] = [{core.T_NAME_KEY: 'other'}]
+    with pytest.raises(SystemExit):
+        checkpoints.start_checkpoint(touched)
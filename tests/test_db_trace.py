@@ -0,0 +1,109 @@
+"""
+Tests for recording database traffic and replaying it.
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import pytest
+
+nori = pytest.importorskip('nori')
+
+from raingutter import core
+from raingutter import dbtrace
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.rows = []
+
+    def fetchmany(self, size):
+        batch = self.rows[0:size]
+        del self.rows[0:size]
+        return batch
+
+
+class FakeDB(object):
+    """
+    A database object with canned results for each query.
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def execute(self, db_cur, query_str, query_args=None,
+                has_results=False):
+        db_cur.rows = list(self.results[(query_str, tuple(query_args))])
+        return True
+
+    def fetchall(self, db_cur):
+        rows = db_cur.rows
+        db_cur.rows = []
+        return (True, rows)
+
+    def get_last_id(self, db_cur):
+        return 42
+
+
+@pytest.fixture
+def trace_cfg(cfg, tmp_path):
+    cfg.update(db_trace_file=str(tmp_path / 'trace.gz'),
+               db_replay_latency=0)
+    yield cfg
+    dbtrace.close_db_trace()
+    dbtrace.db_trace = None
+
+
+def record(trace_cfg):
+    """
+    Record a session, then read the trace back.
+    """
+    fake = FakeDB({
+        ('SELECT a FROM t WHERE id = %s', (1, )): [(1, ), (2, )],
+        ('SELECT a FROM t WHERE id = %s', (2, )): [(3, ), (4, ), (5, )],
+    })
+    db = dbtrace.RecordingDB(fake, 'sourcedb')
+    cur = FakeCursor()
+    db.execute(cur, 'SELECT a FROM t WHERE id = %s', [1])
+    assert db.fetchall(cur) == (True, [(1, ), (2, )])
+    db.execute(cur, 'SELECT a FROM t WHERE id = %s', [2])
+    batches = []
+    while True:
+        ok, rows = core.db_fetchmany(db, cur, 2)
+        if not rows:
+            break
+        batches.append(rows)
+    assert batches == [[(3, ), (4, )], [(5, )]]
+    assert db.get_last_id(cur) == 42
+    dbtrace.close_db_trace()
+    return dbtrace.read_db_trace()
+
+
+def test_replay_serves_recorded_results(trace_cfg):
+    db = dbtrace.ReplayDB('sourcedb', record(trace_cfg))
+
+    # queries are matched by their arguments, not just their order
+    assert db.execute(None, 'SELECT a FROM t WHERE id = %s', [2])
+    assert db.fetchall(None) == (True, [(3, ), (4, ), (5, )])
+    assert db.execute(None, 'SELECT a FROM t WHERE id = %s', [1])
+    assert core.db_fetchmany(db, None, 1) == (True, [(1, )])
+    assert core.db_fetchmany(db, None, 5) == (True, [(2, )])
+    assert core.db_fetchmany(db, None, 5) == (True, [])
+    assert db.get_last_id(None) == 42
+
+
+def test_replay_matches_other_arguments_by_query(trace_cfg):
+    db = dbtrace.ReplayDB('sourcedb', record(trace_cfg))
+    assert db.execute(None, 'SELECT a FROM t WHERE id = %s', [99])
+    assert db.fetchall(None) == (True, [(1, ), (2, )])
+
+
+def test_replay_exits_on_unrecorded_calls(trace_cfg):
+    trace = record(trace_cfg)
+    db = dbtrace.ReplayDB('sourcedb', trace)
+    with pytest.raises(SystemExit):
+        db.execute(None, 'DELETE FROM t', [])
+    db = dbtrace.ReplayDB('destdb', trace)
+    with pytest.raises(SystemExit):
+        db.get_last_id(None)
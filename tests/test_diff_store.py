@@ -0,0 +1,63 @@
+"""
+Tests for the diff storage.
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import pytest
+
+nori = pytest.importorskip('nori')
+
+from raingutter import core
+
+
+def add_diffs(store, num):
+    """
+    Add diffs with sequential keys, alternating between two groups.
+    """
+    for i in range(num):
+        group = 'even' if i % 2 == 0 else 'odd'
+        store.add(group, i % 3, True, (1, (i, 'source {0}'.format(i))),
+                  False, None)
+
+
+def test_spilled_diffs_iterate_in_order(tmp_path):
+    store = core.DiffStore(memory_limit=2, spill_dir=str(tmp_path))
+    add_diffs(store, 7)
+    assert len(store.records) == 2
+    assert store.spill_file is not None
+    assert len(store) == 7
+
+    assert list(store) == ['even', 'odd']
+    assert [d[2][1][0] for d in store.group('even')] == [0, 2, 4, 6]
+    assert [d[2][1][0] for d in store.group('odd')] == [1, 3, 5]
+    assert list(store.template_indexes) == [0, 1, 2, 0, 1, 2, 0]
+
+    # random access, both before and after the spill point
+    assert store.get('odd', 0) == (1, True, (1, (1, 'source 1')), False,
+                                   None, None)
+    assert store.get('odd', 2) == (2, True, (1, (5, 'source 5')), False,
+                                   None, None)
+
+
+def test_spilled_diff_status_changes(tmp_path):
+    store = core.DiffStore(memory_limit=1, spill_dir=str(tmp_path))
+    add_diffs(store, 4)
+    store.set_status('even', 1, True)
+    store.set_status('odd', 1, False)
+    assert [d[5] for d in store.group('even')] == [None, True]
+    assert [d[5] for d in store.group('odd')] == [None, False]
+
+
+def test_close_discards_diffs(tmp_path):
+    store = core.DiffStore(memory_limit=1, spill_dir=str(tmp_path))
+    add_diffs(store, 3)
+    store.close()
+    assert not store
+    assert list(store) == []
+    assert store.spill_file is None
+    add_diffs(store, 1)
+    assert store.get('even', 0)[2] == (1, (0, 'source 0'))
@@ -0,0 +1,105 @@
+"""
+Tests for the run metrics and their Prometheus rendering.
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+
+import pytest
+
+nori = pytest.importorskip('nori')
+
+from raingutter import core
+from raingutter import metrics
+
+
+class FakeDB(object):
+    """
+    A database object whose statements always succeed.
+    """
+    def execute(self, db_cur, query_str, query_args=None,
+                has_results=False):
+        return True
+
+
+@pytest.fixture
+def metrics_cfg(cfg):
+    # two templates with the same name
+    cfg.update(
+        templates=[{core.T_NAME_KEY: 'servers'},
+                   {core.T_NAME_KEY: 'servers'}],
+        query_stats=False,
+        memory_stats=False,
+    )
+    return cfg
+
+
+def simulate_run():
+    metrics.run_start_time = metrics.monotonic()
+    core.db_execute(FakeDB(), None, 'SELECT 1')
+    for t_index, num_rows in [(0, 5), (1, 7)]:
+        metrics.start_phase(t_index, 'source read')
+        core.db_execute(FakeDB(), None, 'SELECT 2')
+        metrics.end_phase(num_rows)
+    metrics.diff_counts[1] = collections.OrderedDict([('no key in dest', 2)])
+    metrics.sync_op_counts[1] = collections.OrderedDict([
+        (('insert', 'full'), 2),
+    ])
+
+
+def samples(text):
+    return [line for line in text.splitlines()
+            if not line.startswith('#')]
+
+
+def test_prometheus_series(metrics_cfg):
+    simulate_run()
+    text = metrics.render_prometheus_metrics(metrics.get_run_metrics())
+    lines = samples(text)
+
+    assert ('raingutter_rows_read{template_index="0",template="servers",'
+            'side="source"} 5') in lines
+    assert ('raingutter_rows_read{template_index="1",template="servers",'
+            'side="source"} 7') in lines
+    assert ('raingutter_diffs{template_index="1",template="servers",'
+            'category="no key in dest"} 2') in lines
+    assert ('raingutter_sync_operations{template_index="1",'
+            'template="servers",mode="insert",outcome="full"} 2') in lines
+
+    # statements are counted even without query_stats
+    assert ('raingutter_db_statements{template_index="0",'
+            'template="servers"} 1') in lines
+    assert ('raingutter_db_statements{template_index="",template=""} 1'
+            in lines)
+
+    # no duplicate series, despite the duplicate template names
+    series = [line.rsplit(' ', 1)[0] for line in lines]
+    assert len(series) == len(set(series))
+
+
+def test_prometheus_format(metrics_cfg):
+    simulate_run()
+    text = metrics.render_prometheus_metrics(metrics.get_run_metrics())
+    assert text.endswith('\n')
+    seen = set()
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            name = line.split()[2]
+        elif line.startswith('# TYPE '):
+            assert line == '# TYPE {0} gauge'.format(name)
+            seen.add(name)
+        else:
+            # every sample follows its family's HELP and TYPE lines
+            assert line.split('{')[0].split(' ')[0] == name
+    assert 'raingutter_template_peak_traced_bytes' not in seen
+
+
+def test_label_values_are_escaped(metrics_cfg):
+    metrics_cfg['templates'][0][core.T_NAME_KEY] = 'a "b"\\c'
+    simulate_run()
+    text = metrics.render_prometheus_metrics(metrics.get_run_metrics())
+    assert 'template="a \\"b\\"\\\\c"' in text
@@ -0,0 +1,85 @@
+"""
+Tests for the destination snapshot.
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import pytest
+
+nori = pytest.importorskip('nori')
+
+from raingutter import core
+from raingutter import snapshots
+
+
+@pytest.fixture
+def snap_cfg(cfg, tmp_path):
+    cfg.update(
+        dest_snapshot_file=str(tmp_path / 'snapshot'),
+        dest_snapshot_max_age=None,
+        reverse=False,
+        templates=[{
+            core.T_NAME_KEY: 'values',
+            core.T_MULTIPLE_KEY: False,
+            core.T_D_QUERY_ARGS_KEY: ([], dict(
+                key_cv=[('id', 'integer')],
+                value_cv=[('value', 'string')],
+            )),
+        }],
+    )
+    snapshots.open_dest_snapshot()
+    return cfg
+
+
+def change(mode, s_row, d_row):
+    """
+    Make a change in the format used by core.template_changes.
+    """
+    return (mode, 'k', s_row or (None, None), d_row or (None, None), [],
+            [])
+
+
+def test_changes_are_applied_to_snapshot(snap_cfg):
+    snapshots.save_dest_snapshot(0, [(1, (1, 'a')), (1, (2, 'b'))])
+    assert snapshots.load_dest_snapshot(0) == [(1, (1, 'a')), (1, (2, 'b'))]
+
+    # a run that stopped after the first change can't use the snapshot
+    snapshots.mark_dest_snapshot_dirty(0)
+    assert snapshots.load_dest_snapshot(0) is None
+
+    snapshots.update_dest_snapshot(0, [
+        change('update', (1, (1, 'A')), (1, (1, 'a'))),
+        change('delete', None, (1, (2, 'b'))),
+        change('insert', (1, (3, 'c')), None),
+    ], False)
+    assert snapshots.load_dest_snapshot(0) == [(1, (1, 'A')), (1, (3, 'c'))]
+
+
+def test_unchanged_template_clears_dirty_mark(snap_cfg):
+    snapshots.save_dest_snapshot(0, [(1, (1, 'a'))])
+    snapshots.mark_dest_snapshot_dirty(0)
+    snapshots.update_dest_snapshot(0, [], False)
+    assert snapshots.load_dest_snapshot(0) == [(1, (1, 'a'))]
+
+
+def test_failed_changes_discard_snapshot(snap_cfg):
+    snapshots.save_dest_snapshot(0, [(1, (1, 'a'))])
+    snapshots.mark_dest_snapshot_dirty(0)
+    snapshots.update_dest_snapshot(0, [
+        change('update', (1, (1, 'A')), (1, (1, 'a'))),
+    ], True)
+    assert snapshots.load_dest_snapshot(0) is None
+    assert snapshots.get_dest_snapshot_key(0) not in snapshots.dest_snapshot
+
+
+def test_multiple_valued_rows_are_matched_whole(snap_cfg):
+    snap_cfg['templates'][0][core.T_MULTIPLE_KEY] = True
+    snapshots.save_dest_snapshot(0, [(1, (1, 'a')), (1, (1, 'b'))])
+    snapshots.update_dest_snapshot(0, [
+        change('delete', None, (1, (1, 'a'))),
+        change('insert', (1, (1, 'c')), None),
+    ], False)
+    assert snapshots.load_dest_snapshot(0) == [(1, (1, 'b')), (1, (1, 'c'))]
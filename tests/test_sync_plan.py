@@ -0,0 +1,107 @@
+"""
+Tests for writing a sync plan and applying it in a later run.
+"""
+
+
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import pytest
+
+nori = pytest.importorskip('nori')
+
+from raingutter import core
+
+
+class Recorder(object):
+    """
+    A query function that records the changes it is asked to make.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, db_obj, db_cur, mode, scope, tables, key_cv,
+                 value_cv, **kwargs):
+        self.calls.append((mode, [cv[2] for cv in key_cv],
+                           [cv[2] for cv in value_cv]))
+        return True
+
+
+@pytest.fixture
+def plan_cfg(cfg, tmp_path):
+    cfg.update(
+        action='plan',
+        sync_plan_file=str(tmp_path / 'plan'),
+        reverse=False,
+        bidir=True,
+        source_type='generic',
+        dest_type='generic',
+        dest_query_func=Recorder(),
+        templates=[{
+            core.T_NAME_KEY: 'values',
+            core.T_S_QUERY_ARGS_KEY: ([], dict(
+                tables='source_table',
+                key_cv=[('id', 'integer')],
+                value_cv=[('value', 'string')],
+            )),
+            core.T_D_QUERY_ARGS_KEY: ([], dict(
+                tables='dest_table',
+                key_cv=[('id', 'integer')],
+                value_cv=[('value', 'string')],
+            )),
+        }],
+    )
+    core.apply_config_defaults()
+    core.diff_store = core.DiffStore()
+    return cfg
+
+
+def make_plan():
+    s_rows = [(1, (1, 'new')), (1, (3, 'added'))]
+    d_rows = [(1, (1, 'old')), (1, (2, 'removed'))]
+    core.do_diff_sync(0, s_rows, d_rows, None, None)
+    core.write_sync_plan()
+
+
+def start_apply_run(plan_cfg):
+    """
+    Throw away the planning run's state, as a separate run would.
+    """
+    core.reset_run_state()
+    plan_cfg['action'] = 'apply'
+
+
+def test_plan_makes_no_changes(plan_cfg):
+    make_plan()
+    assert plan_cfg['dest_query_func'].calls == []
+    assert [op[1] for op in core.sync_plan] == ['update', 'insert',
+                                                'delete']
+
+
+def test_apply_makes_planned_changes(plan_cfg):
+    make_plan()
+    start_apply_run(plan_cfg)
+    assert core.apply_sync_plan('d_db', 'd_cur')
+
+    # deletes first, then updates, then inserts
+    calls = plan_cfg['dest_query_func'].calls
+    assert [(mode, keys) for mode, keys, values in calls] == [
+        ('delete', [2]), ('update', [1]), ('insert', [3]),
+    ]
+    assert calls[1][2] == ['new']
+    assert calls[2][2] == ['added']
+
+    # the diffs are logged again, with their new statuses
+    statuses = [d[5] for d in core.diff_store.group(0)]
+    assert statuses == [True, True, True]
+    assert not core.failed_templates
+
+
+def test_plan_for_other_templates_is_rejected(plan_cfg):
+    make_plan()
+    start_apply_run(plan_cfg)
+    plan_cfg['templates'][0][core.T_NAME_KEY] = 'renamed'
+    with pytest.raises(SystemExit):
+        core.apply_sync_plan('d_db', 'd_cur')
+    assert plan_cfg['dest_query_func'].calls == []